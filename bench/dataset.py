@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+
+
+import re
+import random
+import xml.etree.ElementTree as eTree
+
+# Freshservice asset types of the emulator, as (name, parent name).
+ASSET_TYPES = [
+    ("Hardware", None),
+    ("Computer", "Hardware"),
+    ("Virtual Machine", "Computer"),
+    ("Server", "Hardware"),
+    ("Unix Server", "Server"),
+    ("Windows Server", "Server"),
+    ("Host", "Hardware"),
+    ("VMware VCenter Host", "Host"),
+    ("Printer", "Hardware"),
+    ("Router", "Hardware"),
+    ("Firewall", "Hardware"),
+    ("Load Balancer", "Hardware"),
+    ("Switch", "Hardware"),
+    ("Business Service", None),
+    ("Application", None),
+]
+
+# The asset types that the Device42 devices are spread over.
+DEVICE_ASSET_TYPES = ["Computer", "Virtual Machine", "Virtual Machine", "Virtual Machine", "Host", "VMware VCenter Host",
+                      "Switch", "Router", "Printer", "Firewall", "Load Balancer"]
+
+# Headers whose fields every asset type has (their fields are not specific to an asset type).
+COMMON_HEADERS = ["General", "Assignment"]
+# Headers of the mapping that are not named after an asset type, with the asset type that has their fields.
+HEADER_ASSET_TYPES = {
+    "Cost": "Hardware",
+    "Cloud": "Virtual Machine",
+    "VMware VCenter VM": "Virtual Machine",
+    "AWS VM": "Virtual Machine",
+    "Azure VM": "Virtual Machine",
+}
+
+CONTRACT_TYPES = ["Lease", "Warranty", "Maintenance", "Software License"]
+DROPDOWN_CHOICES = 8
+
+
+class Dataset(object):
+    """ Synthetic Device42 and Freshservice data for a mapping file.
+
+    Every enabled task of the mapping gets a DOQL table (bench_<n>_<task>) with rows that have the
+    columns its mapping reads.  The names in the rows are shared between the tables (e.g. the devices
+    of the Software In Use rows are devices of the Devices task), so lookups in Freshservice find
+    what the earlier tasks created.  asset_type_fields, relationship_types and reference hold what
+    the emulator serves for Freshservice.
+    """
+
+    def __init__(self, mapping_path, devices=1000, seed=42):
+        self.random = random.Random(seed)
+        self.devices = devices
+        self.tables = dict()
+        self.task_tables = dict()
+        self.asset_type_fields = dict()
+        self.relationship_types = list()
+
+        count = max(1, devices)
+        self.device_names = ["bench-device-%06d" % i for i in range(count)]
+        self.device_asset_types = [self.random.choice(DEVICE_ASSET_TYPES) for _ in range(count)]
+        self.product_names = ["Bench Model %03d" % i for i in range(max(5, count // 50))]
+        self.software_names = ["Bench Software %05d" % i for i in range(max(10, count // 4))]
+        self.app_names = ["Bench Business App %04d" % i for i in range(max(2, count // 100))]
+        self.contract_names = ["Bench Vendor %02d-PO%05d-1" % (i % 20, i) for i in range(max(2, count // 20))]
+        self.license_names = ["Bench License %05d" % i for i in range(max(2, count // 50))]
+        self.vendor_names = ["Bench Vendor %02d" % i for i in range(20)]
+        self.group_names = ["Bench Customer %02d" % i for i in range(10)]
+        self.agent_emails = ["bench.agent%02d@example.com" % i for i in range(10)]
+        self.serial_number = 0
+
+        self.mapping = eTree.parse(mapping_path)
+        for index, task in enumerate(self.mapping.getroot().iter("task")):
+            if task.get("enable") == "true":
+                self._add_task(index, task)
+
+    @property
+    def reference(self):
+        # The Freshservice objects that exist before the first sync.
+        return {
+            "vendors": [{"name": name} for name in self.vendor_names],
+            "groups": [{"name": name} for name in self.group_names],
+            "agents": [{"email": email, "first_name": email.split("@")[0]} for email in self.agent_emails],
+            "contract_types": [{"name": name} for name in CONTRACT_TYPES],
+        }
+
+    @staticmethod
+    def get_table_name(index, task):
+        slug = re.sub(r"[^a-z0-9]+", "_", (task.get("name") or task.get("description") or "").lower()).strip("_")
+        return "bench_%02d_%s" % (index, slug[:40])
+
+    def _add_task(self, index, task):
+        resource = task.find("api/resource")
+        mapping = task.find("mapping")
+        if resource is None or mapping is None or not resource.get("doql"):
+            return
+
+        _type = task.get("type")
+        fields = mapping.findall("field")
+        if _type == "product":
+            rows = [self._make_row(name, fields) for name in self.product_names]
+        elif _type == "software":
+            rows = [self._make_row(name, fields) for name in self.software_names]
+        elif _type == "software_in_use":
+            rows = self._make_installations(mapping)
+        elif _type in ["affinity_group", "business_app"]:
+            rows = self._make_relationships(mapping)
+        elif _type == "contracts":
+            names = self.license_names if any(field.get("target") == "software_id" for field in fields) else self.contract_names
+            rows = [self._make_row(name, fields) for name in names]
+        elif _type == "contract_in_asset":
+            rows = [{mapping.get("device-name"): self.random.choice(self.device_names),
+                     mapping.get("contract-name"): self.random.choice(self.contract_names)}
+                    for _ in range(len(self.device_names) // 2)]
+        elif mapping.get("source") == "Businessapps":
+            rows = [self._make_row(name, fields, "Business Service") for name in self.app_names]
+            self._add_asset_type_fields(fields)
+        else:
+            rows = [self._make_row(name, fields, asset_type)
+                    for name, asset_type in zip(self.device_names, self.device_asset_types)]
+            self._add_asset_type_fields(fields)
+
+        for pk, row in enumerate(rows, 1):
+            row.setdefault("bench_pk", pk)
+
+        table = self.get_table_name(index, task)
+        self.tables[table] = rows
+        self.task_tables[index] = table
+
+    def _make_row(self, name, fields, asset_type=None):
+        row = {"name": name}
+        if asset_type is not None:
+            row["asset_type"] = asset_type
+
+        for field in fields:
+            for column in [field.get("resource"), field.get("resource-secondary")]:
+                if column and column not in row:
+                    row[column] = self._make_value(column, field)
+
+        return row
+
+    def _make_value(self, column, field):
+        # Some of the values are missing, like in a real inventory.
+        if field.get("not-null") == "true" and self.random.random() < 0.1:
+            return None
+
+        if field.get("is-array") == "true":
+            return [{field.get("sub-key"): "%s value" % column}]
+
+        value_mapping = field.find("value-mapping")
+        if value_mapping is not None:
+            keys = [item.get("key") for item in value_mapping.findall("item")]
+            return self.random.choice(keys + ["unmapped value"])
+
+        foreign = field.get("target-foregin")
+        if foreign == "products":
+            return self.random.choice(self.product_names)
+        if foreign == "vendors":
+            return self.random.choice(self.vendor_names)
+        if foreign == "groups":
+            return self.random.choice(self.group_names)
+        if foreign == "agents":
+            return self.random.choice(self.agent_emails)
+        if foreign == "contract_types":
+            return self.random.choice(CONTRACT_TYPES)
+        if foreign == "applications":
+            return self.random.choice(self.software_names)
+
+        if field.get("target-type") == "dropdown":
+            return "%s option %d" % (field.get("target"), self.random.randrange(DROPDOWN_CHOICES + 2))
+        if field.get("target-type") == "date" or "date" in column:
+            return "2024-%02d-%02d" % (self.random.randint(1, 12), self.random.randint(1, 28))
+        if column in ["serial_no", "serial_number"]:
+            self.serial_number += 1
+            return "SN%08d" % self.serial_number
+
+        source_type = field.get("source-type") or field.get("type")
+        if field.get("target-type") == "integer":
+            return str(self.random.randint(10 ** 9, 10 ** 10))
+        if source_type == "integer":
+            return self.random.randint(1, 64)
+        if source_type == "float":
+            return round(self.random.uniform(1, 4096), 2)
+        if source_type == "boolean":
+            return self.random.random() < 0.8
+
+        return "%s %d" % (column, self.random.randrange(1000))
+
+    def _make_installations(self, mapping):
+        rows = list()
+        for device_name in self.device_names:
+            for software_name in self.random.sample(self.software_names, min(3, len(self.software_names))):
+                rows.append({
+                    mapping.get("device-name"): device_name,
+                    mapping.get("software-name"): software_name,
+                    mapping.get("install-date"): "2024-01-%02d" % self.random.randint(1, 28),
+                    mapping.get("version"): "%d.%d" % (self.random.randint(1, 9), self.random.randint(0, 9)),
+                })
+
+        return rows
+
+    def _make_relationships(self, mapping):
+        relationship_type = (mapping.get("downstream-relationship"), mapping.get("upstream-relationship"))
+        if relationship_type not in self.relationship_types:
+            self.relationship_types.append(relationship_type)
+
+        # Business app names for the columns named after them, device names for the others.
+        key, target_key = mapping.get("key"), mapping.get("target-key")
+        primaries = self.app_names if "business_app" in key else self.device_names
+        secondaries = self.app_names if "business_app" in target_key else self.device_names
+
+        rows = list()
+        for _ in range(len(self.device_names) // 2):
+            primary, secondary = self.random.choice(primaries), self.random.choice(secondaries)
+            if primary != secondary:
+                rows.append({key: primary, target_key: secondary})
+
+        return rows
+
+    def _add_asset_type_fields(self, fields):
+        # The Freshservice fields that the mapping sends, by header.
+        for field in fields:
+            header = field.get("target-header")
+            if not header:
+                continue
+
+            name = field.get("target-field") or field.get("target")
+            header_fields = self.asset_type_fields.setdefault(header, [])
+            if any(header_field["name"] == name for header_field in header_fields):
+                continue
+
+            header_field = {"name": name, "choices": []}
+            if field.get("target-type") == "dropdown":
+                header_field["choices"] = [["%s option %d" % (field.get("target"), i), i] for i in range(DROPDOWN_CHOICES)]
+            header_fields.append(header_field)
+
+    def write_mapping(self, path, freshservice_url, device42_url, workers=None, async_writes=False):
+        """ Write the mapping with the emulator URLs and the DOQL of every enabled task reading its table.
+
+        With async_writes, the asset tasks send their writes with the asyncio client (async="true").
+        """
+        root = self.mapping.getroot()
+        freshservice = root.find("settings/freshservice")
+        freshservice.set("url", freshservice_url)
+        freshservice.set("api_key", "bench")
+        freshservice.set("default_approver_email", self.agent_emails[0])
+        device42 = root.find("settings/device42")
+        device42.set("url", device42_url)
+        device42.set("user", "bench")
+        device42.set("pass", "bench")
+
+        for index, task in enumerate(root.iter("task")):
+            if index in self.task_tables:
+                task.find("api/resource").set("doql", "select * from %s order by bench_pk" % self.task_tables[index])
+                target = task.find("api/target")
+                if workers is not None:
+                    target.set("workers", str(workers))
+                if async_writes and task.get("type") is None and target.get("delete") != "true":
+                    target.set("async", "true")
+
+        self.mapping.write(path, encoding="utf-8")
@@ -0,0 +1,507 @@
+# -*- coding: utf-8 -*-
+
+
+import re
+import sys
+import json
+import math
+import time
+import uuid
+import random
+import hashlib
+import argparse
+import threading
+import itertools
+from collections import OrderedDict, Counter
+from datetime import datetime
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlsplit, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlsplit, parse_qs
+
+from dataset import Dataset, ASSET_TYPES, COMMON_HEADERS, HEADER_ASSET_TYPES
+
+DEFAULT_PER_PAGE = 30
+MAX_PER_PAGE = 100
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+class EmulatorError(Exception):
+    def __init__(self, status, body):
+        super(EmulatorError, self).__init__(body)
+        self.status = status
+        self.body = body
+
+
+def validation_failed(field, message):
+    return EmulatorError(400, {"description": "Validation failed",
+                               "errors": [{"field": field, "message": message, "code": "invalid_value"}]})
+
+
+def singular(collection):
+    return collection[:-1] if collection.endswith("s") else collection
+
+
+class Emulator(object):
+    """ In-memory stand-in for the Freshservice and Device42 endpoints that the sync uses.
+
+    Freshservice lists are paged with page/per_page like the real API (30 per page by default, at most
+    100), GET responses have an ETag and answer 304 to a matching If-None-Match, and with rate_limit
+    (calls per minute) the X-Ratelimit headers are sent and calls over the limit get a 429 with a
+    Retry-After.  Relationship bulk-create jobs complete after the time it takes to create their
+    relationships at relationships_per_second.  Device42 DOQL queries are answered from the tables
+    of a dataset.Dataset, including the count, key range, LIMIT/OFFSET and incremental wrappers that
+    the client adds around them.  Every call waits latency seconds plus up to jitter more.
+    """
+
+    def __init__(self, dataset=None, latency=0.0, jitter=0.0, rate_limit=None, relationships_per_second=50.0, seed=0):
+        self.lock = threading.RLock()
+        self.random = random.Random(seed)
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.tokens = float(rate_limit) if rate_limit else None
+        self.tokens_at = time.time()
+        self.relationships_per_second = relationships_per_second
+        self.stats = Counter()
+        self.ids = itertools.count(1)
+        self.display_ids = itertools.count(1)
+
+        self.collections = dict()
+        self.trashed_assets = OrderedDict()
+        self.installations = dict()
+        self.relationships = OrderedDict()
+        self.asset_relationships = dict()
+        self.jobs = dict()
+        self.tables = dict()
+        self.asset_type_fields = dict()
+
+        self.routes = [
+            ("GET", r"api/v2/assets", self.list_assets),
+            ("POST", r"api/v2/assets", self.create_asset),
+            ("PUT", r"api/v2/assets/(\d+)", self.update_asset),
+            ("PUT", r"api/v2/assets/(\d+)/delete_forever", self.delete_asset),
+            ("GET", r"api/v2/assets/(\d+)/relationships", self.list_asset_relationships),
+            ("GET", r"api/v2/asset_types/(\d+)/fields", self.list_asset_type_fields),
+            ("GET", r"api/v2/applications/(\d+)/installations", self.list_installations),
+            ("POST", r"api/v2/applications/(\d+)/installations", self.create_installation),
+            ("GET", r"api/v2/contracts/(\d+)/associated-assets", self.list_associated_assets),
+            ("POST", r"api/v2/relationships/bulk-create", self.create_relationships_job),
+            ("DELETE", r"api/v2/relationships", self.delete_relationships),
+            ("GET", r"api/v2/jobs/([\w-]+)", self.get_job),
+            ("GET", r"api/v2/(\w+)", self.list_objects),
+            ("POST", r"api/v2/(\w+)", self.create_object),
+            ("PUT", r"api/v2/(\w+)/(\d+)", self.update_object),
+            ("DELETE", r"api/v2/(\w+)/(\d+)", self.delete_object),
+            ("GET", r"api/1.0/devices/all", self.list_devices),
+            ("POST", r"services/data/v1.0/query", self.doql),
+        ]
+        self.routes = [(method, re.compile(pattern + "$"), handler) for method, pattern, handler in self.routes]
+
+        self._add_asset_types(dataset.asset_type_fields if dataset else dict())
+        if dataset is not None:
+            self.tables = dataset.tables
+            for collection, objects in dataset.reference.items():
+                for obj in objects:
+                    self._add(collection, dict(obj))
+            for downstream, upstream in dataset.relationship_types:
+                self._add("relationship_types", {"downstream_relation": downstream, "upstream_relation": upstream})
+        if not self.collections.get("relationship_types"):
+            self._add("relationship_types", {"downstream_relation": "Depends On", "upstream_relation": "Used By"})
+
+    def _add(self, collection, obj):
+        obj["id"] = next(self.ids)
+        now = datetime.utcnow().strftime(TIME_FORMAT)
+        obj.setdefault("created_at", now)
+        obj["updated_at"] = now
+        self.collections.setdefault(collection, OrderedDict())[obj["id"]] = obj
+        return obj
+
+    def _add_asset_types(self, header_fields):
+        ids = dict()
+        for name, parent in ASSET_TYPES:
+            asset_type = self._add("asset_types", {"name": name, "parent_asset_type_id": ids.get(parent), "visible": True})
+            ids[name] = asset_type["id"]
+
+        # Every asset type has the common headers and the headers of itself and of its ancestors.
+        parents = dict(ASSET_TYPES)
+        for name, asset_type_id in ids.items():
+            sections = list()
+            for header, fields in header_fields.items():
+                owner = None if header in COMMON_HEADERS else HEADER_ASSET_TYPES.get(header, header)
+                ancestor = name
+                while owner is not None and ancestor is not None and ancestor != owner:
+                    ancestor = parents.get(ancestor)
+                if owner is not None and (owner not in ids or ancestor is None):
+                    continue
+
+                owner_id = ids[owner] if owner is not None else None
+                sections.append({"field_header": header, "fields": [
+                    {"name": field["name"] if owner_id is None else "%s_%d" % (field["name"], owner_id),
+                     "label": field["name"], "asset_type_id": owner_id, "choices": field["choices"]}
+                    for field in fields]})
+            self.asset_type_fields[asset_type_id] = sections
+
+    # HTTP
+
+    def handle(self, method, path, query, headers, body):
+        """ Return the (status, headers, body) of a call. """
+        path = re.sub(r"/+", "/", path).strip("/")
+        is_freshservice = path.startswith("api/v2/")
+        with self.lock:
+            self.stats["%s calls" % ("freshservice" if is_freshservice else "device42")] += 1
+
+        delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay > 0:
+            time.sleep(delay)
+
+        response_headers = dict()
+        if is_freshservice and self.rate_limit:
+            retry_after = self._take_token(response_headers)
+            if retry_after is not None:
+                with self.lock:
+                    self.stats["freshservice throttled"] += 1
+                response_headers["Retry-After"] = str(retry_after)
+                return 429, response_headers, {"message": "You have exceeded the limit of requests per minute"}
+
+        for route_method, pattern, handler in self.routes:
+            match = pattern.match(path)
+            if route_method == method and match:
+                with self.lock:
+                    self.stats["%s %s" % (method, pattern.pattern[:-1])] += 1
+                    try:
+                        status, result = handler(query, body, *match.groups())
+                    except EmulatorError as e:
+                        status, result = e.status, e.body
+                break
+        else:
+            status, result = 404, {"message": "No route for %s %s" % (method, path)}
+
+        if is_freshservice and method == "GET" and status == 200:
+            etag = '"%s"' % hashlib.md5(json.dumps(result, sort_keys=True).encode("utf-8")).hexdigest()
+            response_headers["ETag"] = etag
+            if headers.get("If-None-Match") == etag:
+                return 304, response_headers, None
+
+        return status, response_headers, result
+
+    def _take_token(self, response_headers):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(float(self.rate_limit), self.tokens + (now - self.tokens_at) * self.rate_limit / 60.0)
+            self.tokens_at = now
+            response_headers["X-Ratelimit-Total"] = str(self.rate_limit)
+            if self.tokens < 1:
+                response_headers["X-Ratelimit-Remaining"] = "0"
+                return int(math.ceil((1 - self.tokens) * 60.0 / self.rate_limit))
+
+            self.tokens -= 1
+            response_headers["X-Ratelimit-Remaining"] = str(int(self.tokens))
+            return None
+
+    @staticmethod
+    def _page(collection, objects, query):
+        page = int(query.get("page", 1))
+        per_page = min(int(query.get("per_page", DEFAULT_PER_PAGE)), MAX_PER_PAGE)
+        return 200, {collection: objects[(page - 1) * per_page:page * per_page]}
+
+    def _get(self, collection, object_id):
+        obj = self.collections.get(collection, dict()).get(int(object_id))
+        if obj is None:
+            raise EmulatorError(404, {"message": "%s %s not found" % (singular(collection), object_id)})
+        return obj
+
+    # Freshservice
+
+    def list_objects(self, query, body, collection):
+        return self._page(collection, list(self.collections.get(collection, dict()).values()), query)
+
+    def create_object(self, query, body, collection):
+        obj = self._add(collection, dict(body))
+        return 201, {singular(collection): obj}
+
+    def update_object(self, query, body, collection, object_id):
+        obj = self._get(collection, object_id)
+        obj.update(body)
+        obj["updated_at"] = datetime.utcnow().strftime(TIME_FORMAT)
+        return 200, {singular(collection): obj}
+
+    def delete_object(self, query, body, collection, object_id):
+        self._get(collection, object_id)
+        del self.collections[collection][int(object_id)]
+        return 204, None
+
+    def _assets_by_display_id(self):
+        return self.collections.setdefault("assets", OrderedDict())
+
+    def _asset_view(self, asset, include_type_fields):
+        if include_type_fields:
+            return asset
+        return {key: value for key, value in asset.items() if key != "type_fields"}
+
+    def list_assets(self, query, body):
+        if query.get("trashed") == "true":
+            return self._page("assets", list(self.trashed_assets.values()), query)
+
+        assets = self._assets_by_display_id().values()
+        match = re.search(r"asset_type_id:(\d+)", query.get("query", ""))
+        if match:
+            assets = [asset for asset in assets if asset["asset_type_id"] == int(match.group(1))]
+        match = re.search(r"updated_at:>'([^']+)'", query.get("filter", ""))
+        if match:
+            assets = [asset for asset in assets if asset["updated_at"][:10] > match.group(1)]
+
+        include_type_fields = query.get("include") == "type_fields"
+        return self._page("assets", [self._asset_view(asset, include_type_fields) for asset in assets], query)
+
+    def _check_serial_number(self, asset, display_id=None):
+        for key, value in asset.get("type_fields", dict()).items():
+            if key.startswith("serial_number") and value:
+                for other in self._assets_by_display_id().values():
+                    if other["display_id"] != display_id and other.get("type_fields", dict()).get(key) == value:
+                        raise validation_failed("serial_number", " must be unique")
+
+    def create_asset(self, query, body):
+        if not body.get("name") or not body.get("asset_type_id"):
+            raise validation_failed("name" if not body.get("name") else "asset_type_id", "It should not be blank")
+        self._check_serial_number(body)
+
+        asset = dict(body)
+        asset["display_id"] = next(self.display_ids)
+        asset.setdefault("type_fields", dict())
+        asset = self._add("asset_list", asset)
+        self._assets_by_display_id()[asset["display_id"]] = asset
+        return 201, {"asset": asset}
+
+    def _get_asset(self, display_id):
+        asset = self._assets_by_display_id().get(int(display_id))
+        if asset is None:
+            raise EmulatorError(404, {"message": "asset %s not found" % display_id})
+        return asset
+
+    def update_asset(self, query, body, display_id):
+        asset = self._get_asset(display_id)
+        self._check_serial_number(body, asset["display_id"])
+        for key, value in body.items():
+            if key == "type_fields":
+                asset["type_fields"].update(value)
+            else:
+                asset[key] = value
+        asset["updated_at"] = datetime.utcnow().strftime(TIME_FORMAT)
+        return 200, {"asset": asset}
+
+    def delete_asset(self, query, body, display_id):
+        self._get_asset(display_id)
+        del self._assets_by_display_id()[int(display_id)]
+        return 204, None
+
+    def list_asset_type_fields(self, query, body, asset_type_id):
+        if int(asset_type_id) not in self.asset_type_fields:
+            raise EmulatorError(404, {"message": "asset type %s not found" % asset_type_id})
+        return 200, {"asset_type_fields": self.asset_type_fields[int(asset_type_id)]}
+
+    def list_installations(self, query, body, application_id):
+        self._get("applications", application_id)
+        return self._page("installations", self.installations.get(int(application_id), []), query)
+
+    def create_installation(self, query, body, application_id):
+        self._get("applications", application_id)
+        installations = self.installations.setdefault(int(application_id), [])
+        if any(i["installation_machine_id"] == body.get("installation_machine_id") for i in installations):
+            raise validation_failed("installation_machine_id", " has already been taken")
+
+        installation = dict(body)
+        installation["id"] = next(self.ids)
+        installations.append(installation)
+        return 201, {"installation": installation}
+
+    def list_associated_assets(self, query, body, contract_id):
+        contract = self._get("contracts", contract_id)
+        assets = self._assets_by_display_id()
+        associated = [{"id": assets[display_id]["id"], "display_id": display_id, "name": assets[display_id]["name"]}
+                      for display_id in contract.get("associated_asset_ids", []) if display_id in assets]
+        return self._page("associated_assets", associated, query)
+
+    def list_asset_relationships(self, query, body, display_id):
+        self._get_asset(display_id)
+        relationships = [self.relationships[i] for i in sorted(self.asset_relationships.get(int(display_id), ()))]
+        return self._page("relationships", relationships, query)
+
+    def create_relationships_job(self, query, body):
+        relationships = body.get("relationships", [])
+        job_id = str(uuid.uuid4())
+        self.jobs[job_id] = {
+            "relationships": relationships,
+            "done_at": time.time() + len(relationships) / float(self.relationships_per_second),
+            "result": None
+        }
+        return 202, {"job_id": job_id, "href": "/api/v2/jobs/%s" % job_id}
+
+    def get_job(self, query, body, job_id):
+        job = self.jobs.get(job_id)
+        if job is None:
+            raise EmulatorError(404, {"message": "job %s not found" % job_id})
+        if time.time() < job["done_at"]:
+            return 200, {"job_id": job_id, "status": "in progress"}
+
+        if job["result"] is None:
+            results = [dict(relationship, success=self._create_relationship(relationship))
+                       for relationship in job["relationships"]]
+            success_count = sum(1 for result in results if result["success"])
+            status = "success" if success_count == len(results) else "partial" if success_count else "failed"
+            job["result"] = {"job_id": job_id, "status": status, "relationships": results}
+        return 200, job["result"]
+
+    def _create_relationship(self, relationship):
+        assets = self._assets_by_display_id()
+        if relationship.get("primary_id") not in assets or relationship.get("secondary_id") not in assets:
+            return False
+        key = (relationship["relationship_type_id"], relationship["primary_id"], relationship["secondary_id"])
+        for relationship_id in self.asset_relationships.get(relationship["primary_id"], ()):
+            existing = self.relationships[relationship_id]
+            if (existing["relationship_type_id"], existing["primary_id"], existing["secondary_id"]) == key:
+                return False
+
+        created = dict(relationship, id=next(self.ids))
+        self.relationships[created["id"]] = created
+        for display_id in [created["primary_id"], created["secondary_id"]]:
+            self.asset_relationships.setdefault(display_id, set()).add(created["id"])
+        return True
+
+    def delete_relationships(self, query, body):
+        ids = [int(i) for i in query.get("ids", "").split(",") if i]
+        missing = [i for i in ids if i not in self.relationships]
+        if not ids or missing:
+            raise validation_failed("ids", "Invalid relationship ids %s" % missing)
+
+        for relationship_id in ids:
+            relationship = self.relationships.pop(relationship_id)
+            for display_id in [relationship["primary_id"], relationship["secondary_id"]]:
+                self.asset_relationships.get(display_id, set()).discard(relationship_id)
+        return 204, None
+
+    # Device42
+
+    def list_devices(self, query, body):
+        devices = [table for name, table in sorted(self.tables.items()) if "device" in name]
+        devices = devices[0] if devices else []
+        offset, limit = int(query.get("offset", 0)), int(query.get("limit", 1000))
+        return 200, {"Devices": devices[offset:offset + limit], "total_count": len(devices), "offset": offset, "limit": limit}
+
+    def doql(self, query, body):
+        doql = body.get("query", "")
+        match = re.search(r"\bfrom\s+(bench_\w+)", doql, re.IGNORECASE)
+        if match is None or match.group(1) not in self.tables:
+            raise EmulatorError(400, {"message": "Unknown DOQL table in: %s" % doql[:200]})
+
+        rows = self.tables[match.group(1)]
+        # The wrappers that the client puts around the query of the task.
+        match = re.search(r"WHERE (\w+) >= '((?:[^']|'')*)'", doql)
+        if match:
+            column, value = match.group(1), match.group(2).replace("''", "'")
+            rows = [row for row in rows if row.get(column) is not None and str(row[column]) >= value]
+        match = re.search(r"doql_chunk WHERE (\w+) >= (-?\d+)(?: AND \w+ < (-?\d+))?", doql)
+        if match:
+            column, start = match.group(1), int(match.group(2))
+            end = int(match.group(3)) if match.group(3) is not None else None
+            rows = [row for row in rows if row.get(column) is not None and start <= row[column] and (end is None or row[column] < end)]
+        match = re.search(r"SELECT (\w+) AS chunk_start .* chunk_row % (\d+) = 1", doql)
+        if match:
+            column, size = match.group(1), int(match.group(2))
+            keys = sorted(row[column] for row in rows if row.get(column) is not None)
+            rows = [{"chunk_start": key} for key in keys[::size]]
+
+        self.stats["device42 rows"] += len(rows)
+        return 200, rows
+
+
+class EmulatorServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+    allow_reuse_address = True
+
+    def __init__(self, address, emulator):
+        HTTPServer.__init__(self, address, EmulatorRequestHandler)
+        self.emulator = emulator
+
+    @property
+    def url(self):
+        return "http://%s:%d" % self.server_address[:2]
+
+    def start(self):
+        """ Serve from a daemon thread and return the thread. """
+        thread = threading.Thread(target=self.serve_forever, name="emulator")
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+class EmulatorRequestHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so the pooled connections of the clients are reused like with the real servers.
+    protocol_version = "HTTP/1.1"
+    # The headers and the body are separate writes, which Nagle's algorithm would hold back for a delayed ACK.
+    disable_nagle_algorithm = True
+
+    def _handle(self):
+        url = urlsplit(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query, keep_blank_values=True).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        raw_body = self.rfile.read(length).decode("utf-8") if length else ""
+        if "json" in (self.headers.get("Content-Type") or ""):
+            body = json.loads(raw_body) if raw_body else dict()
+        else:
+            body = {key: values[-1] for key, values in parse_qs(raw_body, keep_blank_values=True).items()}
+
+        status, headers, result = self.server.emulator.handle(self.command, url.path, query, self.headers, body)
+        content = json.dumps(result).encode("utf-8") if result is not None else b""
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        if content:
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local Freshservice and Device42 emulator")
+    parser.add_argument("-c", "--config", default="mapping.xml.sample", help="Mapping file the dataset is made for")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8042)
+    parser.add_argument("--devices", type=int, default=1000, help="Number of Device42 devices")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every call")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Up to this many more seconds added to every call")
+    parser.add_argument("--rate-limit", type=int, help="Freshservice calls per minute")
+    parser.add_argument("--relationships-per-second", type=float, default=50.0)
+    parser.add_argument("--write-mapping", help="Write the mapping to use against the emulator to this file")
+    args = parser.parse_args()
+
+    dataset = Dataset(args.config, args.devices, args.seed)
+    emulator = Emulator(dataset, args.latency, args.jitter, args.rate_limit, args.relationships_per_second, args.seed)
+    server = EmulatorServer((args.host, args.port), emulator)
+    if args.write_mapping:
+        dataset.write_mapping(args.write_mapping, server.url, server.url)
+        print("Wrote %s" % args.write_mapping)
+
+    print("Emulating Freshservice and Device42 at %s" % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
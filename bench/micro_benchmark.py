@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+
+
+import os
+import sys
+import json
+import time
+import logging
+import platform
+import argparse
+import itertools
+from collections import OrderedDict
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import d42_sd_sync
+from freshservice import FreshService
+from dataset import Dataset
+from emulator import Emulator
+
+parser = argparse.ArgumentParser(description="Micro-benchmarks of the mapping and client hot paths")
+parser.add_argument('-c', '--config', help='Mapping file', default=os.path.join(os.path.dirname(BENCH_DIR), 'mapping.xml.sample'))
+parser.add_argument('--devices', type=int, default=2000, help='Number of Device42 rows the mapping benchmarks run on')
+parser.add_argument('--objects', type=int, default=100000, help='Number of Freshservice objects the map benchmarks run on')
+parser.add_argument('--seed', type=int, default=42, help='Seed of the synthetic data')
+parser.add_argument('--repeat', type=int, default=5, help='Number of timed runs of every benchmark')
+parser.add_argument('-k', '--filter', help='Only run the benchmarks whose name contains this text')
+parser.add_argument('--json', help='Write the results to this file as JSON')
+parser.add_argument('--compare', help='JSON results of an earlier run to compare with')
+
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(name):
+    """ Register a benchmark.  The decorated function gets the Context and returns (run, number of operations of a run). """
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+
+    return register
+
+
+class PayloadRecorder(object):
+    """ Takes the place of the Freshservice client in update_objects_from_server and keeps the payloads instead of sending them. """
+
+    def __init__(self):
+        self.ids = itertools.count(1)
+        self.payloads = list()
+
+    def insert_asset(self, data):
+        self.payloads.append(data)
+        object_id = next(self.ids)
+        return dict(data, id=object_id, display_id=object_id)
+
+    def update_asset(self, data, display_id):
+        self.payloads.append(data)
+        return display_id
+
+
+class Context(object):
+    """ The synthetic inputs of the benchmarks, built once from the mapping. """
+
+    def __init__(self, args):
+        self.args = args
+        self.client = FreshService("localhost", "bench", d42_sd_sync.logger)
+        self.dataset = Dataset(args.config, args.devices, args.seed)
+        self.emulator = Emulator(self.dataset, seed=args.seed)
+        self.config = d42_sd_sync.parse_config(args.config)
+
+        tasks = self.config["meta"]["tasks"]["task"]
+        self.devices_index, self.devices_task = next((index, task) for index, task in enumerate(tasks)
+                                                     if task["@enable"] and task.get("@name") == "Devices")
+        self.devices = self.dataset.tables[self.dataset.task_tables[self.devices_index]]
+        self.device_fields = self.devices_task["mapping"]["field"]
+
+        # Freshservice objects named like the Device42 rows, padded with more objects up to the map size.
+        names = list(self.dataset.device_names)
+        names += ["bench-fs-object-%07d" % i for i in range(max(0, args.objects - len(names)))]
+        self.fs_objects = [{"id": i, "display_id": i, "name": name, "asset_type_id": 1 + i % 15,
+                            "agent_id": None, "description": "%s description" % name}
+                           for i, name in enumerate(names[:args.objects], 1)]
+        # Lookups as they come from Device42: hits in other cases and with padding or markup, and misses.
+        self.lookup_names = list()
+        for i, name in enumerate(self.dataset.device_names):
+            self.lookup_names += [name.upper(), " %s\xa0" % name, "<%s>" % name if i % 2 else name, "missing-%s" % name]
+
+    def seed_fs_cache(self):
+        # The reference data that the sync would have fetched from Freshservice by the time the devices are mapped.
+        fs_cache = d42_sd_sync.fs_cache
+        fs_cache.clear()
+        collections = self.emulator.collections
+        fs_cache["asset_types"] = self.client.create_objects_map(collections["asset_types"].values())
+        fs_cache["asset_type_fields"] = dict(self.emulator.asset_type_fields)
+        fs_cache["asset_type_choices"] = {asset_type_id: d42_sd_sync.get_choice_indexes(fields)
+                                          for asset_type_id, fields in self.emulator.asset_type_fields.items()}
+        fs_cache["vendors"] = self.client.create_objects_map(collections["vendors"].values())
+        fs_cache["groups"] = self.client.create_objects_map(collections["groups"].values())
+        fs_cache["agents"] = self.client.create_objects_map(collections["agents"].values(), "email")
+        fs_cache["contract_types"] = self.client.create_objects_map(collections["contract_types"].values())
+        fs_cache["products"] = self.client.create_objects_map(
+            {"id": i, "name": name} for i, name in enumerate(self.dataset.product_names, 1))
+        fs_cache["applications"] = self.client.create_objects_map(
+            {"id": i, "name": name} for i, name in enumerate(self.dataset.software_names, 1))
+
+
+@benchmark("parse_config")
+def bench_parse_config(context):
+    def run():
+        d42_sd_sync.parse_config(context.args.config)
+
+    return run, 1
+
+
+@benchmark("get_map_value_from_device42")
+def bench_get_map_value(context):
+    context.seed_fs_cache()
+    devices, fields = context.devices, context.device_fields
+
+    def run():
+        for source in devices:
+            for map_info in fields:
+                d42_sd_sync.get_map_value_from_device42(source, map_info)
+
+    return run, len(devices) * len(fields)
+
+
+def run_update_objects(context, existing_objects_map):
+    recorder = PayloadRecorder()
+    d42_sd_sync.freshservice = recorder
+    d42_sd_sync.fs_cache["assets"] = existing_objects_map
+    # One worker, so that only the payload building is measured.
+    _target = {key: value for key, value in context.devices_task["api"]["target"].items() if key != "@workers"}
+    d42_sd_sync.update_objects_from_server(context.devices, _target, context.devices_task["mapping"])
+    return recorder
+
+
+@benchmark("update_objects_from_server (insert)")
+def bench_update_objects_insert(context):
+    context.seed_fs_cache()
+
+    def run():
+        run_update_objects(context, dict())
+
+    return run, len(context.devices)
+
+
+@benchmark("update_objects_from_server (unchanged)")
+def bench_update_objects_unchanged(context):
+    context.seed_fs_cache()
+    # The assets as the first sync created them, so that the change detection finds nothing to send.
+    payloads = run_update_objects(context, dict()).payloads
+    assets = [dict(payload, id=i, display_id=i) for i, payload in enumerate(payloads, 1)]
+    existing_objects_map = context.client.create_objects_map(assets, keep_fields=True)
+
+    def run():
+        run_update_objects(context, existing_objects_map)
+
+    return run, len(context.devices)
+
+
+@benchmark("escape_value")
+def bench_escape_value(context):
+    names = context.lookup_names
+
+    def run():
+        for name in names:
+            d42_sd_sync.escape_value(name)
+
+    return run, len(names)
+
+
+@benchmark("find_object_in_map")
+def bench_find_object_in_map(context):
+    objects_map = context.client.create_objects_map(context.fs_objects)
+    names = context.lookup_names
+
+    def run():
+        for name in names:
+            d42_sd_sync.find_object_in_map(objects_map, name)
+
+    return run, len(names)
+
+
+@benchmark("FreshService.get_objects_map")
+def bench_get_objects_map(context):
+    # The objects come from memory, so only the map building is measured.
+    client = FreshService("localhost", "bench", d42_sd_sync.logger)
+    client.request = lambda source_url, method, model, page_window=None: context.fs_objects
+
+    def run():
+        client.get_objects_map("api/v2/assets", "assets")
+
+    return run, len(context.fs_objects)
+
+
+@benchmark("FreshService.create_basic_object")
+def bench_create_basic_object(context):
+    client, objects = context.client, context.fs_objects
+
+    def run():
+        for obj in objects:
+            client.create_basic_object(obj)
+
+    return run, len(objects)
+
+
+@benchmark("ChoiceIndex.match")
+def bench_choice_index(context):
+    choices = [["%s %s" % (vendor, model), i] for i, (vendor, model) in
+               enumerate(itertools.product(["Dell", "HP", "Lenovo", "Cisco", "Juniper"], ["PowerEdge", "ProLiant", "ThinkSystem", "Nexus"]))]
+    values = [choice[0].upper() for choice in choices] + ["%s R740" % choice[0] for choice in choices] + \
+             [choice[0].split()[0] for choice in choices] + ["Unknown %d" % i for i in range(20)]
+    values = values * max(1, len(context.devices) // len(values))
+
+    def run():
+        # A new index every run, so the first match of each value is part of the measure.
+        choice_index = d42_sd_sync.ChoiceIndex(choices)
+        for value in values:
+            choice_index.match(value)
+
+    return run, len(values)
+
+
+def time_benchmark(run, repeat):
+    run()
+    timings = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+
+    return sorted(timings)
+
+
+def load_results(path):
+    with open(path) as f:
+        return {result["name"]: result for result in json.load(f)["benchmarks"]}
+
+
+def main():
+    args = parser.parse_args()
+    # The sync logs every asset; the benchmarks measure the work, not the logging.
+    d42_sd_sync.logger.setLevel(logging.CRITICAL)
+
+    baseline = load_results(args.compare) if args.compare else dict()
+    context = Context(args)
+    results = list()
+    print("%-40s %10s %12s %12s %12s %9s" % ("Benchmark", "Ops", "Best (s)", "Median (s)", "Per op (us)", "Change"))
+    for name, setup in BENCHMARKS.items():
+        if args.filter and args.filter not in name:
+            continue
+
+        run, number = setup(context)
+        timings = time_benchmark(run, args.repeat)
+        result = OrderedDict([
+            ("name", name),
+            ("operations", number),
+            ("repeat", args.repeat),
+            ("best", timings[0]),
+            ("median", timings[len(timings) // 2]),
+            ("mean", sum(timings) / len(timings)),
+            ("per_operation_us", timings[0] / number * 1e6),
+        ])
+        results.append(result)
+
+        change = ""
+        if name in baseline:
+            change = "%+.1f%%" % ((result["per_operation_us"] / baseline[name]["per_operation_us"] - 1) * 100)
+        print("%-40s %10d %12.4f %12.4f %12.3f %9s" % (name, number, result["best"], result["median"],
+                                                       result["per_operation_us"], change))
+
+    if args.json:
+        settings = OrderedDict((key, getattr(args, key)) for key in ["devices", "objects", "seed", "repeat"])
+        environment = OrderedDict([("python", platform.python_version()), ("implementation", platform.python_implementation()),
+                                   ("platform", platform.platform())])
+        with open(args.json, "w") as f:
+            json.dump(OrderedDict([("settings", settings), ("environment", environment), ("benchmarks", results)]), f, indent=2)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+from collections import OrderedDict
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import d42_sd_sync
+from dataset import Dataset
+from emulator import Emulator, EmulatorServer
+
+parser = argparse.ArgumentParser(description="End-to-end sync throughput against the local emulator")
+parser.add_argument('-c', '--config', help='Mapping file', default=os.path.join(os.path.dirname(BENCH_DIR), 'mapping.xml.sample'))
+parser.add_argument('--devices', type=int, default=1000, help='Number of Device42 devices of the dataset')
+parser.add_argument('--seed', type=int, default=42, help='Seed of the dataset')
+parser.add_argument('--latency', type=float, default=0.02, help='Seconds added to every emulated call')
+parser.add_argument('--jitter', type=float, default=0.0, help='Up to this many more seconds added to every emulated call')
+parser.add_argument('--rate-limit', type=int, help='Freshservice calls per minute before 429 responses')
+parser.add_argument('--relationships-per-second', type=float, default=50.0, help='Rate at which relationship jobs complete')
+parser.add_argument('--workers', type=int, help='Workers of every task (the mapping value when not set)')
+parser.add_argument('--async', dest='async_writes', action='store_true', help='Send the asset writes with the asyncio client')
+parser.add_argument('--runs', type=int, default=1, help='Number of syncs against the same emulator')
+parser.add_argument('--state-file', action='store_true', help='Keep a sync state file between the runs')
+parser.add_argument('--json', help='Write the results to this file as JSON')
+
+
+class TaskTimer(object):
+    """ Wraps d42_sd_sync.task_execute to measure every task against the emulator counters. """
+
+    def __init__(self, emulator, task_execute):
+        self.emulator = emulator
+        self.task_execute = task_execute
+        self.results = list()
+
+    def __call__(self, task, device42):
+        before = dict(self.emulator.stats)
+        start = time.time()
+        try:
+            return self.task_execute(task, device42)
+        finally:
+            elapsed = time.time() - start
+            stats = self.emulator.stats
+            self.results.append(OrderedDict([
+                ("task", task.get("@name") or task.get("@description")),
+                ("seconds", round(elapsed, 3)),
+                ("freshservice_calls", stats["freshservice calls"] - before.get("freshservice calls", 0)),
+                ("freshservice_throttled", stats["freshservice throttled"] - before.get("freshservice throttled", 0)),
+                ("device42_calls", stats["device42 calls"] - before.get("device42 calls", 0)),
+                ("rows", stats["device42 rows"] - before.get("device42 rows", 0)),
+            ]))
+
+
+def run_sync(mapping_path, log_folder, state_path=None):
+    argv = sys.argv
+    sys.argv = [d42_sd_sync.__file__, "-c", mapping_path, "-l", log_folder, "-q"]
+    if state_path is not None:
+        sys.argv += ["-s", state_path]
+
+    # Every run starts like a new process.
+    d42_sd_sync.fs_cache.clear()
+    d42_sd_sync.sync_state = None
+    try:
+        return d42_sd_sync.main()
+    finally:
+        sys.argv = argv
+        logging.getLogger().handlers = []
+
+
+def print_results(run, results):
+    print("\nRun %d" % run)
+    print("%-55s %9s %8s %8s %8s %8s %9s %9s" % ("Task", "Seconds", "FS", "429", "D42", "Rows", "Rows/s", "Calls/s"))
+    for result in results:
+        seconds = result["seconds"] or 1e-9
+        print("%-55s %9.2f %8d %8d %8d %8d %9.1f %9.1f" % (
+            result["task"][:55], result["seconds"], result["freshservice_calls"], result["freshservice_throttled"],
+            result["device42_calls"], result["rows"], result["rows"] / seconds,
+            (result["freshservice_calls"] + result["device42_calls"]) / seconds))
+
+
+def main():
+    args = parser.parse_args()
+
+    dataset = Dataset(args.config, args.devices, args.seed)
+    emulator = Emulator(dataset, args.latency, args.jitter, args.rate_limit, args.relationships_per_second, args.seed)
+    server = EmulatorServer(("127.0.0.1", 0), emulator)
+    server.start()
+
+    folder = tempfile.mkdtemp(prefix="d42_fs_bench_")
+    try:
+        mapping_path = os.path.join(folder, "mapping.xml")
+        dataset.write_mapping(mapping_path, server.url, server.url, args.workers, args.async_writes)
+        state_path = os.path.join(folder, "state.sqlite") if args.state_file else None
+
+        timer = TaskTimer(emulator, d42_sd_sync.task_execute)
+        d42_sd_sync.task_execute = timer
+        runs = list()
+        for run in range(1, args.runs + 1):
+            timer.results = list()
+            start = time.time()
+            status = run_sync(mapping_path, folder, state_path)
+            elapsed = time.time() - start
+            if status != 0:
+                print("The sync failed with status %s" % status)
+                return status
+
+            print_results(run, timer.results)
+            print("Total: %.2f seconds" % elapsed)
+            runs.append(OrderedDict([("run", run), ("seconds", round(elapsed, 3)), ("tasks", timer.results)]))
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(folder, ignore_errors=True)
+
+    if args.json:
+        settings = OrderedDict((key, getattr(args, key)) for key in
+                               ["devices", "seed", "latency", "jitter", "rate_limit", "relationships_per_second", "workers",
+                                "async_writes"])
+        with open(args.json, "w") as f:
+            json.dump(OrderedDict([("settings", settings), ("runs", runs)]), f, indent=2)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+
+
+import time
+import asyncio
+import itertools
+import logging
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class AIMDController(object):
+    """ Adaptive limit on the number of calls in flight.
+
+    The window grows additively (about one slot per window of healthy calls) while the latency stays
+    close to its moving average and no call is throttled, and it is cut multiplicatively on a 429,
+    a server error or a latency spike.  A burst of concurrent failures only cuts the window once.
+    """
+
+    def __init__(self, initial=2, minimum=1, maximum=16, decrease_factor=0.5, latency_factor=2.0, logger=None):
+        self.condition = threading.Condition()
+        self.minimum = minimum
+        self.maximum = maximum
+        self.window = float(min(max(initial, minimum), maximum))
+        self.decrease_factor = decrease_factor
+        self.latency_factor = latency_factor
+        self.logger = logger
+        self.in_flight = 0
+        self.average_latency = None
+        self.last_decrease = 0.0
+
+    @property
+    def current_window(self):
+        return max(self.minimum, int(self.window))
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= self.current_window:
+                self.condition.wait()
+            self.in_flight += 1
+
+    def try_acquire(self):
+        """ Take a slot if one is free, without waiting.  Returns whether a slot was taken. """
+        with self.condition:
+            if self.in_flight >= self.current_window:
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self, latency, throttled=False, failed=False):
+        with self.condition:
+            self.in_flight -= 1
+            previous_window = self.current_window
+
+            spike = self.average_latency is not None and latency > self.average_latency * self.latency_factor
+            if throttled or failed or spike:
+                now = time.monotonic()
+                if now - self.last_decrease > (self.average_latency or latency):
+                    self.window = max(float(self.minimum), self.window * self.decrease_factor)
+                    self.last_decrease = now
+            else:
+                self.window = min(float(self.maximum), self.window + 1.0 / self.window)
+
+            if not throttled and not failed:
+                if self.average_latency is None:
+                    self.average_latency = latency
+                else:
+                    self.average_latency = 0.9 * self.average_latency + 0.1 * latency
+
+            if self.current_window != previous_window:
+                self._log("Concurrency window changed from %d to %d" % (previous_window, self.current_window))
+
+            self.condition.notify_all()
+
+    def _log(self, message, level=logging.DEBUG):
+        if self.logger:
+            self.logger.log(level, message)
+
+
+class KeyedLocks(object):
+    """ One lock per key, so that work on the same key is serialised while other keys run in parallel. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.locks = dict()
+
+    @contextmanager
+    def hold(self, key):
+        with self.lock:
+            entry = self.locks.get(key)
+            if entry is None:
+                entry = self.locks[key] = [threading.Lock(), 0]
+            entry[1] += 1
+
+        entry[0].acquire()
+        try:
+            yield
+        finally:
+            entry[0].release()
+            with self.lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.locks[key]
+
+
+class AsyncKeyedLocks(object):
+    """ Coroutine counterpart of KeyedLocks, for tasks that run on one event loop. """
+
+    def __init__(self):
+        self.locks = dict()
+
+    async def acquire(self, key):
+        entry = self.locks.get(key)
+        if entry is None:
+            entry = self.locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        await entry[0].acquire()
+
+    def release(self, key):
+        entry = self.locks[key]
+        entry[0].release()
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self.locks[key]
+
+
+def run_concurrently(func, items, workers):
+    """ Call func for every item with up to workers calls running at the same time.
+
+    Items are pulled from the iterable only as workers free up, so a generator is never materialised.
+    func is expected to handle its own errors; an exception raised by it is re-raised here.
+    """
+    if workers <= 1:
+        for item in items:
+            func(item)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for item in items:
+            if len(pending) >= workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+            pending.add(executor.submit(func, item))
+
+        for future in pending:
+            future.result()
+
+
+def map_concurrently(func, items, workers):
+    """ Return a dictionary with func(item) for every distinct item, with up to workers calls running at the same time. """
+    results = dict()
+    lock = threading.Lock()
+
+    def call(item):
+        result = func(item)
+        with lock:
+            results[item] = result
+
+    run_concurrently(call, set(items), workers)
+    return results
+
+
+async def map_concurrently_async(func, items, limit):
+    """ Coroutine counterpart of map_concurrently: func is a coroutine function and up to limit calls run at the same time. """
+    results = dict()
+    semaphore = asyncio.Semaphore(max(1, limit))
+
+    async def call(item):
+        async with semaphore:
+            results[item] = await func(item)
+
+    await asyncio.gather(*[call(item) for item in set(items)])
+    return results
+
+
+async def run_concurrently_async(func, items, limit, batch_size=100):
+    """ Coroutine counterpart of run_concurrently: func is a coroutine function and up to limit calls run at the same time.
+
+    Items are pulled from the iterable in batches on the default executor, so a generator that reads a
+    stream does not block the event loop.
+    """
+    loop = asyncio.get_event_loop()
+    iterator = iter(items)
+    pending = set()
+    while True:
+        batch = await loop.run_in_executor(None, lambda: list(itertools.islice(iterator, batch_size)))
+        if not batch:
+            break
+
+        for item in batch:
+            if len(pending) >= max(1, limit):
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+            pending.add(asyncio.ensure_future(func(item)))
+
+    if pending:
+        done, _ = await asyncio.wait(pending)
+        for future in done:
+            future.result()
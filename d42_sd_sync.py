@@ -2,16 +2,22 @@ __author__ = 'Roman Nyschuk'
 
 import os
 import sys
+import asyncio
 import logging
 import json
 import argparse
 import datetime
 from device42 import Device42
-from freshservice import FreshService, FreshServiceDuplicateValueError
+from freshservice import FreshService, AsyncFreshService, BasicObject, FreshServiceDuplicateValueError
+from concurrency import AsyncKeyedLocks, KeyedLocks, map_concurrently, run_concurrently, run_concurrently_async
+from transport import run_steps, run_steps_async
+from relationships import RelationshipIndex, RelationshipJobTracker
+from sync_state import SyncStateStore, payload_hash
 import xml.etree.ElementTree as eTree
 from xmljson import badgerfish as bf
 import time
-import math
+import threading
+from collections import OrderedDict
 
 logger = logging.getLogger('log')
 logger.setLevel(logging.INFO)
@@ -20,18 +26,22 @@ ch.setFormatter(logging.Formatter('%(asctime)-15s\t%(levelname)s\t %(message)s')
 logger.addHandler(ch)
 CUR_DIR = os.path.dirname(os.path.abspath(__file__))
 
+# Initial size of the relationship create batches; it is then tuned with the measured creation rate.
 RELATIONSHIP_BATCH_SIZE = 20
 # With v1 of the API, we were able to create about 4 relationships per second.
 # So we will assume that we will be able to create them at the same rate with
-# the asynchronous background jobs.
+# the asynchronous background jobs, until the first jobs complete.
 RELATIONSHIPS_CREATED_PER_SECOND = 4
-# The number of seconds to wait before we check the status of create relationships jobs.
-RELATIONSHIPS_JOB_WAIT_SECONDS = int(math.ceil(RELATIONSHIP_BATCH_SIZE / float(RELATIONSHIPS_CREATED_PER_SECOND)))
+# The number of relationship create jobs that can be running at the same time.
+RELATIONSHIP_JOBS_IN_FLIGHT = 4
 ASSET_TYPE_BUSINESS_SERVICE = "Business Service"
 ASSET_TYPE_SERVER = "Server"
 ASSET_TYPE_UNIX_SERVER = "Unix Server"
 ASSET_TYPE_WINDOWS_SERVER = "Windows Server"
 ASSET_TYPE_HOST = "Host"
+ASSETS_PATH = "api/v2/assets"
+# The snapshots of the assets in the state file, without and with their type_fields.
+ASSET_SNAPSHOTS = ("assets", "assets_type_fields")
 
 parser = argparse.ArgumentParser(description="freshservice")
 
@@ -39,10 +49,23 @@ parser.add_argument('-d', '--debug', action='store_true', help='Enable debug out
 parser.add_argument('-q', '--quiet', action='store_true', help='Quiet mode - outputs only errors')
 parser.add_argument('-c', '--config', help='Config file', default='mapping.xml')
 parser.add_argument('-l', '--logfolder', help='log folder path', default='.')
+parser.add_argument('-s', '--state-file', help='SQLite file that keeps the sync state between runs')
+parser.add_argument('--rebuild-state', action='store_true', help='Rebuild the sync state from a full fetch')
+parser.add_argument('--full-sync', action='store_true', help='Ignore the incremental watermarks and process all rows')
+parser.add_argument('--refresh-cache', action='store_true', help='Fetch the cached Freshservice reference data again')
 
 freshservice = None
+freshservice_settings = None
+# The fields that the change detection compares for the asset tasks, see get_compared_fields.
+asset_compared_fields = None
 default_approver = None
 fs_cache = dict()
+# Guards the lazily loaded collections in fs_cache and the Freshservice objects created for them
+# when tasks process sources concurrently.
+fs_cache_lock = threading.RLock()
+sync_state = None
+rebuild_state = False
+full_sync = False
 
 
 class JSONEncoder(json.JSONEncoder):
@@ -62,14 +85,6 @@ def escape_value(name):
     return name
 
 
-def find_object_by_name(assets, name):
-    for asset in assets:
-        if asset["name"].lower() == escape_value(name).lower():
-            return asset
-
-    return None
-
-
 def find_object_in_map(objects_map, name):
     if name:
         return objects_map.get(escape_value(name).lower())
@@ -85,6 +100,272 @@ def find_object_id_in_map(objects_map, name):
     return None
 
 
+def is_same_value(new_value, current_value):
+    # Values that we send and values that Freshservice returns for the same field are not always
+    # of the same type (e.g. 1 and "1") and Freshservice trims strings and stores a blank value
+    # instead of the single space we send for empty not-null fields.
+    if new_value == current_value:
+        return True
+    if isinstance(new_value, dict) and isinstance(current_value, dict):
+        return all(k in current_value and is_same_value(v, current_value[k]) for k, v in new_value.items())
+    if isinstance(new_value, list) and isinstance(current_value, list):
+        return len(new_value) == len(current_value) and \
+            all(is_same_value(n, c) for n, c in zip(new_value, current_value))
+    if isinstance(new_value, bool) or isinstance(current_value, bool):
+        return False
+    if isinstance(new_value, (int, float)) or isinstance(current_value, (int, float)):
+        try:
+            return float(new_value) == float(current_value)
+        except (TypeError, ValueError):
+            return False
+    if new_value is None or isinstance(new_value, str):
+        new_value = (new_value or "").strip()
+        if current_value is None or isinstance(current_value, str):
+            current_value = (current_value or "").strip()
+            # Dates are returned with a time part (e.g. 2020-01-31T00:00:00Z).
+            return new_value == current_value or (new_value != "" and current_value.startswith(new_value + "T"))
+    return False
+
+
+def get_changed_fields(data, existing_object):
+    """ Return the fields of data that differ from the existing Freshservice object.
+
+    Returns data unchanged when we do not have the current fields of the object.
+    """
+    if "fields" not in existing_object:
+        return data
+
+    current = existing_object["fields"]
+    changed = dict()
+    for key, value in data.items():
+        if key == "type_fields":
+            current_type_fields = current.get("type_fields") or dict()
+            changed_type_fields = {k: v for k, v in value.items()
+                                   if k not in current_type_fields or not is_same_value(v, current_type_fields[k])}
+            if changed_type_fields:
+                changed["type_fields"] = changed_type_fields
+        elif key not in current or not is_same_value(value, current[key]):
+            changed[key] = value
+
+    return changed
+
+
+def remember_sent_fields(existing_object, data):
+    # Keep the cached copy in line with what we sent, so that a later source with the same name
+    # is compared against the updated object.
+    if "fields" in existing_object:
+        fields = dict(existing_object["fields"])
+        for key, value in data.items():
+            if key == "type_fields":
+                type_fields = dict(fields.get("type_fields") or dict())
+                type_fields.update(value)
+                fields["type_fields"] = type_fields
+            else:
+                fields[key] = value
+        existing_object["fields"] = fields
+
+
+def get_state_key(name):
+    return escape_value(name).lower() if name else name
+
+
+def is_unchanged_since_last_sync(kind, name, existing_object, data_hash):
+    # The same payload was already pushed to this object in an earlier run.
+    return sync_state is not None and existing_object is not None and \
+        sync_state.is_unchanged(kind, get_state_key(name), data_hash, existing_object["id"])
+
+
+def record_sync_state(kind, name, obj, data_hash):
+    if sync_state is not None:
+        sync_state.record(kind, get_state_key(name), obj["id"], obj.get("display_id"), data_hash)
+
+
+def is_known_in_sync_state(kind, key):
+    return sync_state is not None and sync_state.contains(kind, key)
+
+
+def get_relationship_state_key(relationship):
+    return "%s-%s-%s" % (relationship["relationship_type_id"], relationship["primary_id"], relationship["secondary_id"])
+
+
+def rebuild_sync_state(kind, objects_map):
+    # With --rebuild-state, the state of a kind is replaced with the objects that were just listed.
+    if sync_state is not None and rebuild_state:
+        sync_state.rebuild(kind, ((k, o["id"], o.get("display_id")) for k, o in objects_map.items()))
+
+
+class StateObjectsMap(object):
+    """ Map of the Freshservice objects of a kind, keyed like the maps of FreshService.get_objects_map.
+
+    The objects that the state file knows are resolved from it (with their id and display id only),
+    and the objects are only listed from Freshservice, once, when a key is not in the state file.
+    """
+
+    def __init__(self, kind, list_objects):
+        self.kind = kind
+        self.list_objects = list_objects
+        self.objects = None
+        self.known = dict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if self.objects is None:
+                if key in self.known:
+                    return self.known[key]
+
+                entity = sync_state.get(self.kind, key)
+                if entity is not None:
+                    obj = self.known[key] = BasicObject(id=entity["fs_id"], display_id=entity["display_id"], name=key)
+                    return obj
+
+                self.objects = self.list_objects()
+                self.objects.update((k, v) for k, v in self.known.items() if k not in self.objects)
+
+            return self.objects.get(key, default)
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            if self.objects is None:
+                self.known[key] = value
+            else:
+                self.objects[key] = value
+
+
+def get_compared_fields(mappings):
+    """ Return the names of the Freshservice fields that the change detection compares for the given mappings.
+
+    Only these fields of the existing objects are kept in memory.
+    """
+    names = {"asset_type_id", "type_fields", "approver_id"}
+    for mapping in mappings:
+        fields = mapping["field"] if isinstance(mapping["field"], list) else [mapping["field"]]
+        for map_info in fields:
+            names.add(map_info["@target"])
+            if "@target-field" in map_info:
+                names.add(map_info["@target-field"])
+
+    return frozenset(names)
+
+
+def get_objects_map_from_state(kind, description, _target, keep_fields=False):
+    """ Return the map of the existing Freshservice objects of a target.
+
+    Without a state file or with --rebuild-state, all the objects are listed now.  Otherwise the
+    objects pushed in earlier runs are resolved from the state file and they are only listed on the
+    first name that it does not know.
+    """
+    def list_objects():
+        logger.info("Getting all existing %s in FS." % description)
+        objects_map = freshservice.get_objects_map(_target["@path"], _target["@model"], keep_fields=keep_fields)
+        logger.info("finished getting all existing %s in FS." % description)
+        return objects_map
+
+    if sync_state is None or rebuild_state:
+        objects_map = list_objects()
+        rebuild_sync_state(kind, objects_map)
+        return objects_map
+
+    return StateObjectsMap(kind, list_objects)
+
+
+def get_existing_assets(include_type_fields=False):
+    # With a state file, the assets come from a local snapshot that is refreshed with the assets
+    # updated (or trashed) since the last run instead of listing all of them again.  The assets with
+    # their type_fields are only needed for the change detection and are kept in their own snapshot.
+    if sync_state is not None:
+        if include_type_fields:
+            return freshservice.get_objects_with_snapshot(ASSETS_PATH + "?include=type_fields", "assets", sync_state, full_sync,
+                                                          snapshot_name=ASSET_SNAPSHOTS[1], trashed=True)
+        return freshservice.get_objects_with_snapshot(ASSETS_PATH, "assets", sync_state, full_sync,
+                                                      snapshot_name=ASSET_SNAPSHOTS[0], trashed=True)
+
+    if include_type_fields:
+        return freshservice.request(ASSETS_PATH + "?include=type_fields", "GET", "assets")
+    return freshservice.request(ASSETS_PATH, "GET", "assets")
+
+
+def get_existing_assets_map(keep_fields=False):
+    if "assets" in fs_cache:
+        logger.info("Getting all existing assets in FS from cache.")
+        existing_objects_map = fs_cache["assets"]
+        logger.info("finished getting all existing assets in FS from cache.")
+    else:
+        logger.info("Getting all existing assets in FS.")
+        existing_objects_map = freshservice.create_objects_map(get_existing_assets(keep_fields), keep_fields=keep_fields)
+        logger.info("finished getting all existing assets in FS.")
+        fs_cache["assets"] = existing_objects_map
+        rebuild_sync_state("device", existing_objects_map)
+
+    return existing_objects_map
+
+
+def get_workers(_target):
+    # With workers="N" on the target, up to N objects are processed at the same time.
+    return int(_target["@workers"]) if "@workers" in _target else 1
+
+
+def is_async_enabled(_target):
+    # With async="true" on the target, the task sends its calls with the asyncio client, up to workers
+    # of them in flight on one thread.
+    return "@async" in _target and _target["@async"]
+
+
+def create_async_freshservice(in_flight):
+    """ Return an AsyncFreshService that shares the rate limiter, the write window and the reference
+    cache of the blocking client.
+    """
+    kwargs = get_client_kwargs(freshservice_settings)
+    kwargs["pool_size"] = max(kwargs.get("pool_size", AsyncFreshService.DEFAULT_POOL_SIZE), in_flight)
+    return AsyncFreshService(freshservice.base, freshservice.api_key, logger, rate_limiter=freshservice.rate_limiter,
+                             write_controller=freshservice.write_controller,
+                             reference_cache=freshservice.reference_cache, **kwargs)
+
+
+def run_on_event_loop(client, coroutine):
+    # Run a coroutine on a new event loop and close the client (its aiohttp session) on the same loop.
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(coroutine)
+    finally:
+        loop.run_until_complete(client.close())
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+def find_orphaned_objects(sources, existing_objects, key):
+    # The keys of the sources are indexed once, so every existing object is checked in constant time.
+    source_keys = set(source[key] for source in sources)
+    return [existing_object for existing_object in existing_objects if existing_object[key] not in source_keys]
+
+
+def delete_orphaned_objects(kind, sources, existing_objects, _target, mapping, delete_object):
+    orphaned_objects = find_orphaned_objects(sources, existing_objects, mapping["@key"])
+
+    # max-deletes="N" on the target is a safety cap: if more objects would be deleted (e.g. because the
+    # Device42 query returned nothing), the task deletes none of them.
+    if "@max-deletes" in _target and len(orphaned_objects) > int(_target["@max-deletes"]):
+        logger.error("Not deleting %d %ss, more than max-deletes (%s)" % (len(orphaned_objects), kind, _target["@max-deletes"]))
+        return
+
+    def delete_orphaned_object(existing_object):
+        try:
+            logger.info("deleting %s %s" % (kind, existing_object["name"]))
+            delete_object(existing_object)
+            logger.info("deleted %s %s" % (kind, existing_object["name"]))
+        except Exception as e:
+            log = "Error (%s) deleting %s %s" % (str(e), kind, existing_object["name"])
+            logger.exception(log)
+
+    run_concurrently(delete_orphaned_object, orphaned_objects, get_workers(_target))
+
+
+def is_change_detection_enabled(_target):
+    # Unchanged objects are skipped and only changed fields are sent unless change-detection="false".
+    return "@change-detection" not in _target or _target["@change-detection"]
+
+
 def get_asset_type_field(asset_type_fields, map_info):
     for section in asset_type_fields:
         if section["field_header"] == map_info["@target-header"]:
@@ -100,7 +381,37 @@ def get_asset_type_field(asset_type_fields, map_info):
     return None
 
 
-def get_map_value_from_device42(source, map_info, b_add=False, asset_type_id=None):
+def get_value_mapping(map_info):
+    cache_key = "%s-%s" % (map_info["@resource"], map_info["@target"])
+    if cache_key not in fs_cache:
+        if isinstance(map_info["value-mapping"]["item"], list):
+            items = map_info["value-mapping"]["item"]
+        else:
+            items = [map_info["value-mapping"]["item"]]
+
+        fs_cache[cache_key] = {item["@key"]: item["@value"] for item in items}
+
+    return fs_cache[cache_key]
+
+
+def get_value_mapping_default(map_info):
+    default_value = map_info["value-mapping"]["@default"]
+
+    # If we send a software status of "", we get the following error from the API:
+    # Error 400: {"description":"Validation failed","errors":[{"field":"status",
+    # "message":"It should be one of these values: 'blacklisted,ignored,managed'","code":"invalid_value"}]}
+    # So if we have a value in D42 that does not map to Freshservice (we don't currently have a value that
+    # does not map), instead of clearing the value in Freshservice by sending a "", it will try to set that
+    # value and this is not one of the available options.  However, if we set the software status to None,
+    # the value in Freshservice will get cleared.
+    if default_value == "null":
+        return None
+
+    return default_value
+
+
+def get_d42_value(source, map_info):
+    # The value of a field in a source row, mapped with the value-mapping of the field if it has one.
     d42_value = source[map_info["@resource"]]
     if d42_value is None and "@resource-secondary" in map_info:
         d42_value = source[map_info["@resource-secondary"]]
@@ -113,52 +424,47 @@ def get_map_value_from_device42(source, map_info, b_add=False, asset_type_id=Non
                 break
     else:
         if "value-mapping" in map_info:
-            cache_key = "%s-%s" % (map_info["@resource"], map_info["@target"])
-            if cache_key not in fs_cache:
-                if isinstance(map_info["value-mapping"]["item"], list):
-                    items = map_info["value-mapping"]["item"]
-                else:
-                    items = [map_info["value-mapping"]["item"]]
-
-                fs_cache[cache_key] = {item["@key"]: item["@value"] for item in items}
-            d42_val = fs_cache[cache_key].get(d42_value)
+            d42_val = get_value_mapping(map_info).get(d42_value)
             if d42_val is None and "@default" in map_info["value-mapping"]:
-                default_value = map_info["value-mapping"]["@default"]
-
-                # If we send a software status of "", we get the following error from the API:
-                # Error 400: {"description":"Validation failed","errors":[{"field":"status",
-                # "message":"It should be one of these values: 'blacklisted,ignored,managed'","code":"invalid_value"}]}
-                # So if we have a value in D42 that does not map to Freshservice (we don't currently have a value that
-                # does not map), instead of clearing the value in Freshservice by sending a "", it will try to set that
-                # value and this is not one of the available options.  However, if we set the software status to None,
-                # the value in Freshservice will get cleared.
-                if default_value == "null":
-                    d42_val = None
-                else:
-                    d42_val = default_value
+                d42_val = get_value_mapping_default(map_info)
 
             d42_value = d42_val
-        else:
-            pass
 
+    return d42_value
+
+
+def get_map_value_from_device42(source, map_info, b_add=False, asset_type_id=None):
+    return translate_d42_value(get_d42_value(source, map_info), map_info, b_add, asset_type_id)
+
+
+def translate_d42_value(d42_value, map_info, b_add=False, asset_type_id=None):
+    # Translate a Device42 value to the id of the associated object in Freshservice for foreign key fields
+    # (creating the object if b_add is set and the field is not-null) and escape it if needed.
     if "@target-foregin-key" in map_info:
         target_foregin = map_info["@target-foregin"]
         if target_foregin not in fs_cache:
-            fs_cache[target_foregin] = freshservice.get_objects_map("api/v2/%s" % target_foregin, target_foregin, map_info["@target-foregin-key"])
+            with fs_cache_lock:
+                if target_foregin not in fs_cache:
+                    fs_cache[target_foregin] = freshservice.get_reference_objects_map("api/v2/%s" % target_foregin, target_foregin, map_info["@target-foregin-key"])
 
         value = find_object_id_in_map(fs_cache[target_foregin], d42_value)
         if b_add and value is None and "@not-null" in map_info and map_info["@not-null"]:  # and "@required" in map_info and map_info["@required"]
             if d42_value is not None:
-                if "@max-length" in map_info and len(d42_value) > map_info["@max-length"]:
-                    name = d42_value[0:map_info["@max-length"] - 3] + "..."
-                else:
-                    name = d42_value
-                if target_foregin in ["vendors", "groups", "agents"]:
-                    new_item = freshservice.insert_and_get_by_name(target_foregin, name, None, map_info["@target-foregin-key"])
-                else:
-                    new_item = freshservice.insert_and_get_by_name(target_foregin, name, asset_type_id, map_info["@target-foregin-key"])
-                fs_cache[target_foregin][new_item[map_info["@target-foregin-key"]].lower()] = new_item
-                d42_value = new_item["id"]
+                with fs_cache_lock:
+                    # Look again in case another thread created the object while we were waiting for the lock.
+                    value = find_object_id_in_map(fs_cache[target_foregin], d42_value)
+                    if value is None:
+                        if "@max-length" in map_info and len(d42_value) > map_info["@max-length"]:
+                            name = d42_value[0:map_info["@max-length"] - 3] + "..."
+                        else:
+                            name = d42_value
+                        if target_foregin in ["vendors", "groups", "agents"]:
+                            new_item = freshservice.insert_and_get_by_name(target_foregin, name, None, map_info["@target-foregin-key"])
+                        else:
+                            new_item = freshservice.insert_and_get_by_name(target_foregin, name, asset_type_id, map_info["@target-foregin-key"])
+                        fs_cache[target_foregin][new_item[map_info["@target-foregin-key"]].lower()] = new_item
+                        value = new_item["id"]
+                d42_value = value
             else:
                 d42_value = None
         else:
@@ -189,44 +495,327 @@ def get_asset_type_field_from_map(asset_type_fields_map, asset_type_id, asset_ty
     return asset_type_field
 
 
-def submit_relationship_create_job(relationships_to_create):
-    logger.info("adding relationship create job")
-    # Creating relationships using the v2 API is now an asynchronous operation and is
-    # performed using background jobs.  We will get back the job ID which can then be
-    # used to query the status of the job.
-    job_id = freshservice.insert_relationships({"relationships": relationships_to_create})
-    logger.info("added new relationship create job %s" % job_id)
+class CompiledField(object):
+    """ A <mapping> field compiled once per task (and asset type) into the steps that build its value.
+
+    get_value returns the Device42 value of the field before the foreign key translation and
+    translate turns it into the value of the field.  Each of the steps then gets and returns
+    (value, is_valid) in the order the checks were written in the sync functions.
+    """
+
+    def __init__(self, map_info, get_value, translate, steps):
+        self.map_info = map_info
+        self.target = map_info["@target"]
+        self.target_sub_key = map_info.get("@target-sub-key")
+        self.error_skip = bool(map_info.get("@error-skip"))
+        self.get_value = get_value
+        self.translate = translate
+        self.steps = steps
+        self.asset_type_field = None
+        self.type_field_name = None
+
+    def run(self, source, asset_type_id=None):
+        d42_value = self.get_value(source)
+        value = self.translate(d42_value)
+        is_valid = True
+        for step in self.steps:
+            value, is_valid = step(source, d42_value, value, is_valid, asset_type_id)
+
+        return value, is_valid
+
+
+def compile_d42_value_getter(map_info):
+    # Same as get_d42_value, with the attributes of the field looked up once.
+    resource = map_info["@resource"]
+    resource_secondary = map_info.get("@resource-secondary")
+    has_resource_secondary = "@resource-secondary" in map_info
+
+    def get_resource_value(source):
+        d42_value = source[resource]
+        if d42_value is None and has_resource_secondary:
+            d42_value = source[resource_secondary]
+        return d42_value
+
+    if "@is-array" in map_info and map_info["@is-array"]:
+        sub_key = map_info["@sub-key"]
+
+        def get_array_value(source):
+            for d42_val in get_resource_value(source):
+                if sub_key in d42_val:
+                    return d42_val[sub_key]
+            return None
+
+        return get_array_value
+
+    if "value-mapping" in map_info:
+        value_mapping = get_value_mapping(map_info)
+        has_default = "@default" in map_info["value-mapping"]
+        default_value = get_value_mapping_default(map_info) if has_default else None
+
+        def get_mapped_value(source):
+            d42_val = value_mapping.get(get_resource_value(source))
+            if d42_val is None and has_default:
+                d42_val = default_value
+            return d42_val
+
+        return get_mapped_value
+
+    return get_resource_value
+
+
+def compile_translator(map_info):
+    # Same as translate_d42_value without b_add; values that need no translation are returned as is.
+    if "@target-foregin-key" in map_info or ("@escape" in map_info and map_info["@escape"]):
+        return lambda d42_value: translate_d42_value(d42_value, map_info)
+
+    return lambda d42_value: d42_value
+
+
+def compile_min_length_step(map_info):
+    min_length = map_info["@min-length"]
+    set_space = bool(map_info.get("@set-space"))
+
+    def min_length_step(source, d42_value, value, is_valid, asset_type_id):
+        if value is not None and len(value) < min_length:
+            is_valid = False
+            if value == "" and set_space:
+                is_valid = True
+                value = " " * min_length
+        return value, is_valid
+
+    return min_length_step
+
+
+def compile_max_length_step(map_info):
+    max_length = map_info["@max-length"]
+
+    def max_length_step(source, d42_value, value, is_valid, asset_type_id):
+        # value might have been translated to an associated ID in Freshservice by translate_d42_value
+        #  which is why we need to check that value is a string using isinstance.
+        if value is not None and isinstance(value, str) and len(value) > max_length:
+            value = value[0:max_length - 3] + "..."
+        return value, is_valid
+
+    return max_length_step
+
+
+def compile_not_null_step(map_info, invalid_targets=()):
+    # There is an issue with the Freshservice API where sending a null value for
+    # a field will result in the API returning an error like "Has 0 characters,
+    # it should have minimum of 1 characters and can have maximum of 255 characters".
+    # This prevents us from being able to clear these field values in Freshservice (even though
+    # the Freshservice UI allows you to clear these fields).  To get around this, we will send
+    # a single space for string values and a 0 for integer and float values when the value
+    # coming from D42 is null.
+    target_type = map_info.get("@target-type")
+    if map_info["@target"] in invalid_targets or target_type == "date":
+        null_value, null_is_valid = None, False
+    elif target_type == "integer" or target_type == "float":
+        null_value, null_is_valid = 0, True
+    else:
+        null_value, null_is_valid = " ", True
+
+    def not_null_step(source, d42_value, value, is_valid, asset_type_id):
+        if value is None:
+            return null_value, is_valid and null_is_valid
+        return value, is_valid
+
+    return not_null_step
+
+
+def compile_not_zero_step(map_info):
+    # Some fields in Freshservice do not allow a 0 value.
+    # D42 does allow a 0 for the value being synced over,
+    # so when we try to sync that data to Freshservice,
+    # the API returns an error like "It should be a Positive Number
+    # less than or equal to 99999999.99" when we send a 0 value to a field
+    # that does not accept 0.
+    # To get around this, we will send 1 for integer values and a 0.01
+    # for float values when the value coming from D42 is 0.
+    if "@target-type" in map_info:
+        target_type = map_info["@target-type"]
+        if target_type == "integer":
+            zero_value, zero_is_valid = 1, True
+        elif target_type == "float":
+            zero_value, zero_is_valid = 0.01, True
+        else:
+            zero_value, zero_is_valid = None, False
+    else:
+        zero_value, zero_is_valid = 0.01, True
+
+    def not_zero_step(source, d42_value, value, is_valid, asset_type_id):
+        if value == 0:
+            return zero_value, is_valid and zero_is_valid
+        return value, is_valid
+
+    return not_zero_step
+
+
+def compile_foreign_key_step(map_info, only_names=False):
+    # The value is translated again, this time creating the associated object in Freshservice if needed.
+    # With only_names, this is only done for values that were not translated to an id yet.
+    def foreign_key_step(source, d42_value, value, is_valid, asset_type_id):
+        if only_names and (value is None or not isinstance(value, str)):
+            return value, is_valid
+        value = translate_d42_value(d42_value, map_info, True, asset_type_id)
+        return value, value is not None
+
+    return foreign_key_step
+
+
+def integer_step(source, d42_value, value, is_valid, asset_type_id):
+    if value is not None:
+        try:
+            value = int(value)
+        except Exception as e:
+            logger.exception(str(e))
+            is_valid = False
+    return value, is_valid
+
+
+class ChoiceIndex(object):
+    """ The choices of a dropdown asset type field, indexed for matching Device42 values.
+
+    A value matches the first choice (in the order of the field) that contains it or that it contains,
+    ignoring case.  The result is precomputed for the choices themselves and cached for every
+    other value the first time it is matched.
+    """
+
+    def __init__(self, choices):
+        self.choices = [(choice[0].lower(), choice[0]) for choice in choices]
+        self.matches = dict()
+        for choice_value, _ in self.choices:
+            if choice_value not in self.matches:
+                self.matches[choice_value] = self._scan(choice_value)
+
+    def match(self, value):
+        """ Return the matching choice for a value, or None. """
+        if not self.choices:
+            return None
+
+        d42_value = value.lower()
+        if d42_value not in self.matches:
+            self.matches[d42_value] = self._scan(d42_value)
 
-    return {
-        "job_id": job_id,
-        "relationships_to_create_count": len(relationships_to_create)
-    }
+        return self.matches[d42_value]
+
+    def _scan(self, d42_value):
+        for choice_value, option in self.choices:
+            if d42_value in choice_value or choice_value in d42_value:
+                return option
+
+        return None
+
+
+def get_choice_indexes(asset_type_fields):
+    # The key is the (field header, name) of each dropdown field of an asset type.
+    return {(section["field_header"], field["name"]): ChoiceIndex(field["choices"])
+            for section in asset_type_fields for field in section["fields"] if field.get("choices")}
+
+
+def compile_dropdown_step(choice_index):
+    def dropdown_step(source, d42_value, value, is_valid, asset_type_id):
+        if value is not None:
+            try:
+                option = choice_index.match(value)
+                if option is None:
+                    is_valid = False
+                else:
+                    value = option
+            except Exception as e:
+                logger.exception(str(e))
+                is_valid = False
+        return value, is_valid
+
+    return dropdown_step
+
+
+def compile_asset_field(map_info, asset_type_field, choice_indexes):
+    steps = list()
+    if "@min-length" in map_info:
+        steps.append(compile_min_length_step(map_info))
+    if "@max-length" in map_info:
+        steps.append(compile_max_length_step(map_info))
+    if "@not-null" in map_info and map_info["@not-null"]:
+        steps.append(compile_not_null_step(map_info, ("asset_tag",)))
+    if "@target-foregin-key" in map_info:
+        steps.append(compile_foreign_key_step(map_info))
+    if map_info.get("@target-type") == "integer":
+        steps.append(integer_step)
+    elif map_info.get("@target-type") == "dropdown":
+        choice_index = choice_indexes.get((map_info["@target-header"], asset_type_field["name"]))
+        steps.append(compile_dropdown_step(choice_index or ChoiceIndex(asset_type_field.get("choices") or [])))
+
+    field = CompiledField(map_info, compile_d42_value_getter(map_info), compile_translator(map_info), steps)
+    field.asset_type_field = asset_type_field
+    if asset_type_field["asset_type_id"] is not None:
+        field.type_field_name = asset_type_field["name"]
+
+    return field
+
+
+def compile_asset_field_plan(fields, asset_type_id, asset_type_fields, asset_type_fields_map, choice_indexes):
+    # The fields of an asset task that apply to an asset type, in mapping order.
+    plan = list()
+    for map_info in fields:
+        asset_type_field = get_asset_type_field_from_map(asset_type_fields_map, asset_type_id, asset_type_fields, map_info)
+        if asset_type_field is not None:
+            plan.append(compile_asset_field(map_info, asset_type_field, choice_indexes))
+
+    return plan
+
+
+def compile_contract_field(map_info, existing_softwares_map):
+    steps = list()
+    if "@min-length" in map_info:
+        steps.append(compile_min_length_step(map_info))
+    if "@max-length" in map_info:
+        steps.append(compile_max_length_step(map_info))
+    if "@not-null" in map_info and map_info["@not-null"]:
+        steps.append(compile_not_null_step(map_info))
+    if "@not-zero" in map_info and map_info["@not-zero"]:
+        steps.append(compile_not_zero_step(map_info))
+    if "@target-foregin-key" in map_info:
+        steps.append(compile_foreign_key_step(map_info, only_names=True))
+    if map_info.get("@target-type") == "integer":
+        steps.append(integer_step)
+
+    if "@target-foregin-key" in map_info and map_info["@target-foregin"] == "applications":
+        # Softwares were synced before the contracts, so they are looked up in the softwares map.
+        resource = map_info["@resource"]
+        return CompiledField(map_info, lambda source: find_object_in_map(existing_softwares_map, source[resource])["id"],
+                             lambda d42_value: d42_value, steps)
+
+    return CompiledField(map_info, compile_d42_value_getter(map_info), compile_translator(map_info), steps)
+
+
+def record_created_relationship(relationship):
+    if sync_state is not None:
+        sync_state.record("relationship", get_relationship_state_key(relationship))
 
 
 def update_objects_from_server(sources, _target, mapping):
     global freshservice
 
+    detect_changes = is_change_detection_enabled(_target)
+
     # This method gets called for both devices and business apps.  Since it gets called first for devices,
     # that is when the assets from Freshservice will get added to the cache.  When this method gets called
     #  for business apps, we can get the objects out of the cache.
-    if "assets" in fs_cache:
-        logger.info("Getting all existing assets in FS from cache.")
-        existing_objects_map = fs_cache["assets"]
-        logger.info("finished getting all existing assets in FS from cache.")
-    else:
-        logger.info("Getting all existing assets in FS.")
-        existing_objects_map = freshservice.get_objects_map(_target["@path"], _target["@model"])
-        logger.info("finished getting all existing assets in FS.")
-        fs_cache["assets"] = existing_objects_map
+    # The cached assets keep the fields of every asset task, so that each task can compare its own fields.
+    existing_objects_map = get_existing_assets_map(
+        (asset_compared_fields or get_compared_fields([mapping])) if detect_changes else False)
 
     if "asset_types" not in fs_cache:
-        asset_types_map = freshservice.get_objects_map("api/v2/asset_types", "asset_types")
+        asset_types_map = freshservice.get_reference_objects_map("api/v2/asset_types", "asset_types")
         fs_cache["asset_types"] = asset_types_map
     else:
         asset_types_map = fs_cache["asset_types"]
 
     if "asset_type_fields" not in fs_cache:
         fs_cache["asset_type_fields"] = {}
+    if "asset_type_choices" not in fs_cache:
+        fs_cache["asset_type_choices"] = {}
 
     asset_type_fields_map = dict()
     server_asset_type_id = find_object_id_in_map(asset_types_map, ASSET_TYPE_SERVER)
@@ -234,149 +823,120 @@ def update_objects_from_server(sources, _target, mapping):
     windows_server_asset_type_id = find_object_id_in_map(asset_types_map, ASSET_TYPE_WINDOWS_SERVER)
     host_asset_type_id = find_object_id_in_map(asset_types_map, ASSET_TYPE_HOST)
 
-    for source in sources:
-        error_skip = False
-        while True:
-            try:
-                existing_object = find_object_in_map(existing_objects_map, source["name"])
-                source_asset_type_id = find_object_id_in_map(asset_types_map, source["asset_type"])
-
-                # If we have an existing asset with an asset type of Windows Server or Unix Server and
-                # we determined that the asset type should be Host, we will update it to Host since previously
-                # we were bringing in host devices as Windows Server or Unix Server asset types instead of the
-                # Host asset type.
-                if existing_object is None or existing_object["asset_type_id"] == server_asset_type_id or \
-                   (existing_object["asset_type_id"] in [unix_server_asset_type_id, windows_server_asset_type_id] and \
-                   source_asset_type_id == host_asset_type_id):
-                    asset_type_id = source_asset_type_id
-                else:
-                    asset_type_id = existing_object["asset_type_id"]
-
-                if asset_type_id in fs_cache["asset_type_fields"]:
-                    asset_type_fields = fs_cache["asset_type_fields"][asset_type_id]
-                else:
-                    asset_type_fields = freshservice.get_asset_type_fields(asset_type_id)
-                    fs_cache["asset_type_fields"][asset_type_id] = asset_type_fields
+    # if there is only one field in the mapping, it will be dict.
+    if isinstance(mapping["field"], dict):
+        mapping["field"] = [mapping["field"]]
+
+    # The mapping fields are compiled once for every asset type.
+    field_plans = dict()
+    field_plans_lock = threading.Lock()
+
+    def get_field_plan(asset_type_id, asset_type_fields):
+        with field_plans_lock:
+            if asset_type_id not in field_plans:
+                field_plans[asset_type_id] = compile_asset_field_plan(mapping["field"], asset_type_id, asset_type_fields,
+                                                                      asset_type_fields_map, fs_cache["asset_type_choices"].get(asset_type_id, {}))
+            return field_plans[asset_type_id]
+
+    def build_payload(source, error_skip):
+        # Returns (existing_object, asset_type_id, data, data_hash), or None if there is nothing to send.
+        existing_object = find_object_in_map(existing_objects_map, source["name"])
+        source_asset_type_id = find_object_id_in_map(asset_types_map, source["asset_type"])
+
+        # If we have an existing asset with an asset type of Windows Server or Unix Server and
+        # we determined that the asset type should be Host, we will update it to Host since previously
+        # we were bringing in host devices as Windows Server or Unix Server asset types instead of the
+        # Host asset type.
+        if existing_object is None or existing_object["asset_type_id"] == server_asset_type_id or \
+           (existing_object["asset_type_id"] in [unix_server_asset_type_id, windows_server_asset_type_id] and \
+           source_asset_type_id == host_asset_type_id):
+            asset_type_id = source_asset_type_id
+        else:
+            asset_type_id = existing_object["asset_type_id"]
 
-                data = dict()
-                data['asset_type_id'] = asset_type_id
-                data["type_fields"] = dict()
+        with fs_cache_lock:
+            if asset_type_id in fs_cache["asset_type_fields"]:
+                asset_type_fields = fs_cache["asset_type_fields"][asset_type_id]
+            else:
+                asset_type_fields = freshservice.get_asset_type_fields(asset_type_id)
+                fs_cache["asset_type_fields"][asset_type_id] = asset_type_fields
+                fs_cache["asset_type_choices"][asset_type_id] = get_choice_indexes(asset_type_fields)
 
-                # if there is only one field in the mapping, it will be dict.
-                if isinstance(mapping["field"], dict):
-                    mapping["field"] = [mapping["field"]]
+        data = dict()
+        data['asset_type_id'] = asset_type_id
+        data["type_fields"] = dict()
 
-                # validation
-                for map_info in mapping["field"]:
-                    if error_skip and "@error-skip" in map_info and map_info["@error-skip"]:
-                        continue
+        # validation
+        for field in get_field_plan(asset_type_id, asset_type_fields):
+            if error_skip and field.error_skip:
+                continue
 
-                    asset_type_field = get_asset_type_field_from_map(asset_type_fields_map, asset_type_id, asset_type_fields, map_info)
-                    if asset_type_field is None:
-                        continue
+            value, is_valid = field.run(source, asset_type_id)
 
-                    value = get_map_value_from_device42(source, map_info)
+            if field.type_field_name is not None:
+                field_data, key = data["type_fields"], field.type_field_name
+            else:
+                field_data, key = data, field.target
 
-                    if asset_type_field["asset_type_id"] is not None:
-                        data["type_fields"][asset_type_field["name"]] = value
-                    else:
-                        data[map_info["@target"]] = value
-
-                    is_valid = True
-                    if value is not None and "@min-length" in map_info and len(value) < map_info["@min-length"]:
-                        is_valid = False
-                        if value == "" and "@set-space" in map_info and map_info["@set-space"]:
-                            is_valid = True
-                            value = " " * map_info["@min-length"]
-                    # value might have been translated to an associated ID in Freshservice by get_map_value_from_device42
-                    #  which is why we need to check that value is a string using isinstance.
-                    if value is not None and "@max-length" in map_info and isinstance(value, str) and len(value) > map_info["@max-length"]:
-                        value = value[0:map_info["@max-length"] - 3] + "..."
-                    if value is None and "@not-null" in map_info and map_info["@not-null"]:
-                        if map_info["@target"] == "asset_tag":
-                            is_valid = False
-                        else:
-                            # There is an issue with the Freshservice API where sending a null value for
-                            # a field will result in the API returning an error like "Has 0 characters,
-                            # it should have minimum of 1 characters and can have maximum of 255 characters".
-                            # This prevents us from being able to clear these field values in Freshservice (even though
-                            # the Freshservice UI allows you to clear these fields).  To get around this, we will send
-                            # a single space for string values and a 0 for integer and float values when the value
-                            # coming from D42 is null.
-                            if "@target-type" in map_info:
-                                target_type = map_info["@target-type"]
-                                if target_type == "integer" or target_type == "float":
-                                    value = 0
-                                elif target_type == "date":
-                                    value = None
-                                    is_valid = False
-                                else:
-                                    value = " "
-                            else:
-                                value = " "
-
-                    if "@target-foregin-key" in map_info:
-                        value = get_map_value_from_device42(source, map_info, True, data["asset_type_id"])
-                        is_valid = value is not None
-                    if "@target-type" in map_info and value is not None:
-                        target_type = map_info["@target-type"]
-                        if target_type == "integer":
-                            try:
-                                value = int(value)
-                            except Exception as e:
-                                logger.exception(str(e))
-                                is_valid = False
-
-                        elif target_type == "dropdown":
-                            try:
-                                option = None
-                                for choice in asset_type_field["choices"]:
-                                    d42_value = value.lower()
-                                    choice_value = choice[0].lower()
-                                    if d42_value in choice_value or choice_value in d42_value:
-                                        option = choice[0]
-                                        break
-                                if option is None:
-                                    is_valid = False
-                                else:
-                                    value = option
-                            except Exception as e:
-                                logger.exception(str(e))
-                                is_valid = False
-
-                    if not is_valid:
-                        logger.debug("argument '%s' is invalid." % map_info["@target"])
-                        if asset_type_field["asset_type_id"] is not None:
-                            data["type_fields"].pop(asset_type_field["name"], None)
-                        else:
-                            data.pop(map_info["@target"], None)
-                    if is_valid:
-                        if asset_type_field["asset_type_id"] is not None:
-                            data["type_fields"][asset_type_field["name"]] = value
-                        else:
-                            data[map_info["@target"]] = value
+            if is_valid:
+                field_data[key] = value
+            else:
+                logger.debug("argument '%s' is invalid." % field.target)
+                field_data.pop(key, None)
+
+        data_hash = payload_hash(data) if sync_state is not None else None
+        if is_unchanged_since_last_sync("device", source["name"], existing_object, data_hash):
+            logger.info("asset %s is unchanged since the last sync" % source["name"])
+            return None
+
+        if existing_object is not None:
+            if detect_changes:
+                data = get_changed_fields(data, existing_object)
+                if not data:
+                    logger.info("asset %s is unchanged" % source["name"])
+                    record_sync_state("device", source["name"], existing_object, data_hash)
+                    return None
+                if "type_fields" in data:
+                    data["asset_type_id"] = asset_type_id
+
+            # This is a workaround for an issue with the Freshservice API where if a business service
+            # asset has the Managed By field filled in and we don't send an agent_id to update this
+            # field (we don't map any D42 data to this field and shouldn't need to because
+            # the API will only update the fields that we send), it will result in a validation
+            # error with the message:
+            # Assigned agent isn't a member of the group.
+            # So, if the business service asset has an agent_id already populated, we will send that
+            # same value over and that will avoid this error.
+            if source["asset_type"] == ASSET_TYPE_BUSINESS_SERVICE and "agent_id" in existing_object and existing_object["agent_id"]:
+                data["agent_id"] = existing_object["agent_id"]
+
+        return existing_object, asset_type_id, data, data_hash
+
+    def update_object_steps(source):
+        # The calls are yielded (see transport.api_method), so the same steps run on the blocking
+        # client or on the asyncio client.
+        error_skip = False
+        while True:
+            try:
+                payload = build_payload(source, error_skip)
+                if payload is None:
+                    break
+                existing_object, asset_type_id, data, data_hash = payload
 
                 if existing_object is None:
                     logger.info("adding asset %s" % source["name"])
-                    new_asset = freshservice.insert_asset(data)
+                    new_asset = yield "insert_asset", (data,)
                     logger.info("added new asset %d" % new_asset["id"])
                     # We added a new object to Freshservice.  Add it to the map of objects that we know exist
                     # in Freshservice.
                     existing_objects_map[new_asset["name"].lower()] = new_asset
+                    record_sync_state("device", source["name"], new_asset, data_hash)
                 else:
                     logger.info("updating asset %s" % source["name"])
-                    # This is a workaround for an issue with the Freshservice API where if a business service
-                    # asset has the Managed By field filled in and we don't send an agent_id to update this
-                    # field (we don't map any D42 data to this field and shouldn't need to because
-                    # the API will only update the fields that we send), it will result in a validation
-                    # error with the message:
-                    # Assigned agent isn't a member of the group.
-                    # So, if the business service asset has an agent_id already populated, we will send that
-                    # same value over and that will avoid this error.
-                    if source["asset_type"] == ASSET_TYPE_BUSINESS_SERVICE and "agent_id" in existing_object and existing_object["agent_id"]:
-                        data["agent_id"] = existing_object["agent_id"]
-                    updated_asset_id = freshservice.update_asset(data, existing_object["display_id"])
+                    updated_asset_id = yield "update_asset", (data, existing_object["display_id"])
                     logger.info("updated existing asset %d" % updated_asset_id)
+                    remember_sent_fields(existing_object, data)
+                    record_sync_state("device", source["name"], existing_object, data_hash)
                     # If the asset type changed for this asset, update it in the cache.
                     if existing_object["asset_type_id"] != asset_type_id:
                         existing_object["asset_type_id"] = asset_type_id
@@ -386,43 +946,72 @@ def update_objects_from_server(sources, _target, mapping):
                 if not error_skip:
                     error_skip = True
                     continue
+                row_failures.add()
                 break
             except Exception as e:
                 log = "Error (%s) updating device %s" % (str(e), source["name"])
                 logger.exception(log)
+                row_failures.add()
                 break
 
+    def get_source_lock_key(source):
+        # Sources with the same name are never processed at the same time, so the second one
+        # sees (and updates) the asset that the first one inserted.
+        name = escape_value(source.get("name"))
+        return name.lower() if name else None
+
+    def update_object_locked(source):
+        with source_locks.hold(get_source_lock_key(source)):
+            run_steps(freshservice, update_object_steps(source))
+
+    async def update_object_async(client, source):
+        key = get_source_lock_key(source)
+        await async_source_locks.acquire(key)
+        try:
+            # build_payload may call the blocking client (asset type fields, reference objects and the
+            # foreign key objects it creates) and take fs_cache_lock, so the steps run on the executor
+            # and only the inserts and updates are sent from the event loop.
+            await run_steps_async(client, update_object_steps(source), blocking=True)
+        finally:
+            async_source_locks.release(key)
+
+    workers = get_workers(_target)
+    if is_async_enabled(_target):
+        async_client = create_async_freshservice(workers)
+        async_source_locks = AsyncKeyedLocks()
+        run_on_event_loop(async_client, run_concurrently_async(
+            lambda source: update_object_async(async_client, source), sources, workers))
+    else:
+        source_locks = KeyedLocks()
+        run_concurrently(update_object_locked, sources, workers)
+
 
 def delete_objects_from_server(sources, _target, mapping):
     global freshservice
 
     logger.info("Getting all existing devices in FS.")
-    existing_objects = freshservice.request(_target["@path"] + "?include=type_fields", "GET", _target["@model"])
+    existing_objects = get_existing_assets(True)
     logger.info("finished getting all existing devices in FS.")
 
-    for existing_object in existing_objects:
-        exist = False
-        for source in sources:
-            if source[mapping["@key"]] == existing_object[mapping["@key"]]:
-                exist = True
-                break
+    def delete_device(existing_object):
+        freshservice.delete_asset(existing_object["display_id"])
+        if sync_state is not None:
+            sync_state.forget("device", get_state_key(existing_object["name"]))
+            # delete_forever is a hard delete, so the asset never shows up in the trashed delta of
+            # the snapshots either.
+            for snapshot_name in ASSET_SNAPSHOTS:
+                sync_state.remove_snapshot_object(snapshot_name, existing_object["id"])
 
-        if not exist:
-            try:
-                logger.info("deleting device %s" % existing_object["name"])
-                freshservice.delete_asset(existing_object["display_id"])
-                logger.info("deleted asset %s" % existing_object["name"])
-            except Exception as e:
-                log = "Error (%s) deleting device %s" % (str(e), existing_object["name"])
-                logger.exception(log)
+    delete_orphaned_objects("device", sources, existing_objects, _target, mapping, delete_device)
 
 
 def update_softwares_from_server(sources, _target, mapping):
     global freshservice
 
-    logger.info("Getting all existing softwares in FS.")
-    existing_objects_map = freshservice.get_objects_map(_target["@path"], _target["@model"])
-    logger.info("finished getting all existing softwares in FS.")
+    detect_changes = is_change_detection_enabled(_target)
+
+    existing_objects_map = get_objects_map_from_state("software", "softwares", _target,
+                                                      get_compared_fields([mapping]) if detect_changes else False)
     fs_cache["softwares"] = existing_objects_map
 
     for source in sources:
@@ -439,6 +1028,11 @@ def update_softwares_from_server(sources, _target, mapping):
 
                 data[map_info["@target"]] = value
 
+            data_hash = payload_hash(data) if sync_state is not None else None
+            if is_unchanged_since_last_sync("software", source["name"], existing_object, data_hash):
+                logger.info("software %s is unchanged since the last sync" % source["name"])
+                continue
+
             if existing_object is None:
                 logger.info("adding software %s" % source["name"])
                 new_software = freshservice.insert_software(data)
@@ -446,13 +1040,24 @@ def update_softwares_from_server(sources, _target, mapping):
                 # We added a new object to Freshservice.  Add it to the map of objects that we know exist
                 # in Freshservice.
                 existing_objects_map[new_software["name"].lower()] = new_software
+                record_sync_state("software", source["name"], new_software, data_hash)
             else:
+                if detect_changes:
+                    data = get_changed_fields(data, existing_object)
+                    if not data:
+                        logger.info("software %s is unchanged" % source["name"])
+                        record_sync_state("software", source["name"], existing_object, data_hash)
+                        continue
+
                 logger.info("updating software %s" % source["name"])
                 updated_software_id = freshservice.update_software(data, existing_object["id"])
                 logger.info("updated existing software %d" % updated_software_id)
+                remember_sent_fields(existing_object, data)
+                record_sync_state("software", source["name"], existing_object, data_hash)
         except Exception as e:
             log = "Error (%s) updating software %s" % (str(e), source["name"])
             logger.exception(log)
+            row_failures.add()
 
 
 def delete_softwares_from_server(sources, _target, mapping):
@@ -460,33 +1065,25 @@ def delete_softwares_from_server(sources, _target, mapping):
 
     logger.info("Getting all existing softwares in FS.")
     existing_objects = freshservice.request(_target["@path"] + "?include=type_fields", "GET", _target["@model"])
-    logger.info("finished getting all existing devices in FS.")
+    logger.info("finished getting all existing softwares in FS.")
 
-    for existing_object in existing_objects:
-        exist = False
-        for source in sources:
-            if source[mapping["@key"]] == existing_object[mapping["@key"]]:
-                exist = True
-                break
+    def delete_software(existing_object):
+        freshservice.delete_software(existing_object["id"])
+        if sync_state is not None:
+            sync_state.forget("software", get_state_key(existing_object["name"]))
 
-        if not exist:
-            try:
-                logger.info("deleting software %s" % existing_object["name"])
-                freshservice.delete_software(existing_object["id"])
-                logger.info("deleted software %s" % existing_object["name"])
-            except Exception as e:
-                log = "Error (%s) deleting software %s" % (str(e), existing_object["name"])
-                logger.exception(log)
+    delete_orphaned_objects("software", sources, existing_objects, _target, mapping, delete_software)
 
 
 def update_products_from_server(sources, _target, mapping):
     global freshservice
 
-    logger.info("Getting all existing products in FS.")
-    existing_objects_map = freshservice.get_objects_map(_target["@path"], _target["@model"])
-    logger.info("finished getting all existing products in FS.")
+    detect_changes = is_change_detection_enabled(_target)
 
-    asset_types_map = freshservice.get_objects_map("api/v2/asset_types", "asset_types")
+    existing_objects_map = get_objects_map_from_state("product", "products", _target,
+                                                      get_compared_fields([mapping]) if detect_changes else False)
+
+    asset_types_map = freshservice.get_reference_objects_map("api/v2/asset_types", "asset_types")
     fs_cache["asset_types"] = asset_types_map
     asset_type_id = find_object_id_in_map(asset_types_map, _target["@asset-type"])
 
@@ -504,6 +1101,11 @@ def update_products_from_server(sources, _target, mapping):
 
                 data[map_info["@target"]] = value
 
+            data_hash = payload_hash(data) if sync_state is not None else None
+            if is_unchanged_since_last_sync("product", source["name"], existing_object, data_hash):
+                logger.info("product %s is unchanged since the last sync" % source["name"])
+                continue
+
             if existing_object is None:
                 logger.info("adding product %s" % source["name"])
                 data['asset_type_id'] = asset_type_id
@@ -512,39 +1114,43 @@ def update_products_from_server(sources, _target, mapping):
                 # We added a new object to Freshservice.  Add it to the map of objects that we know exist
                 # in Freshservice.
                 existing_objects_map[new_product["name"].lower()] = new_product
+                record_sync_state("product", source["name"], new_product, data_hash)
             else:
+                if detect_changes:
+                    data = get_changed_fields(data, existing_object)
+                    if not data:
+                        logger.info("product %s is unchanged" % source["name"])
+                        record_sync_state("product", source["name"], existing_object, data_hash)
+                        continue
+
                 logger.info("updating product %s" % source["name"])
                 updated_product_id = freshservice.update_product(data, existing_object["id"])
                 logger.info("updated existing product %d" % updated_product_id)
+                remember_sent_fields(existing_object, data)
+                record_sync_state("product", source["name"], existing_object, data_hash)
         except Exception as e:
             log = "Error (%s) updating product %s" % (str(e), source["name"])
             logger.exception(log)
+            row_failures.add()
 
 
 def create_installation_from_software_in_use(sources, _target, mapping):
     global freshservice
 
-    if "assets" in fs_cache:
-        logger.info("Getting all existing assets in FS from cache.")
-        existing_objects_map = fs_cache["assets"]
-        logger.info("finished getting all existing assets in FS from cache.")
-    else:
-        logger.info("Getting all existing assets in FS.")
-        existing_objects_map = freshservice.get_objects_map(_target["@path"], _target["@model"])
-        logger.info("finished getting all existing assets in FS.")
-        fs_cache["assets"] = existing_objects_map
+    existing_objects_map = get_existing_assets_map()
 
     if "softwares" in fs_cache:
         logger.info("Getting all existing softwares in FS from cache.")
         existing_softwares_map = fs_cache["softwares"]
         logger.info("finished getting all existing softwares in FS from cache.")
     else:
-        logger.info("Getting all existing softwares in FS.")
-        existing_softwares_map = freshservice.get_objects_map(_target["@path"], _target["@model"])
-        logger.info("finished getting all existing softwares in FS.")
+        existing_softwares_map = get_objects_map_from_state("software", "softwares", _target)
         fs_cache["softwares"] = existing_softwares_map
 
-    software_to_assets_map = dict()
+    rebuild_sync_state("installation", dict())
+
+    # The installations that may have to be added, keyed by (software id, asset display id).
+    pending_installations = OrderedDict()
 
     for source in sources:
         try:
@@ -562,68 +1168,131 @@ def create_installation_from_software_in_use(sources, _target, mapping):
                 logger.exception(log)
                 continue
 
-            if software["id"] not in software_to_assets_map:
-                installations = freshservice.get_installations_by_id(software["id"])
-                software_to_assets_map[software["id"]] = {i["installation_machine_id"] for i in installations}
-
-            exist = asset["display_id"] in software_to_assets_map[software["id"]]
-            if exist:
+            # Installations pushed in an earlier run are not looked up in Freshservice again.
+            installation_key = "%d-%d" % (software["id"], asset["display_id"])
+            if is_known_in_sync_state("installation", installation_key):
                 logger.info("There is already installation in FS.")
                 continue
 
-            data = dict()
-            data["installation_machine_id"] = asset["display_id"]
-            data["version"] = source[mapping["@version"]]
-            data["installation_date"] = source[mapping["@install-date"]]
-            logger.info("adding installation %s-%s" % (source[mapping["@device-name"]], source[mapping["@software-name"]]))
-            freshservice.insert_installation(software["id"], data)
-            # We added a new installation to Freshservice.  Add it to the map of installations that we know exist
-            # in Freshservice.
-            software_to_assets_map[software["id"]].add(asset["display_id"])
-            logger.info("added installation %s-%s" % (source[mapping["@device-name"]], source[mapping["@software-name"]]))
+            if (software["id"], asset["display_id"]) not in pending_installations:
+                pending_installations[(software["id"], asset["display_id"])] = {
+                    "name": "%s-%s" % (source[mapping["@device-name"]], source[mapping["@software-name"]]),
+                    "data": {
+                        "installation_machine_id": asset["display_id"],
+                        "version": source[mapping["@version"]],
+                        "installation_date": source[mapping["@install-date"]]
+                    }
+                }
         except Exception as e:
             log = "Error (%s) creating installation %s" % (str(e), source[mapping["@device-name"]])
             logger.exception(log)
+            row_failures.add()
+
+    def get_installed_asset_ids(software_id):
+        try:
+            installations = freshservice.get_installations_by_id(software_id)
+            return {i["installation_machine_id"] for i in installations}
+        except Exception as e:
+            log = "Error (%s) getting installations of software %d" % (str(e), software_id)
+            logger.exception(log)
+            return None
+
+    # The installations of every software are fetched once, up to workers="N" at the same time.
+    logger.info("Getting existing installations in FS.")
+    software_to_assets_map = map_concurrently(get_installed_asset_ids, (software_id for software_id, _ in pending_installations),
+                                              get_workers(_target))
+    logger.info("finished getting existing installations in FS.")
+
+    def get_missing_installations():
+        for (software_id, display_id), installation in pending_installations.items():
+            installed_asset_ids = software_to_assets_map[software_id]
+            if installed_asset_ids is None:
+                # The installations of this software could not be fetched, which was already logged.
+                row_failures.add()
+                continue
+
+            installation_key = "%d-%d" % (software_id, display_id)
+            if display_id in installed_asset_ids:
+                logger.info("There is already installation in FS.")
+                if sync_state is not None:
+                    sync_state.record("installation", installation_key, display_id=display_id)
+                continue
+
+            yield software_id, display_id, installation
+
+    def add_installation(missing_installation):
+        software_id, display_id, installation = missing_installation
+        try:
+            logger.info("adding installation %s" % installation["name"])
+            installation_id = freshservice.insert_installation(software_id, installation["data"])
+            if sync_state is not None:
+                sync_state.record("installation", "%d-%d" % (software_id, display_id), installation_id, display_id)
+            logger.info("added installation %s" % installation["name"])
+        except Exception as e:
+            log = "Error (%s) creating installation %s" % (str(e), installation["name"])
+            logger.exception(log)
+            row_failures.add()
+
+    run_concurrently(add_installation, get_missing_installations(), get_workers(_target))
+
+
+def delete_incorrect_virtualization_relationships(relationship_index, existing_objects_map):
+    # We used to created Virtualized by/Virtualizes relationships incorrectly.  It would read
+    # as the host is virtualized by the VM and the VM virtualizes the host.  This was wrong.
+    # It should read as the VM is virtualized by the host and the host virtualizes the VM.
+    # We will delete these incorrect relationships and the correct ones will be created if
+    # they do not exist.
+
+    # Get both active assets (i.e. those assets that are not in the trash) and trashed
+    # assets (i.e. those assets that have been deleted and moved to the trash).
+    # We get the trashed assets because there could be incorrect relationships
+    # where the host has been deleted and moved to the trash, but the VM is active.
+    # The key for this dictionary will be the display id since this is what the
+    # relationships returned from the Freshservice API use (i.e. the display id for
+    # the primary and secondary assets in the relationship).
+    assets_by_display_id = {v["display_id"]: v for k, v in existing_objects_map.items()}
+    # For the key of the dictionary that gets returned, we will use the display id.  We cannot
+    # use the asset name as the key because multiple assets in the trash could have the same
+    # name and this would result in only one of those assets with the same name being in
+    # the dictionary since they would each be using the same key.  Even though these assets
+    # would have the same name, they would have different display ids.  In addition, an
+    # asset in the trash could have the same name as an active asset.
+    trashed_assets = freshservice.get_objects_map("api/v2/assets?trashed=true", "assets", "display_id")
+    assets_by_display_id.update(trashed_assets)
+
+    host_asset_type_ids = [fs_cache["asset_types"]["host"]["id"], fs_cache["asset_types"]["vmware vcenter host"]["id"]]
+
+    # For the incorrect relationships, a host asset would have been the primary asset in the
+    # relationship.
+    incorrect_relationships = [relationship for relationship in relationship_index
+                               if relationship["primary_id"] in assets_by_display_id and
+                               assets_by_display_id[relationship["primary_id"]]["asset_type_id"] in host_asset_type_ids]
+
+    for relationship in detach_relationships(incorrect_relationships):
+        logger.info("deleted incorrect Virtualized by/Virtualizes relationship %d" % relationship["id"])
+        relationship_index.remove(relationship)
 
 
 def create_relationships_from_affinity_group(sources, _target, mapping):
     global freshservice
 
-    if "assets" in fs_cache:
-        logger.info("Getting all existing assets in FS from cache.")
-        existing_objects_map = fs_cache["assets"]
-        logger.info("finished getting all existing assets in FS from cache.")
-    else:
-        logger.info("Getting all existing assets in FS.")
-        existing_objects_map = freshservice.get_objects_map(_target["@path"], _target["@model"])
-        logger.info("finished getting all existing assets in FS.")
-        fs_cache["assets"] = existing_objects_map
+    existing_objects_map = get_existing_assets_map()
 
-    logger.info("Getting relationship type in FS.")
-    relationship_type = freshservice.get_relationship_type_by_content(mapping["@downstream-relationship"],
-                                                                      mapping["@upstream-relationship"])
-    logger.info("finished getting relationship type in FS.")
+    relationship_type = get_relationship_type(mapping)
     if relationship_type is None:
-        log = "There is no relationship type in FS. (%s - %s)" % (
-            mapping["@downstream-relationship"], mapping["@upstream-relationship"])
-        logger.info(log)
         return
 
-    # The key will be the display_id of the primary asset and the value will be a set of
-    # the secondary asset display_id's that the primary asset is related to.
-    relationships_map = dict()
-    relationships_to_create = list()
-    source_count = len(sources)
-    submitted_jobs = list()
-
     is_virtualized_by_rel_type = False
     if relationship_type["downstream_relation"] == "Virtualized by" and relationship_type["upstream_relation"] == "Virtualizes":
         is_virtualized_by_rel_type = True
 
-    # This will be used for deleting the incorrect Virtualized by/Virtualizes relationships.
-    assets_by_display_id = None
+    rebuild_sync_state("relationship", dict())
+
+    # The (primary, secondary) display ids of the relationships that should exist, in source order.
+    desired_edges = list()
+    desired_edges_set = set()
 
-    for idx, source in enumerate(sources):
+    for source in sources:
         try:
             logger.info("Processing %s - %s." % (source[mapping["@key"]], source[mapping["@target-key"]]))
             primary_asset = find_object_in_map(existing_objects_map, source[mapping["@key"]])
@@ -640,163 +1309,60 @@ def create_relationships_from_affinity_group(sources, _target, mapping):
                 logger.exception(log)
                 continue
 
-            primary_asset_display_id = primary_asset["display_id"]
-
-            if primary_asset_display_id not in relationships_map:
-                relationships_map[primary_asset_display_id] = set()
-                relationships = freshservice.get_relationships_by_id(primary_asset_display_id)
-
-                for relationship in relationships:
-                    if relationship["relationship_type_id"] == relationship_type["id"]:
-                        deleted_relationship = False
-                        # We used to created Virtualized by/Virtualizes relationships incorrectly.  It would read
-                        # as the host is virtualized by the VM and the VM virtualizes the host.  This was wrong.
-                        # It should read as the VM is virtualized by the host and the host virtualizes the VM.
-                        # We will delete these incorrect relationships and the correct ones will be created if
-                        # they do not exist.
-                        if is_virtualized_by_rel_type:
-                            if assets_by_display_id is None:
-                                # Get both active assets (i.e. those assets that are not in the trash) and trashed
-                                # assets (i.e. those assets that have been deleted and moved to the trash).
-                                # We get the trashed assets because there could be incorrect relationships
-                                # where the host has been deleted and moved to the trash, but the VM is active.
-                                # The key for this dictionary will be the display id since this is what the
-                                # relationships returned from the Freshservice API use (i.e. the display id for
-                                # the primary and secondary assets in the relationship).
-                                assets_by_display_id = {v["display_id"]: v for k, v in existing_objects_map.items()}
-                                # For the key of the dictionary that gets returned, we will use the display id.  We cannot
-                                # use the asset name as the key because multiple assets in the trash could have the same
-                                # name and this would result in only one of those assets with the same name being in
-                                # the dictionary since they would each be using the same key.  Even though these assets
-                                # would have the same name, they would have different display ids.  In addition, an
-                                # asset in the trash could have the same name as an active asset.
-                                trashed_assets = freshservice.get_objects_map("api/v2/assets?trashed=true", "assets", "display_id")
-                                assets_by_display_id.update(trashed_assets)
-
-                            # For the incorrect relationships, a host asset would have been the primary asset in the
-                            # relationship.
-                            if relationship["primary_id"] in assets_by_display_id:
-                                pri = assets_by_display_id[relationship["primary_id"]]
-                                if pri["asset_type_id"] in [fs_cache["asset_types"]["host"]["id"], fs_cache["asset_types"]["vmware vcenter host"]["id"]]:
-                                    freshservice.detach_relationship(relationship["id"])
-                                    logger.info("deleted incorrect Virtualized by/Virtualizes relationship %d" % relationship["id"])
-                                    deleted_relationship = True
-
-                        if not deleted_relationship:
-                            relationships_map[primary_asset_display_id].add(relationship["secondary_id"])
-
-            exist = secondary_asset["display_id"] in relationships_map[primary_asset_display_id]
-            if exist:
+            # Relationships created in an earlier run are not looked up in Freshservice again.
+            relationship_key = "%d-%d-%d" % (relationship_type["id"], primary_asset["display_id"], secondary_asset["display_id"])
+            if is_known_in_sync_state("relationship", relationship_key):
                 logger.info("There is already relationship in FS.")
                 continue
 
-            relationships_to_create.append({
-                "relationship_type_id": relationship_type["id"],
-                "primary_id": primary_asset_display_id,
-                "primary_type": "asset",
-                "secondary_id": secondary_asset["display_id"],
-                "secondary_type": "asset"
-            })
-
-            relationships_to_create_count = len(relationships_to_create)
-            relationships_map[primary_asset_display_id].add(secondary_asset["display_id"])
-
-            # Create a new job if we reached our batch size or we are on the last item (which
-            # means this is the last batch we will be submitting).
-            if relationships_to_create_count >= RELATIONSHIP_BATCH_SIZE or idx == source_count - 1:
-                submitted_jobs.append(submit_relationship_create_job(relationships_to_create))
-
-                # Clear the list for the next batch of relationships we are going to send.
-                del relationships_to_create[:]
+            edge = (primary_asset["display_id"], secondary_asset["display_id"])
+            if edge not in desired_edges_set:
+                desired_edges_set.add(edge)
+                desired_edges.append(edge)
         except Exception as e:
             log = "Error (%s) creating relationship %s" % (str(e), source[mapping["@key"]])
             logger.exception(log)
+            row_failures.add()
+
+    # The relationships of every primary asset are fetched once (and concurrently with workers="N").
+    logger.info("Getting existing relationships in FS.")
+    relationship_index = RelationshipIndex(relationship_type["id"], logger)
+    relationship_index.load(freshservice.get_relationships_by_id, [primary_id for primary_id, _ in desired_edges], get_workers(_target))
+    logger.info("finished getting existing relationships in FS.")
+
+    if is_virtualized_by_rel_type:
+        delete_incorrect_virtualization_relationships(relationship_index, existing_objects_map)
+
+    # Creating relationships using the v2 API is an asynchronous operation that is performed using
+    # background jobs, which the tracker submits and follows.
+    job_tracker = RelationshipJobTracker(freshservice, RELATIONSHIP_BATCH_SIZE, RELATIONSHIPS_CREATED_PER_SECOND,
+                                         RELATIONSHIP_JOBS_IN_FLIGHT, on_created=record_created_relationship, logger=logger)
+
+    for primary_id, secondary_id in desired_edges:
+        if not relationship_index.is_loaded(primary_id):
+            # The relationships of this asset could not be fetched, which was already logged.
+            row_failures.add()
+            continue
 
-    # We may not have submitted the last batch of relationships to create if the last item in
-    # sources did not result in a relationship needing to be created (e.g. one of the assets
-    # in the relationship did not exist in Freshservice, the relationship already existed in
-    # Freshservice, etc.).  So if we have any relationships that we need to create that have
-    # not been submitted, submit them now.
-    if relationships_to_create:
-        submitted_jobs.append(submit_relationship_create_job(relationships_to_create))
-
-        del relationships_to_create[:]
-
-    if submitted_jobs:
-        jobs_to_check = list(submitted_jobs)
-        next_jobs_to_check = list()
-
-        # We will make attempts to check the status of the jobs and see if they have
-        # completed.  The max time we will wait is the number of jobs we submitted
-        # times the amount of time it takes to create a full batch of relationships.
-        # This total wait time will be broken into chunks based on how long it would
-        # take a single batch of relationships to be created.  For example, if we
-        # submitted 3 jobs and each job had a batch of 20 relationships to create,
-        # then it should take 5 seconds to create the 20 relationships based on being
-        # able to create them at a rate of 4 per second.  We will wait 5 seconds, then
-        # check the status of all jobs.  If there are any jobs still waiting to complete,
-        # then we will wait another 5 seconds and check the status of the jobs that were
-        # previously waiting to complete.
-        # Added 20% padding to wait a little bit longer for the jobs to complete
-        # if needed.
-        for i in range(int(math.ceil(len(submitted_jobs) * 1.2))):
-            time.sleep(RELATIONSHIPS_JOB_WAIT_SECONDS)
-
-            for job_to_check in jobs_to_check:
-                try:
-                    job = freshservice.get_job(job_to_check["job_id"])
-                    status = job["status"]
-
-                    if status == "success":
-                        # All relationships were created.
-                        logger.info("Job %s created all %d relationships successfully." % (job_to_check["job_id"], job_to_check["relationships_to_create_count"]))
-                    elif status in ["failed", "partial"]:
-                        # No relationships were created (failed status) or some relationships
-                        # were created and some were not (partial status).
-                        for relationship in job["relationships"]:
-                            if not relationship["success"]:
-                                log = "Job %s failed to create relationship: %s" % (job_to_check["job_id"], relationship)
-                                logger.exception(log)
-                    elif status in ["queued", "in progress"]:
-                        # The job has not completed yet.
-                        next_jobs_to_check.append(job_to_check)
-                        log = "Job %s has not completed yet. The job status is %s." % (job_to_check["job_id"], status)
-                        logger.info(log)
-                    else:
-                        raise Exception("Received unknown job status of %s." % status)
-                except Exception as e:
-                    log = "Error (%s) checking job %s" % (str(e), job_to_check["job_id"])
-                    logger.exception(log)
-
-            # Clear the list.
-            del jobs_to_check[:]
-
-            if next_jobs_to_check:
-                # We still have jobs we need to check.
-                jobs_to_check.extend(next_jobs_to_check)
-
-                # Clear the list so that we can add the next set of jobs that are
-                # still waiting to complete.
-                del next_jobs_to_check[:]
-            else:
-                # There are no more jobs that we need to check, so we can stop
-                # checking.
-                break
-
-        if jobs_to_check:
-            submitted_jobs_count = len(submitted_jobs)
-            jobs_not_completed_count = len(jobs_to_check)
-
-            logger.info("%d of %d relationship create jobs did not complete." % (jobs_not_completed_count, submitted_jobs_count))
+        if (primary_id, secondary_id) in relationship_index:
+            logger.info("There is already relationship in FS.")
+            if sync_state is not None:
+                sync_state.record("relationship", "%d-%d-%d" % (relationship_type["id"], primary_id, secondary_id))
+            continue
 
+        job_tracker.add({
+            "relationship_type_id": relationship_type["id"],
+            "primary_id": primary_id,
+            "primary_type": "asset",
+            "secondary_id": secondary_id,
+            "secondary_type": "asset"
+        })
 
-def delete_relationships_from_affinity_group(sources, _target, mapping):
-    global freshservice
+    job_tracker.finish()
+    row_failures.add(job_tracker.failed_count)
 
-    logger.info("Getting all existing devices in FS.")
-    existing_objects = freshservice.request("api/v2/assets" + "?include=type_fields", "GET", _target["@model"])
-    logger.info("finished getting all existing devices in FS.")
 
+def get_relationship_type(mapping):
     logger.info("Getting relationship type in FS.")
     relationship_type = freshservice.get_relationship_type_by_content(mapping["@downstream-relationship"],
                                                                       mapping["@upstream-relationship"])
@@ -805,13 +1371,18 @@ def delete_relationships_from_affinity_group(sources, _target, mapping):
         log = "There is no relationship type in FS. (%s - %s)" % (
             mapping["@downstream-relationship"], mapping["@upstream-relationship"])
         logger.info(log)
-        return
 
+    return relationship_type
+
+
+def get_source_edges(sources, mapping, existing_objects_map):
+    # Return the (primary, secondary) display ids of the relationships described by the sources.
+    edges = list()
     for source in sources:
         try:
             logger.info("Processing %s - %s." % (source[mapping["@key"]], source[mapping["@target-key"]]))
-            primary_asset = find_object_by_name(existing_objects, source[mapping["@key"]])
-            secondary_asset = find_object_by_name(existing_objects, source[mapping["@target-key"]])
+            primary_asset = find_object_in_map(existing_objects_map, source[mapping["@key"]])
+            secondary_asset = find_object_in_map(existing_objects_map, source[mapping["@target-key"]])
 
             if primary_asset is None:
                 logger.info("There is no dependent asset(%s) in FS." % source[mapping["@key"]])
@@ -821,23 +1392,57 @@ def delete_relationships_from_affinity_group(sources, _target, mapping):
                 logger.info("There is no dependency asset(%s) in FS." % source[mapping["@target-key"]])
                 continue
 
-            relationships = freshservice.get_relationships_by_id(primary_asset["display_id"])
-            remove_relationship = None
-            for relationship in relationships:
-                if relationship["relationship_type_id"] == relationship_type["id"]:
-                    if relationship["secondary_id"] == secondary_asset["display_id"]:
-                        remove_relationship = relationship
-                        break
-            if remove_relationship is None:
-                logger.info("There is no relationship in FS.")
-                continue
-
-            freshservice.detach_relationship(remove_relationship["id"])
-            logger.info("detached relationship %d" % remove_relationship["id"])
+            edges.append((primary_asset["display_id"], secondary_asset["display_id"]))
         except Exception as e:
-            log = "Error (%s) deleting relationship %s" % (str(e), source[mapping["@key"]])
+            log = "Error (%s) processing relationship %s" % (str(e), source.get(mapping["@key"]))
             logger.exception(log)
 
+    return edges
+
+
+def detach_relationships(relationships):
+    # The relationships are detached in chunks of ids; the ones that were detached are returned.
+    detached = list()
+    if not relationships:
+        return detached
+
+    results = freshservice.detach_relationships(relationship["id"] for relationship in relationships)
+    for relationship in relationships:
+        result = results[relationship["id"]]
+        if result["error"] is not None:
+            log = "Error (%s) deleting relationship %d (chunk %d)" % (result["error"], relationship["id"], result["chunk"])
+            logger.error(log)
+            continue
+
+        logger.info("detached relationship %d (chunk %d)" % (relationship["id"], result["chunk"]))
+        if sync_state is not None:
+            sync_state.forget("relationship", get_relationship_state_key(relationship))
+        detached.append(relationship)
+
+    return detached
+
+
+def delete_relationships_from_affinity_group(sources, _target, mapping):
+    global freshservice
+
+    existing_objects_map = get_existing_assets_map()
+
+    relationship_type = get_relationship_type(mapping)
+    if relationship_type is None:
+        return
+
+    # The sources are the relationships to delete.
+    edges = get_source_edges(sources, mapping, existing_objects_map)
+
+    logger.info("Getting existing relationships in FS.")
+    relationship_index = RelationshipIndex(relationship_type["id"], logger)
+    relationship_index.load(freshservice.get_relationships_by_id, [primary_id for primary_id, _ in edges], get_workers(_target))
+    logger.info("finished getting existing relationships in FS.")
+
+    relationships_to_delete = relationship_index.existing(set(edges))
+    logger.info("%d of %d relationships exist in FS." % (len(relationships_to_delete), len(set(edges))))
+    detach_relationships(relationships_to_delete)
+
 
 def create_relationships_from_business_app(sources, _target, mapping):
     create_relationships_from_affinity_group(sources, _target, mapping)
@@ -846,52 +1451,35 @@ def create_relationships_from_business_app(sources, _target, mapping):
 def delete_relationships_from_business_app(sources, _target, mapping):
     global freshservice
 
-    logger.info("Getting all existing devices in FS.")
-    existing_objects = freshservice.request("api/v2/assets" + "?include=type_fields", "GET", _target["@model"])
-    logger.info("finished getting all existing devices in FS.")
+    existing_objects_map = get_existing_assets_map()
 
-    logger.info("Getting relationship type in FS.")
-    relationship_type = freshservice.get_relationship_type_by_content(mapping["@downstream-relationship"],
-                                                                      mapping["@upstream-relationship"])
-    logger.info("finished getting relationship type in FS.")
+    relationship_type = get_relationship_type(mapping)
     if relationship_type is None:
-        log = "There is no relationship type in FS. (%s - %s)" % (
-            mapping["@downstream-relationship"], mapping["@upstream-relationship"])
-        logger.info(log)
         return
 
-    for existing_object in existing_objects:
-        try:
-            logger.info("Checking relationship of asset(%s)." % existing_object["name"])
-            relationships = freshservice.get_relationships_by_id(existing_object["display_id"])
-            for relationship in relationships:
-                if relationship["relationship_type_id"] == relationship_type["id"] and \
-                                relationship["primary_id"] == existing_object["display_id"]:
-                    remove_relationship = relationship
-                    target_display_id = relationship["secondary_id"]
-                    for source in sources:
-                        if source[mapping["@key"]] == existing_object["name"]:
-                            secondary_asset = find_object_by_name(existing_objects, source[mapping["@target-key"]])
-                            if target_display_id == secondary_asset["display_id"]:
-                                remove_relationship = None
-                                break
-
-                    if remove_relationship is None:
-                        continue
+    # The sources are the relationships to keep.  Every relationship of this type whose primary asset
+    # is an active asset and that is not in the sources is deleted.  This is why the relationships of
+    # every asset are loaded and not only those of the assets in the sources: an asset whose last
+    # connection was removed in Device42 is no longer in the sources, and its relationships must go too.
+    edges = get_source_edges(sources, mapping, existing_objects_map)
 
-                    freshservice.detach_relationship(remove_relationship["id"])
-                    logger.info("detached relationship %d" % remove_relationship["id"])
-        except Exception as e:
-            log = "Error (%s) deleting relationship %s" % (str(e), existing_object[mapping["@key"]])
-            logger.exception(log)
+    logger.info("Getting existing relationships in FS.")
+    relationship_index = RelationshipIndex(relationship_type["id"], logger)
+    relationship_index.load(freshservice.get_relationships_by_id, [v["display_id"] for v in existing_objects_map.values()], get_workers(_target))
+    logger.info("finished getting existing relationships in FS.")
+
+    relationships_to_delete = relationship_index.orphaned(edges)
+    logger.info("%d relationships are not in Device42." % len(relationships_to_delete))
+    detach_relationships(relationships_to_delete)
 
 
 def update_contracts_from_server(sources, _target, mapping):
     global freshservice
 
-    logger.info("Getting all existing contracts in FS.")
-    existing_objects_map = freshservice.get_objects_map(_target["@path"], _target["@model"])
-    logger.info("finished getting all existing contracts in FS.")
+    detect_changes = is_change_detection_enabled(_target)
+
+    existing_objects_map = get_objects_map_from_state("contract", "contracts", _target,
+                                                      get_compared_fields([mapping]) if detect_changes else False)
     fs_cache["contracts"] = existing_objects_map
 
     if "softwares" in fs_cache:
@@ -899,11 +1487,16 @@ def update_contracts_from_server(sources, _target, mapping):
         existing_softwares_map = fs_cache["softwares"]
         logger.info("finished getting all existing softwares in FS from cache.")
     else:
-        logger.info("Getting all existing softwares in FS.")
-        existing_softwares_map = freshservice.get_objects_map(_target["@path"], _target["@model"])
-        logger.info("finished getting all existing softwares in FS.")
+        existing_softwares_map = get_objects_map_from_state("software", "softwares", _target)
         fs_cache["softwares"] = existing_softwares_map
 
+    # if there is only one field in the mapping, it will be dict.
+    if isinstance(mapping["field"], dict):
+        mapping["field"] = [mapping["field"]]
+
+    # The mapping fields are compiled once for the task.
+    field_plan = [compile_contract_field(map_info, existing_softwares_map) for map_info in mapping["field"]]
+
     for source in sources:
         error_skip = False
         while True:
@@ -915,100 +1508,29 @@ def update_contracts_from_server(sources, _target, mapping):
                 data['approver_id'] = int(default_approver)
 
                 # validation
-                for map_info in mapping["field"]:
-                    if error_skip and "@error-skip" in map_info and map_info["@error-skip"]:
+                for field in field_plan:
+                    if error_skip and field.error_skip:
                         continue
 
-                    if "@target-foregin-key" in map_info and map_info["@target-foregin"] == "applications":
-                        existing_software = find_object_in_map(existing_softwares_map, source[map_info["@resource"]])
-                        value = existing_software["id"]
-                    else:
-                        value = get_map_value_from_device42(source, map_info)
+                    value, is_valid = field.run(source)
 
-                    if "@target-sub-key" not in map_info:
-                        data[map_info["@target"]] = value
+                    if field.target_sub_key is None:
+                        field_data, key = data, field.target
                     else:  # Item cost detail attributes
-                        if map_info["@target"] not in data:
-                            data[map_info["@target"]] = [{
-                                map_info["@target-sub-key"]: value
-                            }]
-                        else:
-                            data[map_info["@target"]][0][map_info["@target-sub-key"]] = value
-
-                    is_valid = True
-                    if value is not None and "@min-length" in map_info and len(value) < map_info["@min-length"]:
-                        is_valid = False
-                        if value == "" and "@set-space" in map_info and map_info["@set-space"]:
-                            is_valid = True
-                            value = " " * map_info["@min-length"]
-                    # value might have been translated to an associated ID in Freshservice by get_map_value_from_device42
-                    #  which is why we need to check that value is a string using isinstance.
-                    if value is not None and "@max-length" in map_info and isinstance(value, str) and len(value) > map_info["@max-length"]:
-                        value = value[0:map_info["@max-length"] - 3] + "..."
-                    if value is None and "@not-null" in map_info and map_info["@not-null"]:
-                        # There is an issue with the Freshservice API where sending a null value for
-                        # a field will result in the API returning an error like "Has 0 characters,
-                        # it should have minimum of 1 characters and can have maximum of 255 characters".
-                        # This prevents us from being able to clear these field values in Freshservice (even though
-                        # the Freshservice UI allows you to clear these fields).  To get around this, we will send
-                        # a single space for string values and a 0 for integer and float values when the value
-                        # coming from D42 is null.
-                        if "@target-type" in map_info:
-                            target_type = map_info["@target-type"]
-                            if target_type == "integer" or target_type == "float":
-                                value = 0
-                            elif target_type == "date":
-                                value = None
-                                is_valid = False
-                            else:
-                                value = " "
-                        else:
-                            value = " "
-
-                    if value == 0 and "@not-zero" in map_info and map_info["@not-zero"]:
-                        # Some fields in Freshservice do not allow a 0 value.
-                        # D42 does allow a 0 for the value being synced over,
-                        # so when we try to sync that data to Freshservice,
-                        # the API returns an error like "It should be a Positive Number
-                        # less than or equal to 99999999.99" when we send a 0 value to a field
-                        # that does not accept 0.
-                        # To get around this, we will send 1 for integer values and a 0.01
-                        # for float values when the value coming from D42 is 0.
-                        if "@target-type" in map_info:
-                            target_type = map_info["@target-type"]
-                            if target_type == "integer":
-                                value = 1
-                            elif target_type == "float":
-                                value = 0.01
-                            else:
-                                value = None
-                                is_valid = False
-                        else:
-                            value = 0.01
-
-                    if "@target-foregin-key" in map_info and value is not None and isinstance(value, str):
-                        value = get_map_value_from_device42(source, map_info, True)
-                        is_valid = value is not None
-                    if "@target-type" in map_info and value is not None:
-                        target_type = map_info["@target-type"]
-                        if target_type == "integer":
-                            try:
-                                value = int(value)
-                            except Exception as e:
-                                logger.exception(str(e))
-                                is_valid = False
-
-                    if not is_valid:
-                        logger.debug("argument '%s' is invalid." % map_info["@target"])
-                        if "@target-sub-key" not in map_info:
-                            data.pop(map_info["@target"], None)
-                        else:
-                            data[[map_info["@target"]]][0].pop(map_info["@target-sub-key"])
+                        if field.target not in data:
+                            data[field.target] = [dict()]
+                        field_data, key = data[field.target][0], field.target_sub_key
+
                     if is_valid:
-                        if "@target-sub-key" not in map_info:
-                            data[map_info["@target"]] = value
-                        else:
-                            data[map_info["@target"]][0][map_info["@target-sub-key"]] = value
+                        field_data[key] = value
+                    else:
+                        logger.debug("argument '%s' is invalid." % field.target)
+                        field_data.pop(key, None)
+
+                data_hash = payload_hash(data) if sync_state is not None else None
+                if is_unchanged_since_last_sync("contract", source["name"], existing_object, data_hash):
+                    logger.info("contract %s is unchanged since the last sync" % source["name"])
+                    break
 
                 if existing_object is None:
                     logger.info("adding contract %s" % source["name"])
@@ -1017,49 +1539,51 @@ def update_contracts_from_server(sources, _target, mapping):
                     # We added a new object to Freshservice.  Add it to the map of objects that we know exist
                     # in Freshservice.
                     existing_objects_map[new_contract["name"].lower()] = new_contract
+                    record_sync_state("contract", source["name"], new_contract, data_hash)
                 else:
+                    if detect_changes:
+                        data = get_changed_fields(data, existing_object)
+                        if not data:
+                            logger.info("contract %s is unchanged" % source["name"])
+                            record_sync_state("contract", source["name"], existing_object, data_hash)
+                            break
+
                     logger.info("updating contract %s" % source["name"])
                     updated_id = freshservice.update_contract(data, existing_object["id"])
                     logger.info("updated contract %d" % updated_id)
+                    remember_sent_fields(existing_object, data)
+                    record_sync_state("contract", source["name"], existing_object, data_hash)
 
                 break
             except FreshServiceDuplicateValueError:
                 if not error_skip:
                     error_skip = True
                     continue
+                row_failures.add()
                 break
             except Exception as e:
                 log = "Error (%s) updating contract %s" % (str(e), source["name"])
                 logger.exception(log)
+                row_failures.add()
                 break
 
 
 def create_association_between_asset_and_contract(sources, _target, mapping):
     global freshservice
 
-    if "assets" in fs_cache:
-        logger.info("Getting all existing assets in FS from cache.")
-        existing_assets_map = fs_cache["assets"]
-        logger.info("finished getting all existing assets in FS from cache.")
-    else:
-        logger.info("Getting all existing assets in FS.")
-        existing_assets_map = freshservice.get_objects_map(_target["@path"], _target["@model"])
-        logger.info("finished getting all existing assets in FS.")
-        fs_cache["assets"] = existing_assets_map
+    existing_assets_map = get_existing_assets_map()
 
     if "contracts" in fs_cache:
         logger.info("Getting all existing contracts in FS from cache.")
         existing_contracts_map = fs_cache["contracts"]
         logger.info("finished getting all existing contracts in FS from cache.")
     else:
-        logger.info("Getting all existing contracts in FS.")
-        existing_contracts_map = freshservice.get_objects_map(_target["@path"], _target["@model"])
-        logger.info("finished getting all existing contracts in FS.")
+        existing_contracts_map = get_objects_map_from_state("contract", "contracts", _target)
         fs_cache["contracts"] = existing_contracts_map
 
-    # Key will be the contract ID and the value will be a set of asset IDs that the contract is
-    # associated with.
-    contract_to_assets_map = dict()
+    # Key will be the contract ID and the value will be the asset display IDs (with the name used in the
+    # logs) that the sources associate with the contract.
+    pending_associations = OrderedDict()
 
     for source in sources:
         try:
@@ -1077,24 +1601,58 @@ def create_association_between_asset_and_contract(sources, _target, mapping):
                 logger.exception(log)
                 continue
 
-            if contract["id"] not in contract_to_assets_map:
-                associated_assets = freshservice.get_associated_assets_by_contract(contract["id"])
-                contract_to_assets_map[contract["id"]] = {a["display_id"] for a in associated_assets}
+            name = "%s-%s" % (source[mapping["@device-name"]], source[mapping["@contract-name"]])
+            pending_associations.setdefault(contract["id"], OrderedDict()).setdefault(asset["display_id"], name)
+        except Exception as e:
+            log = "Error (%s) creating associated assets %s-%s" % (str(e), source[mapping["@device-name"]], source[mapping["@contract-name"]])
+            logger.exception(log)
+            row_failures.add()
 
-            if asset['display_id'] in contract_to_assets_map[contract["id"]]:
-                logger.info("There is already associated asset in FS.")
+    def get_associated_asset_ids(contract_id):
+        try:
+            associated_assets = freshservice.get_associated_assets_by_contract(contract_id)
+            return {a["display_id"] for a in associated_assets}
+        except Exception as e:
+            log = "Error (%s) getting associated assets of contract %d" % (str(e), contract_id)
+            logger.exception(log)
+            return None
+
+    # The associated assets of every contract are fetched once, up to workers="N" at the same time.
+    logger.info("Getting existing associated assets in FS.")
+    contract_to_assets_map = map_concurrently(get_associated_asset_ids, pending_associations.keys(), get_workers(_target))
+    logger.info("finished getting existing associated assets in FS.")
+
+    def get_missing_associations():
+        for contract_id, assets in pending_associations.items():
+            associated_asset_ids = contract_to_assets_map[contract_id]
+            if associated_asset_ids is None:
+                # The associated assets of this contract could not be fetched, which was already logged.
+                row_failures.add(len(assets))
                 continue
 
-            contract_to_assets_map[contract["id"]].add(asset['display_id'])
+            missing_assets = [(display_id, name) for display_id, name in assets.items() if display_id not in associated_asset_ids]
+            if len(missing_assets) < len(assets):
+                logger.info("There are already %d associated assets in FS." % (len(assets) - len(missing_assets)))
+            if missing_assets:
+                yield contract_id, associated_asset_ids, missing_assets
+
+    def add_associations(missing_association):
+        # All the missing assets of a contract are associated with one update of the contract.
+        contract_id, associated_asset_ids, missing_assets = missing_association
+        names = ", ".join(name for _, name in missing_assets)
+        try:
             data = dict()
-            data['associated_asset_ids'] = list(contract_to_assets_map[contract["id"]])
+            data['associated_asset_ids'] = list(associated_asset_ids) + [display_id for display_id, _ in missing_assets]
 
-            logger.info("adding associated asset %s-%s" % (source[mapping["@device-name"]], source[mapping["@contract-name"]]))
-            freshservice.update_contract(data, contract["id"])
-            logger.info("added associated asset %s-%s" % (source[mapping["@device-name"]], source[mapping["@contract-name"]]))
+            logger.info("adding associated assets %s" % names)
+            freshservice.update_contract(data, contract_id)
+            logger.info("added associated assets %s" % names)
         except Exception as e:
-            log = "Error (%s) creating associated assets %s-%s" % (str(e), source[mapping["@device-name"]], source[mapping["@contract-name"]])
+            log = "Error (%s) creating associated assets %s" % (str(e), names)
             logger.exception(log)
+            row_failures.add()
+
+    run_concurrently(add_associations, get_missing_associations(), get_workers(_target))
 
 
 def parse_config(url):
@@ -1105,6 +1663,79 @@ def parse_config(url):
     return config_json
 
 
+def get_task_key(task):
+    return "%s|%s" % (task["@name"] if "@name" in task else "", task["@description"] if "@description" in task else "")
+
+
+def get_incremental_query(task, _resource, _target, doql):
+    """ Add the high-water mark of the task to its DOQL query.
+
+    Returns the query, the incremental column (None if the task is not incremental) and whether this
+    is a full pass.
+    """
+    if "@incremental-column" not in _resource:
+        return doql, None, False
+
+    # Deletes compare Freshservice against the full set of rows, so they always need all of them.
+    if "@delete" in _target and _target["@delete"]:
+        return doql, None, False
+
+    if sync_state is None:
+        logger.info("incremental-column is ignored without a state file.")
+        return doql, None, False
+
+    column = _resource["@incremental-column"]
+    watermark, full_sync_at = sync_state.get_watermark(get_task_key(task))
+    full_sync_hours = _resource["@full-sync-hours"] if "@full-sync-hours" in _resource else None
+    if full_sync or watermark is None or \
+            (full_sync_hours and (full_sync_at is None or time.time() - full_sync_at > full_sync_hours * 3600)):
+        logger.info("Running a full pass of the task.")
+        return doql, column, True
+
+    # The rows at the watermark itself are read again, since rows changed within the same second as the
+    # last processed one would be missed otherwise.  Those that were already sent are skipped by their
+    # payload hash.
+    logger.info("Getting rows with %s from %s." % (column, watermark))
+    query = "SELECT * FROM (%s) incremental WHERE %s >= '%s'" % (doql.strip().rstrip(";"), column, watermark.replace("'", "''"))
+    return query, column, False
+
+
+def get_watermark_key(value):
+    # Numbers (and numeric strings) compare as numbers and everything else as text, so that a column
+    # that comes back as a mix of int and str never raises a TypeError.
+    if not isinstance(value, bool):
+        try:
+            return 0, float(value)
+        except (TypeError, ValueError):
+            pass
+    return 1, str(value)
+
+
+def track_watermark(sources, column, watermark):
+    # watermark is a one item list that ends up holding the highest value of the column.
+    for source in sources:
+        value = source.get(column)
+        if value is not None and (watermark[0] is None or get_watermark_key(value) > get_watermark_key(watermark[0])):
+            watermark[0] = value
+        yield source
+
+
+class RowFailureCounter(object):
+    """ Counts the rows of a task that could not be written to Freshservice. """
+
+    def __init__(self):
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def add(self, count=1):
+        # The rows are written by several worker threads at the same time.
+        with self.lock:
+            self.count += count
+
+
+row_failures = RowFailureCounter()
+
+
 def task_execute(task, device42):
     if "@description" in task:
         logger.info("Execute task - %s" % task["@description"])
@@ -1132,11 +1763,47 @@ def task_execute(task, device42):
 
     mapping = task['mapping']
 
+    incremental_column = None
     if doql is not None and doql:
-        sources = device42.doql(source_url, method, query=doql)
+        # With incremental-column, only the rows changed since the last run are processed.
+        doql, incremental_column, full_pass = get_incremental_query(task, _resource, _target, doql)
+
+        # With stream="true" the DOQL rows are parsed and handed to the task as they arrive.
+        stream = "@stream" in _resource and _resource["@stream"]
+        # With chunk-size, the query is run as several smaller queries (ranges of chunk-size rows on chunk-key)
+        # that are fetched concurrently.
+        chunk_size = _resource["@chunk-size"] if "@chunk-size" in _resource else None
+        chunk_key = _resource["@chunk-key"] if "@chunk-key" in _resource else None
+        if chunk_size and not chunk_key:
+            logger.error("chunk-size needs a chunk-key, the query is run as a whole.")
+            chunk_size = None
+        sources = device42.doql(source_url, method, query=doql, stream=stream,
+                                chunk_size=chunk_size, chunk_key=chunk_key)
     else:
         sources = device42.request(source_url, method, _resource["@model"])
 
+    if incremental_column is not None:
+        watermark = [None]
+        sources = track_watermark(sources, incremental_column, watermark)
+        # The rows that failed to be written are not all in Freshservice, so the watermark is kept and
+        # they are read again on the next run.
+        global row_failures
+        row_failures = RowFailureCounter()
+        execute_task_type(_type, sources, _target, mapping)
+
+        if row_failures.count:
+            logger.warning("%d row(s) of the task failed, its %s watermark is not advanced." % (row_failures.count, incremental_column))
+            return
+
+        previous_watermark, _ = sync_state.get_watermark(get_task_key(task))
+        new_watermark = str(watermark[0]) if watermark[0] is not None else previous_watermark
+        sync_state.set_watermark(get_task_key(task), new_watermark, full_pass)
+        logger.info("Saved %s watermark %s." % (incremental_column, new_watermark))
+    else:
+        execute_task_type(_type, sources, _target, mapping)
+
+
+def execute_task_type(_type, sources, _target, mapping):
     if _type == "affinity_group":
         if "@delete" in _target and _target["@delete"]:
             delete_relationships_from_affinity_group(sources, _target, mapping)
@@ -1166,9 +1833,36 @@ def task_execute(task, device42):
     else:
         if "@delete" in _target and _target["@delete"]:
             delete_objects_from_server(sources, _target, mapping)
-            return
-
-        update_objects_from_server(sources, _target, mapping)
+        else:
+            update_objects_from_server(sources, _target, mapping)
+
+
+def get_client_kwargs(settings):
+    # Optional connection settings for the Device42 and Freshservice clients.
+    kwargs = dict()
+    if "@pool_size" in settings:
+        kwargs["pool_size"] = int(settings["@pool_size"])
+    if "@connect_timeout" in settings:
+        kwargs["connect_timeout"] = float(settings["@connect_timeout"])
+    if "@read_timeout" in settings:
+        kwargs["read_timeout"] = float(settings["@read_timeout"])
+    if "@page_window" in settings:
+        kwargs["page_window"] = int(settings["@page_window"])
+    if "@workers" in settings:
+        kwargs["workers"] = int(settings["@workers"])
+    if "@rate_limit" in settings:
+        kwargs["rate_limit"] = int(settings["@rate_limit"])
+    if "@max_concurrency" in settings:
+        kwargs["max_concurrency"] = int(settings["@max_concurrency"])
+    if "@snapshot_full_sync_hours" in settings:
+        kwargs["snapshot_full_sync_hours"] = float(settings["@snapshot_full_sync_hours"])
+    # reference_cache_hours_<collection> (e.g. reference_cache_hours_vendors="1") sets the TTL of one collection.
+    reference_data_ttl_hours = {key[len("@reference_cache_hours_"):]: float(value) for key, value in settings.items()
+                                if key.startswith("@reference_cache_hours_")}
+    if reference_data_ttl_hours:
+        kwargs["reference_data_ttl_hours"] = reference_data_ttl_hours
+
+    return kwargs
 
 
 def get_agent_from_freshservice(email):
@@ -1188,7 +1882,12 @@ def get_agent_from_freshservice(email):
 
 def main():
     global freshservice
+    global freshservice_settings
+    global asset_compared_fields
     global default_approver
+    global sync_state
+    global rebuild_state
+    global full_sync
 
     args = parser.parse_args()
     if args.debug:
@@ -1207,8 +1906,20 @@ def main():
     logger.debug("configuration info: %s" % (json.dumps(config)))
 
     settings = config["meta"]["settings"]
-    device42 = Device42(settings['device42']['@url'], settings['device42']['@user'], settings['device42']['@pass'])
-    freshservice = FreshService(settings['freshservice']['@url'], settings['freshservice']['@api_key'], logger)
+
+    # The state file also caches the Freshservice reference data (asset types, vendors, etc.).
+    if args.state_file:
+        sync_state = SyncStateStore(args.state_file)
+        rebuild_state = args.rebuild_state
+        if args.refresh_cache:
+            sync_state.forget_reference_data()
+    full_sync = args.full_sync
+
+    device42 = Device42(settings['device42']['@url'], settings['device42']['@user'], settings['device42']['@pass'],
+                        **get_client_kwargs(settings['device42']))
+    freshservice_settings = settings['freshservice']
+    freshservice = FreshService(settings['freshservice']['@url'], settings['freshservice']['@api_key'], logger,
+                                reference_cache=sync_state, **get_client_kwargs(settings['freshservice']))
     if '@default_approver_email' in settings['freshservice']:
         default_approver = get_agent_from_freshservice(settings['freshservice']['@default_approver_email'])
 
@@ -1221,11 +1932,18 @@ def main():
     else:
         tasks = [config["meta"]["tasks"]["task"]]
 
-    for task in tasks:
-        if not task["@enable"]:
-            continue
+    asset_compared_fields = get_compared_fields(task["mapping"] for task in tasks
+                                                if task["@enable"] and "@type" not in task and "field" in (task.get("mapping") or {}))
+
+    try:
+        for task in tasks:
+            if not task["@enable"]:
+                continue
 
-        task_execute(task, device42)
+            task_execute(task, device42)
+    finally:
+        if sync_state is not None:
+            sync_state.close()
 
     print("Completed! View log at %s" % log_file)
     return 0
@@ -2,10 +2,19 @@
 
 
 import os
+import json
+import codecs
 import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrency import map_concurrently_async
+from transport import Transport, AsyncTransport, api_method, run_steps, run_steps_async, DEFAULT_POOL_SIZE, \
+    DEFAULT_ASYNC_POOL_SIZE, DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT
 
 requests.packages.urllib3.disable_warnings()
 
+STREAM_CHUNK_SIZE = 64 * 1024
+
 
 class Device42BaseException(Exception):
     pass
@@ -23,7 +32,56 @@ class Device42WrongRequest(Device42HTTPError):
     pass
 
 
-class Device42(object):
+def iter_json_array(chunks):
+    """ Incrementally parse a top level JSON array from an iterable of text chunks and yield its items. """
+    decoder = json.JSONDecoder()
+    buf = ""
+    started = False
+    for chunk in chunks:
+        buf += chunk
+        pos = 0
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n,":
+                pos += 1
+            if pos == len(buf):
+                break
+            if not started:
+                if buf[pos] != "[":
+                    raise ValueError("Expected a JSON array, got: %s" % buf[pos:pos + 100])
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == "]":
+                return
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # The item is not complete yet, wait for the next chunk.
+                break
+            if not isinstance(item, (dict, list)) and (end == len(buf) or buf[end] not in " \t\r\n,]"):
+                # A scalar (e.g. a number) is only complete once it is followed by a separator.
+                break
+            yield item
+            pos = end
+        buf = buf[pos:]
+
+    if buf.strip() or not started:
+        raise ValueError("Unexpected end of JSON array: %s" % buf[:100])
+
+
+class Device42Client(object):
+    """ What Device42 and AsyncDevice42 share: the request building, the response check and the API
+    methods that return whole results.
+
+    The API methods are api_method generators, run by the blocking client (Device42) or awaited on
+    the asyncio client (AsyncDevice42).  A subclass provides the transport, _run and the I/O
+    operations that the API methods yield: _send and _get_offsets.
+    """
+
+    DEVICES_PAGE_SIZE = 1000
+    DEFAULT_WORKERS = 4
+    DEFAULT_DOQL_QUERY = "SELECT * FROM view_device_v1 order by device_pk"
+
     def __init__(self, endpoint, user, password, **kwargs):
         self.base = endpoint
         self.user = user
@@ -33,88 +91,310 @@ class Device42(object):
         self.logger = kwargs.get('logger', None)
         self.base_url = "%s" % self.base
         self.headers = {}
+        self.workers = kwargs.get('workers', self.DEFAULT_WORKERS)
+        self.transport = kwargs.get('transport') or self._create_transport(
+            pool_size=kwargs.get('pool_size', self.DEFAULT_POOL_SIZE),
+            connect_timeout=kwargs.get('connect_timeout', DEFAULT_CONNECT_TIMEOUT),
+            read_timeout=kwargs.get('read_timeout', DEFAULT_READ_TIMEOUT))
 
-    def _send(self, method, path, data=None):
-        """ General method to send requests """
+    def _create_transport(self, pool_size, connect_timeout, read_timeout):
+        raise NotImplementedError
+
+    def _run(self, steps):
+        raise NotImplementedError
+
+    def _prepare_request(self, method, path, data):
         url = "%s/%s" % (self.base_url, path)
         params = None
         if method == 'GET':
             params = data
             data = None
-        resp = requests.request(method, url, data=data, params=params,
-                                auth=(self.user, self.pwd),
-                                verify=self.verify_cert, headers=self.headers)
+
+        return url, data, params
+
+    @staticmethod
+    def _check_response(method, path, data, resp):
         if not resp.ok:
             raise Device42HTTPError("HTTP %s (%s) Error %s: %s\n request was %s" %
                                     (method, path, resp.status_code, resp.text, data))
-        retval = resp.json()
-        return retval
 
-    def _get(self, path, data=None):
-        return self._send("GET", path, data=data)
+    # The operations that the API methods yield.
+
+    @staticmethod
+    def _get(path, data=None):
+        return "_send", ("GET", path, data)
 
-    def _post(self, path, data):
+    @staticmethod
+    def _post(path, data):
         if not path.endswith('/'):
             path += '/'
-        return self._send("POST", path, data=data)
+        return "_send", ("POST", path, data)
 
-    def _put(self, path, data):
+    @staticmethod
+    def _put(path, data):
         if not path.endswith('/'):
             path += '/'
-        return self._send("PUT", path, data=data)
+        return "_send", ("PUT", path, data)
+
+    @staticmethod
+    def _delete(path):
+        return "_send", ("DELETE", path)
 
-    def _delete(self, path):
-        return self._send("DELETE", path)
+    @staticmethod
+    def _offsets(path, model, limit, offset, total_count, ordered=True):
+        return "_get_offsets", (path, model, limit, offset, total_count, ordered)
 
     def _log(self, message, level="DEBUG"):
         if self.logger:
             self.logger.log(level.upper(), message)
 
+    @api_method
     def get_device_by_name(self, name):
         path = "api/1.0/devices/name/%s" % name
-        return self._get(path)
+        return (yield self._get(path))
 
-    def get_all_devices(self):
+    @api_method
+    def get_all_devices(self, ordered=True):
         path = "api/1.0/devices/all/"
-        devices = []
-        init_data = self._get(path, {'limit': 1, 'offset': 0})
-        total_count = init_data['total_count']
-        i = 0
-        limit = 1000
-        while i < total_count:
-            devices_data = self._get(path, {'limit': limit, 'offset': i})
-            devices = devices + devices_data['Devices']
-            i += limit
+        limit = self.DEVICES_PAGE_SIZE
+        init_data = yield self._get(path, {'limit': limit, 'offset': 0})
+        devices = list(init_data['Devices'])
+        for page in (yield self._offsets(path, 'Devices', limit, limit, init_data['total_count'], ordered)):
+            devices.extend(page)
 
         return devices
 
-    def doql(self, url, method, query=None):
+    @api_method
+    def request(self, source_url, method, model, ordered=True):
+        models = []
+        if method == "GET":
+            result = yield self._get(source_url)
+            if model in result:
+                models.extend(result[model])
+            limit = result.get("limit", 0)
+            total_count = result.get("total_count", 0)
+
+            for page in (yield self._offsets(source_url, model, limit, limit, total_count, ordered)):
+                models.extend(page)
+
+        return models
+
+    @api_method
+    def _get_doql_chunk_queries(self, path, query, chunk_size, chunk_key):
+        """ Split a DOQL query into smaller queries whose rows, in order, are the rows of the query.
+
+        Each chunk holds chunk_size rows: a first query numbers the rows by chunk_key, a column that is
+        unique for every row, and returns the key of the first row of every chunk.  Each chunk is then
+        the range of keys from its first key to the first key of the next chunk, ordered by chunk_key,
+        so sparse keys never make empty chunks and the rows never depend on the order in which the
+        database returns them.
+        """
+        if not chunk_key:
+            raise ValueError("A DOQL query can only be split in chunks with a chunk_key")
+
+        start_query = "SELECT %s AS chunk_start FROM (SELECT %s, row_number() OVER (ORDER BY %s) AS chunk_row " \
+                      "FROM (%s) doql_chunk) doql_chunk_rows WHERE chunk_row %% %d = 1 ORDER BY %s" % \
+                      (chunk_key, chunk_key, chunk_key, query, chunk_size, chunk_key)
+        start_rows = yield self._post(path, {"output_type": "json", "query": start_query})
+        starts = [self._get_doql_literal(row["chunk_start"]) for row in start_rows or []]
+
+        chunk_queries = list()
+        for i, start in enumerate(starts):
+            condition = "%s >= %s" % (chunk_key, start)
+            if i + 1 < len(starts):
+                condition += " AND %s < %s" % (chunk_key, starts[i + 1])
+            chunk_queries.append("SELECT * FROM (%s) doql_chunk WHERE %s ORDER BY %s" % (query, condition, chunk_key))
+
+        return chunk_queries
+
+    @staticmethod
+    def _get_doql_literal(value):
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return repr(value)
+        return "'%s'" % str(value).replace("'", "''")
+
+
+class Device42(Device42Client):
+    DEFAULT_POOL_SIZE = DEFAULT_POOL_SIZE
+
+    def _create_transport(self, pool_size, connect_timeout, read_timeout):
+        return Transport(pool_size=pool_size, connect_timeout=connect_timeout, read_timeout=read_timeout)
+
+    def _run(self, steps):
+        return run_steps(self, steps)
+
+    def _send(self, method, path, data=None):
+        """ General method to send requests """
+        url, data, params = self._prepare_request(method, path, data)
+        resp = self.transport.request(method, url, data=data, params=params,
+                                      auth=(self.user, self.pwd),
+                                      verify=self.verify_cert, headers=self.headers)
+        self._check_response(method, path, data, resp)
+        retval = resp.json()
+        return retval
+
+    def _send_stream(self, method, path, data=None):
+        """ Send a request and return the items of the JSON array in the response body as a generator """
+        url = "%s/%s" % (self.base_url, path)
+        resp = self.transport.request(method, url, data=data, auth=(self.user, self.pwd),
+                                      verify=self.verify_cert, headers=self.headers, stream=True)
+        self._check_response(method, path, data, resp)
+
+        return self._iter_response_items(resp)
+
+    def _iter_response_items(self, resp):
+        decoder = codecs.getincrementaldecoder(resp.encoding or "utf-8")(errors="replace")
+        chunks = (decoder.decode(chunk) for chunk in resp.iter_content(STREAM_CHUNK_SIZE))
+        try:
+            for item in iter_json_array(chunks):
+                yield item
+        finally:
+            resp.close()
+
+    def iter_all_devices(self, ordered=True):
+        path = "api/1.0/devices/all/"
+        limit = self.DEVICES_PAGE_SIZE
+        init_data = self._send("GET", path, {'limit': limit, 'offset': 0})
+        yield init_data['Devices']
+
+        for page in self._iter_offsets(path, 'Devices', limit, limit, init_data['total_count'], ordered):
+            yield page
+
+    def doql(self, url, method, query=None, stream=False, chunk_size=None, chunk_key=None):
         path = url
         if query is None:
-            query = "SELECT * FROM view_device_v1 order by device_pk"
+            query = self.DEFAULT_DOQL_QUERY
+
+        if chunk_size:
+            rows = self._iter_doql_chunks(path, query, int(chunk_size), chunk_key)
+            if stream:
+                return rows
+            return list(rows)
 
         data = {"output_type": "json", "query": query}
+        if not path.endswith('/'):
+            path += '/'
 
-        result = self._post(path, data)
-        return result
+        if stream:
+            # Rows are parsed from the response as they arrive instead of loading the whole result.
+            return self._send_stream("POST", path, data)
 
-    def request(self, source_url, method, model):
-        models = []
-        if method == "GET":
-            result = self._get(source_url)
-            if model in result:
-                models = result[model]
-            limit = 0
-            total_count = 0
-            if "limit" in result:
-                limit = result["limit"]
-            if "total_count" in result:
-                total_count = result["total_count"]
-            offset = limit
-            while offset < total_count:
-                result = self._get(source_url, data={"offset":offset, "limit":limit})
+        return self._send("POST", path, data)
+
+    def _iter_doql_chunks(self, path, query, chunk_size, chunk_key):
+        """ Run a DOQL query as a set of smaller queries and yield the rows of each chunk in order.
+
+        Up to self.workers chunks are fetched at the same time.
+        """
+        chunk_queries = self._get_doql_chunk_queries(path, query.strip().rstrip(";"), chunk_size, chunk_key)
+        if not path.endswith('/'):
+            path += '/'
+
+        pending = deque()
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            for chunk_query in chunk_queries:
+                pending.append(executor.submit(self._send, "POST", path, {"output_type": "json", "query": chunk_query}))
+                if len(pending) >= self.workers:
+                    for row in pending.popleft().result():
+                        yield row
+
+            while pending:
+                for row in pending.popleft().result():
+                    yield row
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def iter_pages(self, source_url, model, ordered=True):
+        """ Yield the pages of a paged GET endpoint.
+
+        The first response gives the page limit and the total_count, the remaining offsets are then
+        fetched with up to self.workers concurrent requests.  With ordered=False the pages are
+        yielded as they arrive instead of in offset order.
+        """
+        result = self._send("GET", source_url)
+        if model in result:
+            yield result[model]
+        limit = 0
+        total_count = 0
+        if "limit" in result:
+            limit = result["limit"]
+        if "total_count" in result:
+            total_count = result["total_count"]
+
+        for page in self._iter_offsets(source_url, model, limit, limit, total_count, ordered):
+            yield page
+
+    def _get_offsets(self, path, model, limit, offset, total_count, ordered=True):
+        return list(self._iter_offsets(path, model, limit, offset, total_count, ordered))
+
+    def _iter_offsets(self, path, model, limit, offset, total_count, ordered=True):
+        if not limit or offset >= total_count:
+            return
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(self._send, "GET", path, {"offset": i, "limit": limit})
+                       for i in range(offset, total_count, limit)]
+            for future in (futures if ordered else as_completed(futures)):
+                result = future.result()
                 if model in result:
-                    models += result[model]
-                offset += limit
+                    yield result[model]
 
-        return models
+
+class AsyncDevice42(Device42Client):
+    """ Device42 client whose API methods are coroutines, sent over an AsyncTransport (aiohttp).
+
+    Results are returned whole: doql returns a list of rows and there is no page by page or
+    streamed iteration.  Up to self.workers pages or DOQL chunks are fetched at the same time.
+    """
+
+    DEFAULT_POOL_SIZE = DEFAULT_ASYNC_POOL_SIZE
+
+    def _create_transport(self, pool_size, connect_timeout, read_timeout):
+        return AsyncTransport(pool_size=pool_size, connect_timeout=connect_timeout, read_timeout=read_timeout)
+
+    def _run(self, steps):
+        return run_steps_async(self, steps)
+
+    async def close(self):
+        await self.transport.close()
+
+    async def _send(self, method, path, data=None):
+        """ General method to send requests """
+        url, data, params = self._prepare_request(method, path, data)
+        resp = await self.transport.request(method, url, data=data, params=params,
+                                            auth=(self.user, self.pwd),
+                                            verify=self.verify_cert, headers=self.headers)
+        self._check_response(method, path, data, resp)
+        retval = resp.json()
+        return retval
+
+    async def doql(self, url, method, query=None, chunk_size=None, chunk_key=None):
+        path = url
+        if query is None:
+            query = self.DEFAULT_DOQL_QUERY
+        if not path.endswith('/'):
+            path += '/'
+
+        if not chunk_size:
+            return await self._send("POST", path, {"output_type": "json", "query": query})
+
+        chunk_queries = await self._get_doql_chunk_queries(path, query.strip().rstrip(";"), int(chunk_size), chunk_key)
+        chunks = await map_concurrently_async(
+            lambda chunk_query: self._send("POST", path, {"output_type": "json", "query": chunk_query}), chunk_queries, self.workers)
+        rows = []
+        for chunk_query in chunk_queries:
+            rows.extend(chunks[chunk_query])
+
+        return rows
+
+    async def _get_offsets(self, path, model, limit, offset, total_count, ordered=True):
+        # The pages are always returned in offset order.
+        if not limit or offset >= total_count:
+            return []
+
+        offsets = list(range(offset, total_count, limit))
+        results = await map_concurrently_async(lambda i: self._send("GET", path, {"offset": i, "limit": limit}), offsets, self.workers)
+        return [results[i][model] for i in offsets if model in results[i]]
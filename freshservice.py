@@ -1,18 +1,29 @@
 # -*- coding: utf-8 -*-
 
 
+import asyncio
 import requests
-from datetime import datetime
+from requests.structures import CaseInsensitiveDict
+from datetime import datetime, timedelta
+import sys
 import time
 import logging
 import jwt
 import pytz
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from concurrency import AIMDController
+from transport import Transport, AsyncTransport, api_method, run_steps, run_steps_async, DEFAULT_POOL_SIZE, \
+    DEFAULT_ASYNC_POOL_SIZE, DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT
 
 requests.packages.urllib3.disable_warnings()
 
 # in seconds
 DEFAULT_RETRY_AFTER = 10
 RETRY_AFTER_HEADER = 'Retry-After'
+RATE_LIMIT_TOTAL_HEADER = 'X-Ratelimit-Total'
+RATE_LIMIT_REMAINING_HEADER = 'X-Ratelimit-Remaining'
 
 
 class FreshServiceBaseException(Exception):
@@ -27,12 +38,152 @@ class FreshServiceDuplicateValueError(FreshServiceHTTPError):
     pass
 
 
-class FreshService(object):
+class BasicObject(object):
+    """ Cached copy of a Freshservice object with only the properties that the sync needs.
+
+    It is read and updated like a dict (obj["id"], obj.get("display_id"), "agent_id" in obj), but it
+    stores its properties in slots, which takes a fraction of the memory of a dict when hundreds of
+    thousands of assets are cached.
+    """
+
+    __slots__ = ("id", "name", "email", "display_id", "agent_id", "asset_type_id", "fields")
+    PROPERTIES = frozenset(__slots__)
+
+    def __init__(self, **properties):
+        for key, value in properties.items():
+            setattr(self, key, value)
+
+    def __getitem__(self, key):
+        if key in self.PROPERTIES:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                pass
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self.PROPERTIES:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.PROPERTIES and hasattr(self, key)
+
+    def get(self, key, default=None):
+        if key in self.PROPERTIES:
+            return getattr(self, key, default)
+        return default
+
+    def __repr__(self):
+        return repr({key: getattr(self, key) for key in self.__slots__ if hasattr(self, key)})
+
+
+class RateLimiter(object):
+    """ Token bucket that paces calls to stay just under the Freshservice rate limit.
+
+    The bucket size and refill rate come from the X-Ratelimit-Total header (calls per minute) and the
+    available tokens are lowered to X-Ratelimit-Remaining whenever the server reports fewer calls left
+    than we expected.  Only a fraction (headroom) of the limit is used.  reserve() is thread safe and
+    returns the time to wait instead of sleeping, so coroutines can wait with asyncio.sleep.
+    """
+    PERIOD = 60.0
+
+    def __init__(self, calls_per_minute=None, headroom=0.9):
+        self.lock = threading.Lock()
+        self.headroom = headroom
+        self.total = None
+        self.capacity = None
+        self.rate = None
+        self.tokens = None
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+        if calls_per_minute:
+            self._set_total(calls_per_minute)
+
+    def _set_total(self, total):
+        self.total = total
+        self.capacity = max(1.0, total * self.headroom)
+        self.rate = self.capacity / self.PERIOD
+        if self.tokens is None or self.tokens > self.capacity:
+            self.tokens = self.capacity
+
+    def _refill(self, now):
+        if self.rate is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def reserve(self):
+        """ Take a token and return the number of seconds the caller has to wait before sending the call. """
+        with self.lock:
+            now = time.monotonic()
+            wait = max(0.0, self.blocked_until - now)
+            # Until the first response tells us the limit, calls are not paced.
+            if self.rate is None:
+                return wait
+
+            self._refill(now)
+            self.tokens -= 1
+            if self.tokens < 0:
+                wait = max(wait, -self.tokens / self.rate)
+            return wait
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def update(self, headers):
+        """ Adjust the bucket from the rate limit headers of a response. """
+        try:
+            total = int(headers.get(RATE_LIMIT_TOTAL_HEADER))
+            remaining = int(headers.get(RATE_LIMIT_REMAINING_HEADER))
+        except (TypeError, ValueError):
+            return
+
+        with self.lock:
+            if total != self.total:
+                self._set_total(total)
+            self._refill(time.monotonic())
+            allowed = remaining - total * (1 - self.headroom)
+            if allowed < self.tokens:
+                self.tokens = allowed
+
+    def block(self, seconds):
+        """ Hold back every caller for the given number of seconds (e.g. after a 429). """
+        with self.lock:
+            now = time.monotonic()
+            self.blocked_until = max(self.blocked_until, now + seconds)
+            if self.tokens is not None:
+                self._refill(now)
+                self.tokens = min(self.tokens, 0.0)
+
+
+class FreshServiceClient(object):
+    """ What FreshService and AsyncFreshService share: the request building, the response handling and
+    the API methods.
+
+    The API methods are api_method generators, so they are written once and run by the blocking
+    client (FreshService) or awaited on the asyncio client (AsyncFreshService).  A subclass provides
+    the transport, _run and the I/O operations that the API methods yield: _send and request.
+    """
+
     CITypeServerName = "Server"
     PAGE_SIZE = 100
     FS_INTEGRATION_NAME_HEADER = 'FS-INTEGRATION-NAME'
     JWT_ALGORITHM = 'HS256'
     JWT_RECREATE_TIME = 15
+    DEFAULT_PAGE_WINDOW = 4
+    DEFAULT_MAX_CONCURRENCY = 16
+    DEFAULT_SNAPSHOT_FULL_SYNC_HOURS = 24
+    DETACH_RELATIONSHIPS_CHUNK_SIZE = 50
+    SNAPSHOT_TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+    UPDATED_SINCE_FILTER = "updated_at:>'%s'"
+    # How long (in hours) reference data is used from the cache before it is revalidated, per collection.
+    DEFAULT_REFERENCE_DATA_TTL_HOURS = 6
+    REFERENCE_DATA_TTL_HOURS = {
+        "asset_types": 24,
+        "relationship_types": 24,
+    }
 
     def __init__(self, endpoint, api_key, logger, **kwargs):
         self.base = endpoint
@@ -40,14 +191,33 @@ class FreshService(object):
         self.verify_cert = False
         self.debug = kwargs.get('debug', False)
         self.logger = logger
-        self.base_url = "https://%s" % self.base
+        # The endpoint is a host name (https is assumed) or a full URL, e.g. http://localhost:8080 for a test server.
+        self.base_url = self.base.rstrip("/") if "://" in self.base else "https://%s" % self.base
         self.headers = {}
         self.last_time_call_api = None
-        self.period_call_api = 1
         self.api_call_count = 0
         self.asset_types = None
+        self.page_window = kwargs.get('page_window', self.DEFAULT_PAGE_WINDOW)
+        self.rate_limiter = kwargs.get('rate_limiter') or RateLimiter(kwargs.get('rate_limit'))
+        self.snapshot_full_sync_hours = kwargs.get('snapshot_full_sync_hours', self.DEFAULT_SNAPSHOT_FULL_SYNC_HOURS)
+        self.reference_cache = kwargs.get('reference_cache')
+        self.reference_collections = None
+        self.reference_data_ttl_hours = dict(self.REFERENCE_DATA_TTL_HOURS)
+        self.reference_data_ttl_hours.update(kwargs.get('reference_data_ttl_hours') or {})
+        self.write_controller = kwargs.get('write_controller') or AIMDController(
+            maximum=kwargs.get('max_concurrency', self.DEFAULT_MAX_CONCURRENCY), logger=logger)
         self.created_by_jwt = None
         self.expired_time_jwt = None
+        self.transport = kwargs.get('transport') or self._create_transport(
+            pool_size=kwargs.get('pool_size', self.DEFAULT_POOL_SIZE),
+            connect_timeout=kwargs.get('connect_timeout', DEFAULT_CONNECT_TIMEOUT),
+            read_timeout=kwargs.get('read_timeout', DEFAULT_READ_TIMEOUT))
+
+    def _create_transport(self, pool_size, connect_timeout, read_timeout):
+        raise NotImplementedError
+
+    def _run(self, steps):
+        raise NotImplementedError
 
     def _get_created_by_jwt(self):
         if self.created_by_jwt is not None:
@@ -65,103 +235,128 @@ class FreshService(object):
         self.expired_time_jwt = timestamp
         return encoded
 
-    def _send(self, method, path, data=None, headers=None):
-        """ General method to send requests """
-        now = datetime.now()
+    def _prepare_request(self, method, path, data, headers):
         self.api_call_count += 1
 
-        is_getting_exist = False
-        if method == 'GET' and data is not None and "page" in data:
-            is_getting_exist = True
-
-        # if not is_getting_exist and self.last_time_call_api is not None and (
-        #             now - self.last_time_call_api).total_seconds() < self.period_call_api:
-        #     time.sleep(self.period_call_api - (now - self.last_time_call_api).total_seconds())
-
         url = "%s/%s" % (self.base_url, path)
         params = None
         if method == 'GET':
             params = data
             data = None
 
-        all_headers = self.headers
+        all_headers = dict(self.headers)
         if headers:
             all_headers.update(headers)
 
-        while True:
-            if method == 'GET':
-                resp = requests.request(method, url, data=data, params=params,
-                                        auth=(self.api_key, "X"),
-                                        verify=self.verify_cert, headers=all_headers)
-            else:
-                resp = requests.request(method, url, json=data, params=params,
-                                        auth=(self.api_key, "X"),
-                                        verify=self.verify_cert, headers=all_headers)
-
-            self.last_time_call_api = datetime.now()
-
-            if not resp.ok:
-                if resp.status_code == 429:
-                    self._log("HTTP %s (%s) Error %s: %s\n request was %s" %
-                              (method, path, resp.status_code, resp.text, data))
-
-                    retry_after = DEFAULT_RETRY_AFTER
-                    header_value = resp.headers.get(RETRY_AFTER_HEADER)
-                    if header_value:
-                        try:
-                            retry_after = int(header_value)
-                        except ValueError as e:
-                            client.captureException(extra={'header_value': header_value})
-                            self._log('Failed to convert Retry-After value of "%s" to int: %s' % (header_value, str(e)))
-
-                    self._log("Throttling %d second(s)..." % retry_after)
-                    time.sleep(retry_after)
-                    continue
-
-                if resp.status_code == 400:
-                    exception = None
-                    try:
-                        error_resp = resp.json()
-                        if error_resp["description"] == "Validation failed":
-                            for error in error_resp["errors"]:
-                                if (error["field"] == "serial_number" or error["field"] == "item_id") and \
-                                        (error["message"] == " must be unique" or error["message"] == " is not unique"):
-                                    exception = FreshServiceDuplicateValueError("HTTP %s (%s) Error %s: %s\n request was %s" %
-                                                                (method, path, resp.status_code, resp.text, data))
-                                    break
-                    except Exception:
-                        pass
-
-                    if exception is not None:
-                        raise exception
-
-                raise FreshServiceHTTPError("HTTP %s (%s) Error %s: %s\n request was %s" %
-                                            (method, path, resp.status_code, resp.text, data))
-
-            if method == "DELETE":
-                return True
-
-            if resp.status_code == 204:
-                return {}
-
-            retval = resp.json()
-            return retval
-
-    def _get(self, path, data=None):
-        return self._send("GET", path, data=data)
-
-    def _post(self, path, data, headers=None):
+        return url, data, params, all_headers
+
+    def _check_response(self, method, path, data, resp, response_headers=None):
+        """ Raise the error of a failed response.  Returns True if the call was throttled and has to be sent again. """
+        self.last_time_call_api = datetime.now()
+        self.rate_limiter.update(resp.headers)
+        if response_headers is not None:
+            response_headers.update(resp.headers)
+
+        if resp.ok:
+            return False
+
+        if resp.status_code == 429:
+            self._log("HTTP %s (%s) Error %s: %s\n request was %s" %
+                      (method, path, resp.status_code, resp.text, data))
+
+            retry_after = DEFAULT_RETRY_AFTER
+            header_value = resp.headers.get(RETRY_AFTER_HEADER)
+            if header_value:
+                try:
+                    retry_after = int(header_value)
+                except ValueError as e:
+                    self._log('Failed to convert Retry-After value of "%s" to int: %s' % (header_value, str(e)))
+
+            self._log("Throttling %d second(s)..." % retry_after)
+            # Block the shared limiter so that other threads (or coroutines) wait as well instead of
+            # running into the same 429.
+            self.rate_limiter.block(retry_after)
+            return True
+
+        if resp.status_code == 400:
+            exception = None
+            try:
+                error_resp = resp.json()
+                if error_resp["description"] == "Validation failed":
+                    for error in error_resp["errors"]:
+                        if (error["field"] == "serial_number" or error["field"] == "item_id") and \
+                                (error["message"] == " must be unique" or error["message"] == " is not unique"):
+                            exception = FreshServiceDuplicateValueError("HTTP %s (%s) Error %s: %s\n request was %s" %
+                                                        (method, path, resp.status_code, resp.text, data))
+                            break
+            except Exception:
+                pass
+
+            if exception is not None:
+                raise exception
+
+        raise FreshServiceHTTPError("HTTP %s (%s) Error %s: %s\n request was %s" %
+                                    (method, path, resp.status_code, resp.text, data))
+
+    def _get_response_value(self, method, path, resp):
+        if method != "GET":
+            self._forget_reference_data(path)
+
+        if method == "DELETE":
+            return True
+
+        if resp.status_code == 204:
+            return {}
+
+        if resp.status_code == 304:
+            return None
+
+        retval = resp.json()
+        return retval
+
+    @staticmethod
+    def _release_write_slot(write_controller, start, resp):
+        write_controller.release(time.monotonic() - start,
+                                 throttled=resp is not None and resp.status_code == 429,
+                                 failed=resp is None or resp.status_code >= 500)
+
+    # The operations that the API methods yield.
+
+    @staticmethod
+    def _get(path, data=None, headers=None, response_headers=None):
+        return "_send", ("GET", path, data, headers, response_headers)
+
+    @staticmethod
+    def _post(path, data, headers=None):
         if not path.endswith('/'):
             path += '/'
-        return self._send("POST", path, data=data, headers=headers)
+        return "_send", ("POST", path, data, headers)
 
-    def _put(self, path, data, headers=None):
+    @staticmethod
+    def _put(path, data, headers=None):
         if not path.endswith('/'):
             path += '/'
-        return self._send("PUT", path, data=data, headers=headers)
+        return "_send", ("PUT", path, data, headers)
+
+    @staticmethod
+    def _delete(path, data=None):
+        return "_send", ("DELETE", path, data)
 
-    def _delete(self, path, data=None):
-        return self._send("DELETE", path, data)
+    @staticmethod
+    def _list(source_url, model, page_window=None):
+        return "request", (source_url, "GET", model, page_window)
+
+    def _next_page_window(self, pages, page_window, items):
+        """ Return the number of pages to keep in flight after a page, or 0 when the listing is complete.
+
+        per_page is always PAGE_SIZE, so a page with fewer items is the last one.  The window grows by
+        one page, up to page_window, with every full page after the first, so that a listing of one or
+        two pages costs the same calls as fetching its pages one by one.  pages is the number of pages
+        received so far and items those of the last one.
+        """
+        if len(items) < self.PAGE_SIZE:
+            return 0
+        return max(1, min(page_window, pages - 1))
 
     def _log(self, message, level=logging.DEBUG):
         if self.logger:
@@ -170,75 +365,89 @@ class FreshService(object):
     def _get_asset_headers(self):
         return {self.FS_INTEGRATION_NAME_HEADER: self._get_created_by_jwt()}
 
+    @api_method
     def insert_asset(self, data):
         path = "api/v2/assets"
-        result = self._post(path, data, self._get_asset_headers())
+        result = yield self._post(path, data, self._get_asset_headers())
         return self.create_basic_object(result["asset"])
 
+    @api_method
     def update_asset(self, data, display_id):
         path = "api/v2/assets/%d" % display_id
-        result = self._put(path, data, self._get_asset_headers())
+        result = yield self._put(path, data, self._get_asset_headers())
         return result["asset"]["id"]
 
+    @api_method
     def delete_asset(self, display_id):
         path = "api/v2/assets/%d/delete_forever" % display_id
-        result = self._put(path, {"No": 1})
+        result = yield self._put(path, {"No": 1})
         return result
 
+    @api_method
     def get_assets_by_asset_type(self, asset_type_id):
         path = "api/v2/assets?include=type_fields&query=\"asset_type_id:%d\"" % asset_type_id
-        assets = self._get(path)
+        assets = yield self._get(path)
         return assets["assets"]
 
+    @api_method
     def insert_software(self, data):
         path = "api/v2/applications"
-        result = self._post(path, data)
+        result = yield self._post(path, data)
         return self.create_basic_object(result["application"])
 
+    @api_method
     def update_software(self, data, id):
         path = "api/v2/applications/%d" % id
-        result = self._put(path, data)
+        result = yield self._put(path, data)
         return result["application"]["id"]
 
+    @api_method
     def delete_software(self, id):
         path = "api/v2/applications/%d" % id
-        result = self._delete(path)
+        result = yield self._delete(path)
         return result
 
+    @api_method
     def insert_product(self, data):
         path = "api/v2/products"
-        result = self._post(path, data)
+        result = yield self._post(path, data)
         return self.create_basic_object(result["product"])
 
+    @api_method
     def update_product(self, data, id):
         path = "api/v2/products/%d" % id
-        result = self._put(path, data)
+        result = yield self._put(path, data)
         return result["product"]["id"]
 
+    @api_method
     def insert_contract(self, data):
         path = "api/v2/contracts"
-        result = self._post(path, data)
+        result = yield self._post(path, data)
         return self.create_basic_object(result["contract"])
 
+    @api_method
     def update_contract(self, data, id):
         path = "api/v2/contracts/%d" % id
-        result = self._put(path, data)
+        result = yield self._put(path, data)
         return result["contract"]["id"]
 
+    @api_method
     def get_associated_assets_by_contract(self, contract_id):
         path = "/api/v2/contracts/%d/associated-assets" % contract_id
-        return self.request(path, "GET", "associated_assets")
+        return (yield self._list(path, "associated_assets", page_window=1))
 
+    @api_method
     def get_all_ci_types(self):
         if self.asset_types is not None:
             return self.asset_types
         path = "api/v2/asset_types"
-        self.asset_types = self.request(path, "GET", "asset_types")
+        self.asset_types = yield from self.get_reference_data.steps(self, path, "asset_types")
         return self.asset_types
 
+    @api_method
     def get_ci_type_by_name(self, name, all_ci_types=None):
         if all_ci_types is None:
-            all_ci_types = self.get_all_ci_types()
+            all_ci_types = yield from self.get_all_ci_types.steps(self)
 
         for ci_type in all_ci_types:
             if ci_type["name"] == name:
@@ -246,11 +455,12 @@ class FreshService(object):
 
         return None
 
+    @api_method
     def get_all_server_ci_types(self):
-        all_ci_types = self.get_all_ci_types()
+        all_ci_types = yield from self.get_all_ci_types.steps(self)
 
         server_types = []
-        server_type = self.get_ci_type_by_name("Server", all_ci_types)
+        server_type = yield from self.get_ci_type_by_name.steps(self, "Server", all_ci_types)
         if server_type is None:
             return []
 
@@ -261,47 +471,55 @@ class FreshService(object):
 
         return server_types
 
+    @api_method
     def get_server_ci_type(self):
-        return self.get_ci_type_by_name(self.CITypeServerName)
+        return (yield from self.get_ci_type_by_name.steps(self, self.CITypeServerName))
 
+    @api_method
     def get_asset_type_fields(self, asset_type_id):
         path = "api/v2/asset_types/%d/fields" % asset_type_id
-        return self._get(path)["asset_type_fields"]
+        return (yield from self.get_reference_data.steps(self, path, "asset_type_fields", paged=False))
 
+    @api_method
     def get_all_server_assets(self):
-        server_asset_types = self.get_all_server_ci_types()
+        server_asset_types = yield from self.get_all_server_ci_types.steps(self)
         server_assets = []
         for asset_type in server_asset_types:
-            assets = self.get_assets_by_asset_type(asset_type["id"])
+            assets = yield from self.get_assets_by_asset_type.steps(self, asset_type["id"])
             server_assets += assets
 
         return server_assets
 
+    @api_method
     def get_products(self):
         path = "/api/v2/products"
-        products = self._get(path)
+        products = yield self._get(path)
         return products["products"]
 
+    @api_method
     def get_vendors(self):
         path = "/api/v2/vendors"
-        vendors = self._get(path)
+        vendors = yield self._get(path)
         return vendors["vendors"]
 
+    @api_method
     def get_all_agents(self):
         path = "/api/v2/agents"
-        return self.request(path, "GET", "agents")
+        return (yield from self.get_reference_data.steps(self, path, "agents"))
 
+    @api_method
     def get_agents(self, search, page, per_page):
         path = "/api/v2/agents"
         data = {'page': page, 'per_page': per_page}
         if search and len(search) >= 2:
             data['query'] = '"~[name|first_name|last_name|email]:\'' + search + '\'"'
-        vendors = self._get(path, data)
+        vendors = yield self._get(path, data)
         return vendors["agents"]
 
+    @api_method
     def get_id_by_name(self, model, name, foregin_key="name"):
         path = "/api/v2/%s" % model
-        models = self.request(path, "GET", model)
+        models = yield self._list(path, model)
         for model in models:
             if foregin_key in model and model[foregin_key] is not None and name is not None and \
                             model[foregin_key].lower() == name.lower():
@@ -309,36 +527,19 @@ class FreshService(object):
 
         return None
 
+    @api_method
     def insert_and_get_by_name(self, model, name, asset_type_id, foregin_key="name"):
         path = "/api/v2/%s" % model
         if asset_type_id is not None:
             data = {foregin_key: name, "asset_type_id": asset_type_id}
         else:
             data = {foregin_key: name}
-        models = self._post(path, data)
+        models = yield self._post(path, data)
         for key in models:
             return self.create_basic_object(models[key])
 
         return None
 
-    def request(self, source_url, method, model):
-        if method == "GET":
-            models = []
-            page = 1
-            while True:
-                result = self._get(source_url, data={"page": page, "per_page": self.PAGE_SIZE})
-                if model in result:
-                    models += result[model]
-                    if len(result[model]) == 0:
-                        break
-                else:
-                    break
-
-                page += 1
-
-            return models
-        return []
-
     def normalize_value(self, val):
         if val:
             # Replace Unicode no-break spaces with normal spaces.
@@ -350,13 +551,22 @@ class FreshService(object):
 
         return val
 
-    def create_basic_object(self, m):
+    def create_basic_object(self, m, keep_fields=False):
         # Create an object using only the properties that we will need.  This object will
         # be stored in the cache, so we want to try to minimize the memory footprint of it.
-        obj = {"id": m["id"]}
+        obj = BasicObject(id=m["id"])
+
+        # The fields are only kept when we need to compare them with the data we are about to send.
+        # keep_fields is either True (every field) or the names of the fields that are compared.
+        if keep_fields is True:
+            obj["fields"] = m
+        elif keep_fields:
+            obj["fields"] = self.select_fields(m, keep_fields)
 
         if "name" in m:
-            obj["name"] = self.normalize_value(m["name"])
+            # Names are interned, so that a name that is also its own (lowercase) map key is stored once.
+            name = self.normalize_value(m["name"])
+            obj["name"] = sys.intern(name) if isinstance(name, str) else name
 
         if "email" in m:
             obj["email"] = m["email"]
@@ -373,15 +583,158 @@ class FreshService(object):
 
         return obj
 
-    def get_objects_map(self, source_url, model, foregin_key="name"):
-        objects = self.request(source_url, "GET", model)
+    @api_method
+    def get_objects_map(self, source_url, model, foregin_key="name", keep_fields=False):
+        objects = yield self._list(source_url, model)
+        return self.create_objects_map(objects, foregin_key, keep_fields)
+
+    @staticmethod
+    def select_fields(m, names):
+        """ Return the fields of an object whose name is in names, with the type_fields reduced the same way.
+
+        A type field matches the name it has without the asset type id suffix (e.g. vendor_1234 matches vendor).
+        """
+        fields = {sys.intern(key): value for key, value in m.items() if key in names}
+        if fields.get("type_fields"):
+            fields["type_fields"] = {sys.intern(key): value for key, value in fields["type_fields"].items()
+                                     if key in names or key.rsplit("_", 1)[0] in names}
+        return fields
+
+    def create_objects_map(self, objects, foregin_key="name", keep_fields=False):
         # Return a dictionary where the key is the lowercase name of the object (usually, but could be any other property
         # of the object like the display id) and the value is the basic object (e.g. id, name, etc.).
-        return {self.normalize_value(obj[foregin_key]).lower() if isinstance(obj[foregin_key], str) else obj[foregin_key]: self.create_basic_object(obj) for obj in objects}
-
+        return {sys.intern(self.normalize_value(obj[foregin_key]).lower()) if isinstance(obj[foregin_key], str) else obj[foregin_key]: self.create_basic_object(obj, keep_fields) for obj in objects}
+
+    @api_method
+    def get_reference_objects_map(self, source_url, model, foregin_key="name"):
+        objects = yield from self.get_reference_data.steps(self, source_url, model)
+        return self.create_objects_map(objects, foregin_key)
+
+    @api_method
+    def get_reference_data(self, source_url, model, paged=True):
+        """ Return the objects of a reference data endpoint (asset types, vendors, agents, etc.).
+
+        With a reference_cache (a sync_state.SyncStateStore), the objects are kept on disk and used
+        without any call until their TTL expires.  They are then revalidated with If-None-Match or
+        If-Modified-Since when the last response had an ETag or a Last-Modified header and fitted in
+        a single page, and fetched again otherwise.  Any write to a collection drops it from the cache.
+        """
+        if self.reference_cache is None:
+            if paged:
+                return (yield self._list(source_url, model))
+            return (yield self._get(source_url))[model]
+
+        name = source_url.strip("/")
+        cached = self.reference_cache.get_reference_data(name)
+        if self._is_reference_data_fresh(name, cached):
+            return cached["data"]
+
+        # Header names are case insensitive (and HTTP/2 servers send them in lowercase).
+        response_headers = CaseInsensitiveDict()
+        params = {"page": 1, "per_page": self.PAGE_SIZE} if paged else None
+        result = yield self._get(source_url, params, self._get_conditional_headers(cached), response_headers)
+        if result is None:
+            self._log("%s did not change, using the cached data" % name)
+            self.reference_cache.touch_reference_data(name)
+            return cached["data"]
+
+        objects = result.get(model, [])
+        if paged and len(objects) >= self.PAGE_SIZE:
+            # The validators of the first page say nothing about the other pages.
+            objects = yield self._list(source_url, model)
+            response_headers = CaseInsensitiveDict()
+
+        self.reference_cache.save_reference_data(name, objects, response_headers.get("ETag"),
+                                                 response_headers.get("Last-Modified"))
+        self._get_reference_collections().add(self._get_reference_collection(name))
+        return objects
+
+    def _is_reference_data_fresh(self, name, cached):
+        if cached is None:
+            return False
+
+        ttl_hours = self.reference_data_ttl_hours.get(self._get_reference_data_ttl_key(name), self.DEFAULT_REFERENCE_DATA_TTL_HOURS)
+        return time.time() - cached["fetched_at"] < ttl_hours * 3600
+
+    @staticmethod
+    def _get_reference_data_ttl_key(name):
+        # e.g. asset_types for api/v2/asset_types and asset_types_fields for api/v2/asset_types/5/fields
+        return "_".join(part for part in name.split("?")[0].split("/")[2:] if not part.isdigit())
+
+    @staticmethod
+    def _get_conditional_headers(cached):
+        conditional_headers = dict()
+        if cached is not None and cached["etag"]:
+            conditional_headers["If-None-Match"] = cached["etag"]
+        if cached is not None and cached["last_modified"]:
+            conditional_headers["If-Modified-Since"] = cached["last_modified"]
+
+        return conditional_headers
+
+    def _forget_reference_data(self, path):
+        # A write to a collection (e.g. POST api/v2/vendors or PUT api/v2/vendors/1) makes its cached data stale.
+        if self.reference_cache is not None:
+            collection = self._get_reference_collection(path.strip("/"))
+            reference_collections = self._get_reference_collections()
+            if collection in reference_collections:
+                self.reference_cache.forget_reference_data(collection)
+                reference_collections.discard(collection)
+
+    def _get_reference_collections(self):
+        # The collections that have data in the cache, so that writes to other collections cost nothing.
+        if self.reference_collections is None:
+            self.reference_collections = {self._get_reference_collection(name)
+                                          for name in self.reference_cache.get_reference_data_names()}
+        return self.reference_collections
+
+    @staticmethod
+    def _get_reference_collection(name):
+        # e.g. api/v2/asset_types for api/v2/asset_types/5/fields
+        return "/".join(name.split("?")[0].split("/")[:3])
+
+    @api_method
+    def get_objects_with_snapshot(self, source_url, model, snapshot, full_sync=False, snapshot_name=None, trashed=False):
+        """ Return the objects of a list endpoint and keep a local snapshot of them up to date.
+
+        Only the objects updated since the snapshot was last refreshed are fetched and merged into it.
+        The snapshot is replaced with a full listing on the first call, when full_sync is set or when
+        the last full listing is older than snapshot_full_sync_hours, which is how hard deletes are caught.
+        With trashed, the objects moved to the trash since the last refresh (listed with trashed=true)
+        are removed from the snapshot.  snapshot_name (the model by default) is the name it is kept
+        under, and snapshot is a sync_state.SyncStateStore (or any object with the same snapshot methods).
+        """
+        snapshot_name = snapshot_name or model
+        refreshed_at, full_sync_at = snapshot.get_snapshot_info(snapshot_name)
+        started_at = datetime.utcnow().strftime(self.SNAPSHOT_TIME_FORMAT)
+
+        if full_sync or refreshed_at is None or full_sync_at is None or \
+                time.time() - full_sync_at > self.snapshot_full_sync_hours * 3600:
+            self._log("Getting all %s for the snapshot" % model)
+            objects = yield self._list(source_url, model)
+            snapshot.save_snapshot(snapshot_name, objects, started_at, full_sync=True)
+            return objects
+
+        # The filter only has a day precision, so we go back one more day to not miss any update.
+        since = (datetime.strptime(refreshed_at, self.SNAPSHOT_TIME_FORMAT) - timedelta(days=1)).strftime("%Y-%m-%d")
+        separator = "&" if "?" in source_url else "?"
+        updated_filter = "filter=\"%s\"" % (self.UPDATED_SINCE_FILTER % since)
+        updated_objects = yield self._list("%s%s%s" % (source_url, separator, updated_filter), model)
+        self._log("Merging %d updated %s into the snapshot" % (len(updated_objects), model))
+        snapshot.save_snapshot(snapshot_name, updated_objects, started_at)
+
+        if trashed:
+            path = "%s?trashed=true&%s" % (source_url.split("?")[0], updated_filter)
+            trashed_objects = yield self._list(path, model)
+            self._log("Removing %d trashed %s from the snapshot" % (len(trashed_objects), model))
+            for obj in trashed_objects:
+                snapshot.remove_snapshot_object(snapshot_name, obj["id"])
+
+        return snapshot.load_snapshot(snapshot_name)
+
+    @api_method
     def get_relationship_type_by_content(self, downstream, upstream):
         path = "/api/v2/relationship_types"
-        relationship_types = self.request(path, "GET", "relationship_types")
+        relationship_types = yield from self.get_reference_data.steps(self, path, "relationship_types")
 
         for relationship_type in relationship_types:
             if relationship_type["downstream_relation"] == downstream and relationship_type["upstream_relation"] == upstream:
@@ -389,31 +742,271 @@ class FreshService(object):
 
         return None
 
+    @api_method
     def get_relationships_by_id(self, asset_id):
         path = "/api/v2/assets/%d/relationships" % asset_id
-        return self.request(path, "GET", "relationships")
+        return (yield self._list(path, "relationships", page_window=1))
 
+    @api_method
     def insert_relationships(self, data):
         path = "/api/v2/relationships/bulk-create"
-        job = self._post(path, data)
+        job = yield self._post(path, data)
         return job["job_id"]
 
+    @api_method
     def detach_relationship(self, relationship_id):
         path = "/api/v2/relationships?ids=%d" % relationship_id
-        return self._delete(path)
-
+        return (yield self._delete(path))
+
+    @api_method
+    def detach_relationships(self, relationship_ids, chunk_size=None):
+        """ Detach relationships, sending up to chunk_size ids in each DELETE call.
+
+        A chunk that fails is split in halves that are sent again, down to single ids, so only the
+        relationships that cannot be detached are left.  Returns a dictionary with, for every id, the
+        number of the chunk it was sent in and the error that prevented detaching it (or None).
+        """
+        chunk_size = chunk_size or self.DETACH_RELATIONSHIPS_CHUNK_SIZE
+        relationship_ids = list(relationship_ids)
+        results = dict()
+        for chunk_number, start in enumerate(range(0, len(relationship_ids), chunk_size)):
+            yield from self._detach_relationships_chunk(relationship_ids[start:start + chunk_size], chunk_number, results)
+
+        return results
+
+    def _detach_relationships_chunk(self, relationship_ids, chunk_number, results):
+        path = "/api/v2/relationships?ids=%s" % ",".join(str(relationship_id) for relationship_id in relationship_ids)
+        try:
+            yield self._delete(path)
+            error = None
+        except FreshServiceHTTPError as e:
+            if len(relationship_ids) > 1:
+                self._log("Detaching %d relationships of chunk %d failed, splitting them" % (len(relationship_ids), chunk_number))
+                middle = len(relationship_ids) // 2
+                yield from self._detach_relationships_chunk(relationship_ids[:middle], chunk_number, results)
+                yield from self._detach_relationships_chunk(relationship_ids[middle:], chunk_number, results)
+                return
+            error = str(e)
+        except Exception as e:
+            # Not an error response for these ids (e.g. a connection error), so splitting would not help.
+            error = str(e)
+
+        for relationship_id in relationship_ids:
+            results[relationship_id] = {"chunk": chunk_number, "error": error}
+
+    @api_method
     def get_installations_by_id(self, display_id):
         path = "/api/v2/applications/%d/installations" % display_id
-        return self.request(path, "GET", "installations")
+        return (yield self._list(path, "installations", page_window=1))
 
+    @api_method
     def insert_installation(self, display_id, data):
         path = "/api/v2/applications/%d/installations" % display_id
-        installation = self._post(path, data)
+        installation = yield self._post(path, data)
         if len(installation) > 0:
             return installation['installation']["id"]
 
         return -1
 
+    @api_method
     def get_job(self, job_id):
         path = "/api/v2/jobs/%s" % job_id
-        return self._get(path)
+        return (yield self._get(path))
+
+
+class FreshService(FreshServiceClient):
+    DEFAULT_POOL_SIZE = DEFAULT_POOL_SIZE
+
+    def _create_transport(self, pool_size, connect_timeout, read_timeout):
+        return Transport(pool_size=pool_size, connect_timeout=connect_timeout, read_timeout=read_timeout)
+
+    def _run(self, steps):
+        return run_steps(self, steps)
+
+    def _send(self, method, path, data=None, headers=None, response_headers=None):
+        """ General method to send requests
+
+        The headers of the response are copied to response_headers if it is given.  A 304 response (to a
+        conditional GET) returns None.
+        """
+        url, data, params, all_headers = self._prepare_request(method, path, data, headers)
+
+        while True:
+            if method == 'GET':
+                self.rate_limiter.acquire()
+                resp = self.transport.request(method, url, data=data, params=params,
+                                              auth=(self.api_key, "X"),
+                                              verify=self.verify_cert, headers=all_headers)
+            else:
+                resp = self._send_write(method, url, data, params, all_headers)
+
+            if self._check_response(method, path, data, resp, response_headers):
+                continue
+
+            return self._get_response_value(method, path, resp)
+
+    def _send_write(self, method, url, data, params, headers):
+        # Writes go through the adaptive concurrency controller, which decides how many of them may
+        # be in flight based on their latency and on 429/5xx responses.
+        self.write_controller.acquire()
+        resp = None
+        start = time.monotonic()
+        try:
+            self.rate_limiter.acquire()
+            start = time.monotonic()
+            resp = self.transport.request(method, url, json=data, params=params,
+                                          auth=(self.api_key, "X"),
+                                          verify=self.verify_cert, headers=headers)
+            return resp
+        finally:
+            self._release_write_slot(self.write_controller, start, resp)
+
+    def request(self, source_url, method, model, page_window=None):
+        if method == "GET":
+            models = []
+            for items in self.iter_pages(source_url, model, page_window):
+                models += items
+
+            return models
+        return []
+
+    def iter_pages(self, source_url, model, page_window=None):
+        """ Yield the pages of a list endpoint in page order.
+
+        The first two pages are fetched alone, and up to page_window pages are in flight once the
+        earlier pages came back full.  Paging stops at the first page that does not contain the model or that
+        is shorter than per_page, so a listing that fits in one page costs a single call.
+        """
+        if page_window is None:
+            page_window = self.page_window
+        page_window = max(1, page_window)
+
+        window = 1
+        pages = 0
+        next_page = 1
+        pending = deque()
+        executor = ThreadPoolExecutor(max_workers=page_window)
+        try:
+            while True:
+                while len(pending) < window:
+                    pending.append(executor.submit(self._send, "GET", source_url,
+                                                   {"page": next_page, "per_page": self.PAGE_SIZE}))
+                    next_page += 1
+
+                result = pending.popleft().result()
+                items = result.get(model) or []
+                if items:
+                    yield items
+
+                pages += 1
+                window = self._next_page_window(pages, page_window, items)
+                if not window:
+                    break
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+
+class AsyncFreshService(FreshServiceClient):
+    """ FreshService client whose API methods are coroutines, sent over an AsyncTransport (aiohttp).
+
+    The API methods, the 429/Retry-After handling, the duplicate value detection, the rate limiter,
+    the write concurrency controller and the JWT FS-INTEGRATION-NAME header are shared with
+    FreshService, so many calls can be in flight on one event loop without a thread for each of
+    them.  request returns whole lists: there is no page by page iteration.
+    """
+
+    DEFAULT_POOL_SIZE = DEFAULT_ASYNC_POOL_SIZE
+
+    def __init__(self, endpoint, api_key, logger, **kwargs):
+        super(AsyncFreshService, self).__init__(endpoint, api_key, logger, **kwargs)
+        self.write_slots = None
+
+    def _create_transport(self, pool_size, connect_timeout, read_timeout):
+        return AsyncTransport(pool_size=pool_size, connect_timeout=connect_timeout, read_timeout=read_timeout)
+
+    def _run(self, steps):
+        return run_steps_async(self, steps)
+
+    async def close(self):
+        await self.transport.close()
+
+    async def _send(self, method, path, data=None, headers=None, response_headers=None):
+        url, data, params, all_headers = self._prepare_request(method, path, data, headers)
+
+        while True:
+            if method == 'GET':
+                await self._acquire_rate_limit()
+                resp = await self.transport.request(method, url, data=data, params=params,
+                                                    auth=(self.api_key, "X"),
+                                                    verify=self.verify_cert, headers=all_headers)
+            else:
+                resp = await self._send_write(method, url, data, params, all_headers)
+
+            if self._check_response(method, path, data, resp, response_headers):
+                continue
+
+            return self._get_response_value(method, path, resp)
+
+    async def _acquire_rate_limit(self):
+        wait = self.rate_limiter.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def _send_write(self, method, url, data, params, headers):
+        # The condition is created here so that it belongs to the running event loop.
+        if self.write_slots is None:
+            self.write_slots = asyncio.Condition()
+
+        async with self.write_slots:
+            await self.write_slots.wait_for(self.write_controller.try_acquire)
+
+        resp = None
+        start = time.monotonic()
+        try:
+            await self._acquire_rate_limit()
+            start = time.monotonic()
+            resp = await self.transport.request(method, url, json=data, params=params,
+                                                auth=(self.api_key, "X"),
+                                                verify=self.verify_cert, headers=headers)
+            return resp
+        finally:
+            self._release_write_slot(self.write_controller, start, resp)
+            async with self.write_slots:
+                self.write_slots.notify_all()
+
+    async def request(self, source_url, method, model, page_window=None):
+        """ Return all the objects of a list endpoint, with the same paging as FreshService.iter_pages. """
+        if method != "GET":
+            return []
+
+        if page_window is None:
+            page_window = self.page_window
+        page_window = max(1, page_window)
+
+        models = []
+        window = 1
+        pages = 0
+        next_page = 1
+        pending = deque()
+        try:
+            while True:
+                while len(pending) < window:
+                    pending.append(asyncio.ensure_future(self._send("GET", source_url, {"page": next_page, "per_page": self.PAGE_SIZE})))
+                    next_page += 1
+
+                result = await pending.popleft()
+                items = result.get(model) or []
+                models += items
+
+                pages += 1
+                window = self._next_page_window(pages, page_window, items)
+                if not window:
+                    break
+        finally:
+            for future in pending:
+                future.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+        return models
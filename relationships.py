@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+
+
+import time
+import logging
+import threading
+from collections import deque
+
+from concurrency import run_concurrently
+
+
+class RelationshipIndex(object):
+    """ In-memory index of the existing Freshservice relationships of one relationship type.
+
+    Relationships are keyed by (primary_id, secondary_id), the display ids of the two assets.  The
+    relationships of each asset are fetched at most once, so the relationships that have to be
+    created or deleted are found with set operations instead of one lookup per source.
+    """
+
+    def __init__(self, relationship_type_id, logger=None):
+        self.relationship_type_id = relationship_type_id
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.relationships = dict()
+        self.loaded_asset_ids = set()
+
+    def load(self, get_relationships, asset_ids, workers=1):
+        """ Fetch the relationships of the given assets with get_relationships(display_id).
+
+        Up to workers assets are fetched at the same time.  An asset whose relationships could not be
+        fetched is logged and is not marked as loaded, see is_loaded.
+        """
+        asset_ids = set(asset_ids) - self.loaded_asset_ids
+
+        def load_asset(asset_id):
+            try:
+                relationships = get_relationships(asset_id)
+            except Exception as e:
+                self._log("Error (%s) getting relationships of asset %s" % (str(e), asset_id), logging.ERROR)
+                return
+
+            with self.lock:
+                for relationship in relationships:
+                    self.add(relationship)
+                self.loaded_asset_ids.add(asset_id)
+
+        run_concurrently(load_asset, asset_ids, workers)
+
+    def is_loaded(self, asset_id):
+        return asset_id in self.loaded_asset_ids
+
+    def add(self, relationship):
+        if relationship["relationship_type_id"] == self.relationship_type_id:
+            self.relationships[(relationship["primary_id"], relationship["secondary_id"])] = relationship
+
+    def remove(self, relationship):
+        self.relationships.pop((relationship["primary_id"], relationship["secondary_id"]), None)
+
+    def __contains__(self, edge):
+        return edge in self.relationships
+
+    def __iter__(self):
+        return iter(list(self.relationships.values()))
+
+    def existing(self, edges):
+        """ The existing relationships for the given (primary_id, secondary_id) edges. """
+        return [self.relationships[edge] for edge in edges if edge in self.relationships]
+
+    def orphaned(self, edges):
+        """ The existing relationships whose primary asset was loaded and that are not in edges. """
+        edges = set(edges)
+        return [relationship for key, relationship in self.relationships.items()
+                if key not in edges and relationship["primary_id"] in self.loaded_asset_ids]
+
+    def _log(self, message, level=logging.DEBUG):
+        if self.logger:
+            self.logger.log(level, message)
+
+
+class RelationshipJobTracker(object):
+    """ Creates relationships through bulk-create background jobs and follows the jobs until they complete.
+
+    Relationships are queued with add and sent in batches while up to max_jobs earlier jobs are still
+    running.  Each job is polled when it is expected to be done, based on the creation rate measured
+    on the jobs that already completed, and again with a growing delay while it is still running.
+    The batch size follows the measured rate, so that a job takes about target_job_seconds.
+    Relationships that a failed or partial job did not create are queued again, up to max_attempts
+    times.  on_created is called with every relationship that was created.
+    """
+
+    FIRST_POLL_FRACTION = 0.5
+    POLL_BACKOFF = 1.5
+    MIN_POLL_SECONDS = 1.0
+    MAX_POLL_SECONDS = 30.0
+    # A job that is still running after this many seconds is no longer followed.
+    JOB_TIMEOUT_SECONDS = 600.0
+
+    def __init__(self, freshservice, batch_size=20, created_per_second=4.0, max_jobs=4, target_job_seconds=5.0,
+                 min_batch_size=1, max_batch_size=100, max_attempts=3, on_created=None, logger=None):
+        self.freshservice = freshservice
+        self.batch_size = batch_size
+        self.rate = float(created_per_second)
+        self.max_jobs = max_jobs
+        self.target_job_seconds = target_job_seconds
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.max_attempts = max_attempts
+        self.on_created = on_created
+        self.logger = logger
+        self.queue = deque()
+        self.attempts = dict()
+        self.jobs = list()
+        self.submitted_count = 0
+        self.created_count = 0
+        self.failed_count = 0
+
+    def add(self, relationship):
+        self.queue.append(relationship)
+        # Submit the full batches right away, polling the running jobs when the window is full.
+        while len(self.queue) >= self.batch_size:
+            if len(self.jobs) >= self.max_jobs:
+                self._wait_for_job()
+            else:
+                self._submit()
+
+    def finish(self):
+        """ Submit the queued relationships and wait until every job completed or timed out. """
+        while self.queue or self.jobs:
+            if self.queue and len(self.jobs) < self.max_jobs:
+                self._submit()
+            else:
+                self._wait_for_job()
+
+        self._log("%d relationships created, %d failed, in %d jobs." %
+                  (self.created_count, self.failed_count, self.submitted_count), logging.INFO)
+
+    def _submit(self):
+        batch = [self.queue.popleft() for _ in range(min(self.batch_size, len(self.queue)))]
+        try:
+            job_id = self.freshservice.insert_relationships({"relationships": batch})
+        except Exception as e:
+            self._log("Error (%s) adding relationship create job" % str(e), logging.ERROR)
+            # The batch might be too large, so it is retried with smaller batches.
+            self.batch_size = max(self.min_batch_size, self.batch_size // 2)
+            self._retry(batch)
+            return
+
+        # The first poll comes before the job is expected to be done, so that a faster rate than the
+        # current estimate can be measured.
+        now = time.time()
+        poll_seconds = min(max(len(batch) / self.rate * self.FIRST_POLL_FRACTION, self.MIN_POLL_SECONDS), self.MAX_POLL_SECONDS)
+        self.jobs.append({
+            "job_id": job_id,
+            "relationships": batch,
+            "submitted_at": now,
+            "next_poll_at": now + poll_seconds,
+            "poll_seconds": poll_seconds
+        })
+        self.submitted_count += 1
+        self._log("added new relationship create job %s with %d relationships" % (job_id, len(batch)), logging.INFO)
+
+    def _wait_for_job(self):
+        job = min(self.jobs, key=lambda j: j["next_poll_at"])
+        delay = job["next_poll_at"] - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+        try:
+            result = self.freshservice.get_job(job["job_id"])
+            status = result["status"]
+        except Exception as e:
+            self._log("Error (%s) checking job %s" % (str(e), job["job_id"]), logging.ERROR)
+            status = None
+
+        now = time.time()
+        if status in ["success", "failed", "partial"]:
+            self.jobs.remove(job)
+            self._completed(job, status, result, now)
+        elif now - job["submitted_at"] > self.JOB_TIMEOUT_SECONDS:
+            self.jobs.remove(job)
+            # The relationships of the job are not known to be created, so they count as failed.
+            self.failed_count += len(job["relationships"])
+            self._log("Job %s did not complete (status %s)." % (job["job_id"], status), logging.ERROR)
+        else:
+            if status not in ["queued", "in progress", None]:
+                self._log("Received unknown job status of %s for job %s." % (status, job["job_id"]), logging.ERROR)
+            job["poll_seconds"] = min(job["poll_seconds"] * self.POLL_BACKOFF, self.MAX_POLL_SECONDS)
+            job["next_poll_at"] = now + job["poll_seconds"]
+            self._log("Job %s has not completed yet. The job status is %s." % (job["job_id"], status))
+
+    def _completed(self, job, status, result, now):
+        if status == "success":
+            # All relationships were created.
+            created = job["relationships"]
+            failed = []
+        else:
+            # No relationships were created (failed status) or some relationships were created and
+            # some were not (partial status).  The results are matched to what was sent by their ids.
+            results = dict()
+            for relationship in result.get("relationships", []):
+                if "primary_id" in relationship and "secondary_id" in relationship:
+                    results[(relationship["primary_id"], relationship["secondary_id"])] = relationship["success"]
+                elif not relationship["success"]:
+                    self._log("Job %s failed to create relationship: %s" % (job["job_id"], relationship), logging.ERROR)
+
+            # A relationship missing from the results is assumed created in a partial job and not in a failed one.
+            created, failed = [], []
+            for relationship in job["relationships"]:
+                if results.get((relationship["primary_id"], relationship["secondary_id"]), status == "partial"):
+                    created.append(relationship)
+                else:
+                    failed.append(relationship)
+
+        self._log("Job %s created %d of %d relationships." % (job["job_id"], len(created), len(job["relationships"])),
+                  logging.INFO)
+        for relationship in created:
+            self.created_count += 1
+            if self.on_created:
+                self.on_created(relationship)
+        self._retry(failed)
+
+        # Tune the rate and the batch size with the time the job took.  The time includes the polling
+        # delay, so the measured rate errs on the slow side.
+        if created:
+            sample = len(job["relationships"]) / max(now - job["submitted_at"], self.MIN_POLL_SECONDS)
+            self.rate = 0.7 * self.rate + 0.3 * sample
+            self.batch_size = int(min(max(self.rate * self.target_job_seconds, self.min_batch_size), self.max_batch_size))
+
+    def _retry(self, relationships):
+        for relationship in relationships:
+            key = self._key(relationship)
+            self.attempts[key] = self.attempts.get(key, 1) + 1
+            if self.attempts[key] > self.max_attempts:
+                self.failed_count += 1
+                self._log("Failed to create relationship: %s" % relationship, logging.ERROR)
+            else:
+                self.queue.append(relationship)
+
+    @staticmethod
+    def _key(relationship):
+        return relationship["relationship_type_id"], relationship["primary_id"], relationship["secondary_id"]
+
+    def _log(self, message, level=logging.DEBUG):
+        if self.logger:
+            self.logger.log(level, message)
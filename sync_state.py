@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+
+
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+# Each entry upgrades the schema by one version; the current version is stored in PRAGMA user_version.
+MIGRATIONS = [
+    [
+        """CREATE TABLE entities (
+            kind TEXT NOT NULL,
+            d42_key TEXT NOT NULL,
+            fs_id INTEGER,
+            display_id INTEGER,
+            payload_hash TEXT,
+            pushed_at REAL,
+            PRIMARY KEY (kind, d42_key)
+        )""",
+    ],
+    [
+        """CREATE TABLE watermarks (
+            task TEXT NOT NULL PRIMARY KEY,
+            value TEXT,
+            full_sync_at REAL
+        )""",
+    ],
+    [
+        """CREATE TABLE snapshots (
+            name TEXT NOT NULL PRIMARY KEY,
+            refreshed_at TEXT,
+            full_sync_at REAL
+        )""",
+        """CREATE TABLE snapshot_objects (
+            name TEXT NOT NULL,
+            object_id INTEGER NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (name, object_id)
+        )""",
+    ],
+    [
+        """CREATE TABLE reference_data (
+            name TEXT NOT NULL PRIMARY KEY,
+            data TEXT NOT NULL,
+            etag TEXT,
+            last_modified TEXT,
+            fetched_at REAL
+        )""",
+    ],
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+# Number of writes after which the pending changes are committed.
+COMMIT_EVERY = 500
+
+
+class SyncStateError(Exception):
+    pass
+
+
+def payload_hash(data):
+    return hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class SyncStateStore(object):
+    """ Local SQLite store of what has been pushed to Freshservice.
+
+    For every synced entity (device, software, product, contract, relationship, installation) it
+    keeps the Freshservice id/display_id, a hash of the last payload sent and when it was sent.
+    The store is safe to use from several threads.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.pending_writes = 0
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self._migrate()
+
+    def _migrate(self):
+        with self.lock:
+            version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+            if version > SCHEMA_VERSION:
+                raise SyncStateError("State file %s has schema version %d, newer than the supported version %d" %
+                                     (self.path, version, SCHEMA_VERSION))
+            for statements in MIGRATIONS[version:]:
+                for statement in statements:
+                    self.conn.execute(statement)
+                version += 1
+                self.conn.execute("PRAGMA user_version = %d" % version)
+            self.conn.commit()
+
+    def _written(self, count=1):
+        self.pending_writes += count
+        if self.pending_writes >= COMMIT_EVERY:
+            self.conn.commit()
+            self.pending_writes = 0
+
+    def get(self, kind, key):
+        with self.lock:
+            row = self.conn.execute("SELECT fs_id, display_id, payload_hash, pushed_at FROM entities "
+                                    "WHERE kind = ? AND d42_key = ?", (kind, str(key))).fetchone()
+        if row is None:
+            return None
+
+        return {"fs_id": row[0], "display_id": row[1], "payload_hash": row[2], "pushed_at": row[3]}
+
+    def contains(self, kind, key):
+        return self.get(kind, key) is not None
+
+    def is_unchanged(self, kind, key, data_hash, fs_id=None):
+        """ True if the last payload pushed for this entity (to the same Freshservice id) had the same hash. """
+        entity = self.get(kind, key)
+        if entity is None or entity["payload_hash"] != data_hash:
+            return False
+
+        return fs_id is None or entity["fs_id"] == fs_id
+
+    def record(self, kind, key, fs_id=None, display_id=None, data_hash=None):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO entities (kind, d42_key, fs_id, display_id, payload_hash, pushed_at) "
+                              "VALUES (?, ?, ?, ?, ?, ?)", (kind, str(key), fs_id, display_id, data_hash, time.time()))
+            self._written()
+
+    def forget(self, kind, key):
+        with self.lock:
+            self.conn.execute("DELETE FROM entities WHERE kind = ? AND d42_key = ?", (kind, str(key)))
+            self._written()
+
+    def rebuild(self, kind, entities):
+        """ Replace every entity of a kind from a full fetch.
+
+        entities is an iterable of (key, fs_id, display_id).  The payload hashes are cleared, so the
+        next push of each entity is compared with Freshservice again.
+        """
+        with self.lock:
+            self.conn.execute("DELETE FROM entities WHERE kind = ?", (kind,))
+            self.conn.executemany("INSERT OR REPLACE INTO entities (kind, d42_key, fs_id, display_id, payload_hash, pushed_at) "
+                                  "VALUES (?, ?, ?, ?, NULL, NULL)",
+                                  ((kind, str(key), fs_id, display_id) for key, fs_id, display_id in entities))
+            self.conn.commit()
+            self.pending_writes = 0
+
+    def get_watermark(self, task):
+        """ Return the high-water mark of a task and when its last full pass ran, or (None, None). """
+        with self.lock:
+            row = self.conn.execute("SELECT value, full_sync_at FROM watermarks WHERE task = ?", (task,)).fetchone()
+        if row is None:
+            return None, None
+
+        return row[0], row[1]
+
+    def set_watermark(self, task, value, full_sync=False):
+        with self.lock:
+            _, full_sync_at = self.get_watermark(task)
+            if full_sync:
+                full_sync_at = time.time()
+            self.conn.execute("INSERT OR REPLACE INTO watermarks (task, value, full_sync_at) VALUES (?, ?, ?)",
+                              (task, value, full_sync_at))
+            self.conn.commit()
+
+    def get_snapshot_info(self, name):
+        """ Return when a snapshot was last refreshed and when it was last fully fetched, or (None, None). """
+        with self.lock:
+            row = self.conn.execute("SELECT refreshed_at, full_sync_at FROM snapshots WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return None, None
+
+        return row[0], row[1]
+
+    def load_snapshot(self, name):
+        with self.lock:
+            rows = self.conn.execute("SELECT data FROM snapshot_objects WHERE name = ? ORDER BY object_id", (name,)).fetchall()
+
+        return [json.loads(row[0]) for row in rows]
+
+    def save_snapshot(self, name, objects, refreshed_at, full_sync=False):
+        """ Merge objects into a snapshot, or replace its content with them on a full sync. """
+        with self.lock:
+            _, full_sync_at = self.get_snapshot_info(name)
+            if full_sync:
+                full_sync_at = time.time()
+                self.conn.execute("DELETE FROM snapshot_objects WHERE name = ?", (name,))
+            self.conn.executemany("INSERT OR REPLACE INTO snapshot_objects (name, object_id, data) VALUES (?, ?, ?)",
+                                  ((name, obj["id"], json.dumps(obj)) for obj in objects))
+            self.conn.execute("INSERT OR REPLACE INTO snapshots (name, refreshed_at, full_sync_at) VALUES (?, ?, ?)",
+                              (name, refreshed_at, full_sync_at))
+            self.conn.commit()
+            self.pending_writes = 0
+
+    def remove_snapshot_object(self, name, object_id):
+        with self.lock:
+            self.conn.execute("DELETE FROM snapshot_objects WHERE name = ? AND object_id = ?", (name, object_id))
+            self._written()
+
+    def get_reference_data(self, name):
+        """ Return the cached reference data saved under name, or None. """
+        with self.lock:
+            row = self.conn.execute("SELECT data, etag, last_modified, fetched_at FROM reference_data WHERE name = ?",
+                                    (name,)).fetchone()
+        if row is None:
+            return None
+
+        return {"data": json.loads(row[0]), "etag": row[1], "last_modified": row[2], "fetched_at": row[3]}
+
+    def get_reference_data_names(self):
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT name FROM reference_data").fetchall()]
+
+    def save_reference_data(self, name, data, etag=None, last_modified=None):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO reference_data (name, data, etag, last_modified, fetched_at) "
+                              "VALUES (?, ?, ?, ?, ?)", (name, json.dumps(data), etag, last_modified, time.time()))
+            self.conn.commit()
+            self.pending_writes = 0
+
+    def touch_reference_data(self, name):
+        # The cached data was revalidated, so it is fresh again.
+        with self.lock:
+            self.conn.execute("UPDATE reference_data SET fetched_at = ? WHERE name = ?", (time.time(), name))
+            self.conn.commit()
+            self.pending_writes = 0
+
+    def forget_reference_data(self, prefix=None):
+        """ Remove the reference data saved under prefix and under the names that extend it (all of it if None). """
+        with self.lock:
+            if prefix is None:
+                self.conn.execute("DELETE FROM reference_data")
+            else:
+                self.conn.execute("DELETE FROM reference_data WHERE name = ? OR substr(name, 1, ?) IN (?, ?)",
+                                  (prefix, len(prefix) + 1, prefix + "/", prefix + "?"))
+            self.conn.commit()
+            self.pending_writes = 0
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
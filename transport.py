@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+
+import json
+import asyncio
+import functools
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+
+requests.packages.urllib3.disable_warnings()
+
+# in seconds
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 120
+DEFAULT_POOL_SIZE = 10
+# Connections are cheap on an event loop, so the async transport allows many more of them.
+DEFAULT_ASYNC_POOL_SIZE = 100
+
+
+def api_method(steps):
+    """ Decorator for the API methods that a client shares with its async counterpart.
+
+    The decorated generator yields an (operation, arguments) tuple for every call it needs, where
+    operation names an I/O method of the client (e.g. "_send" or "request"), and gets its result
+    back (or its exception raised at the yield).  The client's _run performs the operations: the
+    blocking clients return the result of the method, the async clients a coroutine.  The generator
+    is available as the steps attribute, so that one API method can run another one's steps with
+    yield from.
+    """
+    @functools.wraps(steps)
+    def method(self, *args, **kwargs):
+        return self._run(steps(self, *args, **kwargs))
+
+    method.steps = steps
+    return method
+
+
+def run_steps(client, steps):
+    """ Perform the operations of an api_method generator with the blocking methods of client. """
+    value, error = None, None
+    while True:
+        try:
+            operation, args = steps.send(value) if error is None else steps.throw(error)
+        except StopIteration as e:
+            return e.value
+
+        try:
+            value, error = getattr(client, operation)(*args), None
+        except Exception as e:
+            value, error = None, e
+
+
+def _advance_steps(steps, value, error):
+    # Returns (True, the next operation) or (False, the return value), since StopIteration cannot be
+    # raised out of an executor.
+    try:
+        return True, (steps.send(value) if error is None else steps.throw(error))
+    except StopIteration as e:
+        return False, e.value
+
+
+async def run_steps_async(client, steps, blocking=False):
+    """ Coroutine counterpart of run_steps: the operations of client are coroutine methods.
+
+    With blocking=True, the generator is advanced on the default executor of the event loop, for steps
+    that do blocking work (e.g. calls of a blocking client) between their operations.  The operations
+    themselves still run on the event loop.
+    """
+    loop = asyncio.get_event_loop()
+    value, error = None, None
+    while True:
+        if blocking:
+            running, result = await loop.run_in_executor(None, _advance_steps, steps, value, error)
+        else:
+            running, result = _advance_steps(steps, value, error)
+        if not running:
+            return result
+        operation, args = result
+
+        try:
+            value, error = await getattr(client, operation)(*args), None
+        except Exception as e:
+            value, error = None, e
+
+
+class Transport(object):
+    """ Persistent HTTP session shared by the Device42 and FreshService clients.
+
+    Connections are kept alive and pooled per host, so consecutive calls against the same
+    instance reuse the TCP/TLS connection instead of doing a new handshake every time.
+    Every response is passed to the registered hooks, which get the response object
+    (the prepared request is available as response.request).
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT, hooks=None):
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.hooks = list(hooks) if hooks else []
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def request(self, method, url, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = self.timeout
+        resp = self.session.request(method, url, timeout=timeout, **kwargs)
+        for hook in self.hooks:
+            hook(resp)
+        return resp
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncResponse(object):
+    """ Response of an AsyncTransport call, with its body already read.
+
+    It has the attributes of a requests response that the clients use (ok, status_code, headers,
+    text and json()), so the same response handling works for both transports.
+    """
+
+    def __init__(self, method, url, status_code, headers, content, encoding=None):
+        self.method = method
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.encoding = encoding
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding or "utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class AsyncTransport(object):
+    """ aiohttp counterpart of Transport for the async clients.
+
+    request() is a coroutine that reads the whole body and returns an AsyncResponse.  The session is
+    created on the first request, inside the running event loop, and up to pool_size connections are
+    open at the same time.
+    """
+
+    def __init__(self, pool_size=DEFAULT_ASYNC_POOL_SIZE, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT, hooks=None):
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.hooks = list(hooks) if hooks else []
+        self.session = None
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def _get_session(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=self.read_timeout))
+        return self.session
+
+    async def request(self, method, url, params=None, data=None, json=None, auth=None, verify=True, headers=None):
+        kwargs = dict()
+        if params:
+            # Like requests, parameters without a value are left out (aiohttp rejects them).
+            kwargs["params"] = [(key, str(value)) for key, value in params.items() if value is not None]
+        if auth:
+            kwargs["auth"] = aiohttp.BasicAuth(*auth)
+        if not verify:
+            kwargs["ssl"] = False
+
+        async with self._get_session().request(method, url, data=data, json=json, headers=headers, **kwargs) as resp:
+            content = await resp.read()
+            response = AsyncResponse(method, str(resp.url), resp.status, resp.headers, content, resp.charset)
+
+        for hook in self.hooks:
+            hook(response)
+        return response
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None